@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+bench_cache.py
+~~~~~~~~~~~~~~
+
+Measures the cost of the HTTPCache hot paths: a cache hit, a cache miss and
+storing a response.
+
+Run it with ``python benchmarks/bench_cache.py``.
+"""
+import itertools
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from requests import Request  # NOQA
+from requests.models import Response  # NOQA
+from requests.structures import CaseInsensitiveDict  # NOQA
+
+from httpcache import HTTPCache  # NOQA
+from httpcache.utils import build_http_date  # NOQA
+
+URL = 'http://api.example.com/items/42'
+
+
+def make_response(url):
+    response = Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict({
+        'Date': build_http_date(time.time()),
+        'Cache-Control': 'max-age=3600',
+        'Content-Type': 'application/json',
+        'ETag': '"abc"',
+        'Content-Length': '1024'})
+    response._content = b'x' * 1024
+    response.request = Request(
+        'GET', url, headers={'Accept-Language': 'en'}).prepare()
+    return response
+
+
+def main():
+    number = 20000
+    cache = HTTPCache(capacity=number * 2)
+    response = make_response(URL)
+    assert cache.store(response, response.request)
+    assert cache.retrieve(response.request) is not None
+    miss = Request('GET', URL + '/missing').prepare()
+
+    responses = itertools.cycle(
+        [make_response(URL + '/%d' % i) for i in range(number)])
+
+    def store():
+        response = next(responses)
+        cache.store(response, response.request)
+
+    cases = [
+        ('hit', lambda: cache.retrieve(response.request)),
+        ('miss', lambda: cache.retrieve(miss)),
+        ('store', store),
+    ]
+
+    for name, case in cases:
+        seconds = min(timeit.repeat(case, number=number, repeat=5))
+        print('%-6s %8.0f ns/op' % (name, seconds / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
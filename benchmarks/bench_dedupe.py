@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+bench_dedupe.py
+~~~~~~~~~~~~~~~
+
+Replays a synthetic trace modelled on a multilingual JSON API and reports how
+many bytes of bodies sharing identical bodies saves, and what it costs.
+
+In the trace, most resources are data that doesn't depend on the language
+asked for, a minority are localised, and some are also reachable through an
+alias URL (e.g. with a tracking parameter). Clients ask for resources with a
+skewed popularity and a spread of Accept-Language values.
+
+Run it with ``python benchmarks/bench_dedupe.py``.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from requests import Request  # NOQA
+from requests.models import Response  # NOQA
+from requests.structures import CaseInsensitiveDict  # NOQA
+
+from httpcache import HTTPCache  # NOQA
+
+RESOURCES = 2000
+REQUESTS = 50000
+LANGUAGES = ('en', 'en', 'en', 'fr', 'de', 'es', 'ja')
+LOCALISED = 0.2
+ALIASED = 0.1
+
+
+def make_trace(seed=42):
+    rng = random.Random(seed)
+    resources = []
+    for i in range(RESOURCES):
+        size = rng.randint(2 * 1024, 16 * 1024)
+        resources.append((
+            'http://api.example.com/items/%d' % i, size,
+            rng.random() < LOCALISED, rng.random() < ALIASED))
+
+    trace = []
+    for _ in range(REQUESTS):
+        url, size, localised, aliased = resources[
+            min(int(rng.paretovariate(1.2)) - 1, RESOURCES - 1)
+            if rng.random() < 0.8 else rng.randrange(RESOURCES)]
+        if aliased and rng.random() < 0.5:
+            url += '?utm_source=feed'
+        trace.append((url, size, localised, rng.choice(LANGUAGES)))
+    return trace
+
+
+def make_response(url, size, localised, language):
+    body_url = url.split('?')[0]
+    seed = body_url + (language if localised else '')
+    body = (seed.encode('utf-8') * (size // len(seed) + 1))[:size]
+
+    response = Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict({
+        'Cache-Control': 'max-age=3600',
+        'Content-Type': 'application/json',
+        'Vary': 'Accept-Language'})
+    response._content = body
+    response.request = Request(
+        'GET', url, headers={'Accept-Language': language}).prepare()
+    return response
+
+
+def replay(cache, trace):
+    stores = 0
+    elapsed = 0.0
+    for url, size, localised, language in trace:
+        request = Request(
+            'GET', url, headers={'Accept-Language': language}).prepare()
+        if cache.retrieve(request) is not None:
+            continue
+
+        response = make_response(url, size, localised, language)
+        start = time.time()
+        cache.store(response, response.request)
+        elapsed += time.time() - start
+        stores += 1
+    return stores, elapsed
+
+
+def main():
+    trace = make_trace()
+
+    shared = HTTPCache(capacity=RESOURCES * 4)
+    stores, with_sharing = replay(shared, trace)
+
+    unshared = HTTPCache(capacity=RESOURCES * 4)
+    unshared._bodies = None
+    stores, without_sharing = replay(unshared, trace)
+
+    report = shared.body_report()
+    print('%d requests, %d entries stored' % (len(trace), stores))
+    print('  bodies held:   %6.1f MB (%d distinct)' % (
+        report['unique_bytes'] / 1e6, report['bodies']))
+    print('  without dedupe: %5.1f MB' % (report['referenced_bytes'] / 1e6))
+    print('  saved:          %5.1f MB (%.0f%%)' % (
+        report['saved_bytes'] / 1e6,
+        100.0 * report['saved_bytes'] / report['referenced_bytes']))
+    print('  store: %.0f ns/op shared, %.0f ns/op unshared' % (
+        with_sharing / stores * 1e9, without_sharing / stores * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+bench_import.py
+~~~~~~~~~~~~~~~
+
+Measures how long a fresh interpreter takes to import httpcache, with and
+without the Requests-based adapter, as a short-lived job that only wants the
+cache would see it.
+
+Each case is timed in its own interpreter, so that nothing is already
+imported. The time for an interpreter that imports nothing is subtracted.
+
+Run it with ``python benchmarks/bench_import.py``.
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+RUNS = 20
+
+CASES = (
+    ('interpreter only', 'pass'),
+    ('import httpcache', 'import httpcache; httpcache.HTTPCache()'),
+    ('... and the adapter',
+     'import httpcache; httpcache.CachingHTTPAdapter()'),
+    ('import requests', 'import requests'),
+)
+
+
+def time_import(code):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='')
+    times = []
+    for _ in range(RUNS):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], env=env)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    # Make sure every module has been compiled before anything's timed.
+    time_import(CASES[2][1])
+
+    baseline = None
+    for name, code in CASES:
+        median = time_import(code)
+        if baseline is None:
+            baseline = median
+            print('%-22s %6.1f ms' % (name, median * 1e3))
+        else:
+            print('%-22s %6.1f ms (+%.1f ms)' % (
+                name, median * 1e3, (median - baseline) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+bench_policy.py
+~~~~~~~~~~~~~~~
+
+Measures the cost of finding the caching policy for a URL in a large rule
+table.
+
+Run it with ``python benchmarks/bench_policy.py``.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from httpcache import CachePolicy, Rule  # NOQA
+
+
+def main():
+    rules = [Rule('*', ttl=10)]
+    for host in range(100):
+        rules.append(Rule('*.upstream%d.com' % host, cache=False))
+        for path in range(10):
+            rules.append(Rule(
+                'api.upstream%d.com' % host, path='/v%d/items' % path, ttl=60))
+    policy = CachePolicy(rules)
+
+    urls = [
+        'http://api.upstream42.com/v7/items/123?page=2',
+        'http://static.upstream42.com/logo.png',
+        'http://unknown.example.com/',
+    ]
+    number = 100000
+
+    print('%d rules' % len(rules))
+    for url in urls:
+        seconds = timeit.timeit(lambda: policy.match(url), number=number)
+        print('  %-48s %6.0f ns/lookup -> %r' % (
+            url, seconds / number * 1e9, policy.match(url)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+bench_serializer.py
+~~~~~~~~~~~~~~~~~~~
+
+Compares the binary entry format used for out-of-process backends with
+pickle: the time to encode and decode an entry, and its size on the wire.
+
+Run it with ``python benchmarks/bench_serializer.py``.
+"""
+import os
+import pickle
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from requests import Request  # NOQA
+from requests.models import Response  # NOQA
+from requests.structures import CaseInsensitiveDict  # NOQA
+
+from httpcache import serializer  # NOQA
+from httpcache.models import freeze_response  # NOQA
+
+URL = 'http://api.example.com/items/42'
+
+
+def make_entry(size):
+    response = Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.url = URL
+    response.encoding = 'utf-8'
+    response.headers = CaseInsensitiveDict({
+        'Date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+        'Cache-Control': 'max-age=3600',
+        'Content-Type': 'application/json; charset=utf-8',
+        'ETag': '"abc"',
+        'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT',
+        'Vary': 'Accept-Language',
+        'Server': 'nginx',
+        'Content-Length': str(size)})
+    response._content = b'x' * size
+    response.request = Request(
+        'GET', URL, headers={'Accept-Language': 'en'}).prepare()
+
+    return {
+        'response': freeze_response(response),
+        'creation': 784111777,
+        'expiry': 784115377}
+
+
+def main():
+    number = 20000
+
+    for size in (1024, 64 * 1024):
+        entry = make_entry(size)
+        formats = [
+            ('pickle', lambda: pickle.dumps(entry, pickle.HIGHEST_PROTOCOL),
+             pickle.loads),
+            ('binary', lambda: serializer.dumps(entry), serializer.loads),
+        ]
+
+        print('%d byte body' % size)
+        for name, dumps, loads in formats:
+            data = dumps()
+            encode = min(timeit.repeat(dumps, number=number, repeat=5))
+            decode = min(timeit.repeat(
+                lambda: loads(data), number=number, repeat=5))
+            print('  %-6s encode %7.0f ns/op  decode %7.0f ns/op  %6d bytes'
+                  % (name, encode / number * 1e9, decode / number * 1e9,
+                     len(data)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+bench_shared_memory.py
+~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the aggregate hit throughput of the shared memory backend across
+several processes, as in a prefork server, against each process holding its
+own in-process cache, and the memory each approach takes.
+
+Expect the in-process caches to serve hits several times faster: a hit on the
+shared segment copies the body out and checks a seqlock. What the shared
+segment buys is memory, since every process shares one copy of each body, and
+a single fill for all of them.
+
+Run it with ``python benchmarks/bench_shared_memory.py [processes]``.
+"""
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from httpcache.backends import (  # NOQA
+    RecentOrderedDict, SharedMemoryCache)
+
+ENTRIES = 500
+BODY = b'x' * 8192
+DURATION = 2.0
+
+
+def fill(cache):
+    for i in range(ENTRIES):
+        cache.set('key-%d' % i, BODY)
+
+
+def read(name, results):
+    if name is None:
+        cache = RecentOrderedDict()
+        fill(cache)
+    else:
+        cache = SharedMemoryCache(name)
+
+    hits = 0
+    deadline = time.time() + DURATION
+    while time.time() < deadline:
+        for i in range(100):
+            if cache.get('key-%d' % ((hits + i) % ENTRIES)) is not None:
+                hits += 1
+
+    results.put(hits)
+
+
+def run(processes, name):
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=read, args=(name, results))
+        for _ in range(processes)]
+
+    for worker in workers:
+        worker.start()
+    hits = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+
+    return hits / DURATION
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+    shared = SharedMemoryCache(
+        'httpcache-bench-' + uuid.uuid4().hex[:8], slots=2048,
+        slot_size=16 * 1024)
+    try:
+        fill(shared)
+        shared_rate = run(processes, shared.name)
+    finally:
+        shared.close()
+        shared.unlink()
+
+    local_rate = run(processes, None)
+
+    print('%d processes, %d entries of %d bytes' % (
+        processes, ENTRIES, len(BODY)))
+    print('  shared memory:  %10.0f hits/s, %6.1f MB of bodies in total' % (
+        shared_rate, ENTRIES * len(BODY) / 1e6))
+    print('  per-process:    %10.0f hits/s, %6.1f MB of bodies in total' % (
+        local_rate, processes * ENTRIES * len(BODY) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,36 @@ __init__.py
 ~~~~~~~~~~~
 
 Defines the public API to the httpcache module.
+
+The cache itself doesn't need Requests, so importing httpcache doesn't import
+it: :class:`CachingHTTPAdapter` (and with it Requests and urllib3) is only
+imported when it's first used.
 """
-from .adapter import CachingHTTPAdapter
+import sys
+
 from .cache import HTTPCache
+from .policy import CachePolicy, Rule
 
 
 __version__ = '0.1.7'
 
 
-__all__ = [HTTPCache, CachingHTTPAdapter]
+__all__ = ['HTTPCache', 'CachingHTTPAdapter', 'CachePolicy', 'Rule']
+
+
+def __getattr__(name):
+    if name == 'CachingHTTPAdapter':
+        from .adapter import CachingHTTPAdapter
+        globals()['CachingHTTPAdapter'] = CachingHTTPAdapter
+        return CachingHTTPAdapter
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# Modules can only have a __getattr__ from Python 3.7.
+if sys.version_info < (3, 7):
+    from .adapter import CachingHTTPAdapter  # NOQA
@@ -5,8 +5,24 @@ adapter.py
 Contains an implementation of an HTTP adapter for Requests that is aware of the
 cache contained in this module.
 """
+import functools
+from multiprocessing.pool import ThreadPool
+
+from requests import Request
 from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool, HTTPSConnectionPool)
+
 from .cache import HTTPCache
+from .compat import perf_counter
+from .policy import CachePolicy
+from .prefetch import Prefetcher
+from .stats import AdapterStats
+from .utils import clock
+
+# The request headers that make a request a revalidation.
+CONDITIONAL_HEADERS = ('If-Modified-Since', 'If-None-Match')
 
 
 class CachingHTTPAdapter(HTTPAdapter):
@@ -15,12 +31,78 @@ class CachingHTTPAdapter(HTTPAdapter):
     portion of the API.
 
     :param capacity: The maximum capacity of the backing cache.
+    :param negative_ttls: (Optional) Status codes of negative responses to
+        cache briefly, mapped to their base TTL in seconds. See
+        :class:`HTTPCache <httpcache.HTTPCache>`.
+    :param policy: (Optional) A :class:`CachePolicy <httpcache.CachePolicy>`,
+        or a list of :class:`Rule <httpcache.Rule>` objects, overriding the
+        caching rules for particular hosts and paths.
+    :param revalidation_pool_connections: (Optional) The number of hosts to
+        keep connections open to for revalidations.
+    :param revalidation_pool_maxsize: (Optional) The number of connections to
+        keep open to each host for revalidations.
+    :param write_behind: (Optional) Write responses to the cache from a
+        background thread, so a miss doesn't wait for a slow backend.
+    :param lease_ttl: (Optional) With a shared backing cache that supports
+        ``add`` (e.g. memcached), take a lease before fetching a missing
+        response, so that when many processes miss the same key only one
+        fetches it. See :class:`HTTPCache <httpcache.HTTPCache>`.
+    :param stale_grace: (Optional) How many seconds past its expiry a backend
+        that expires entries itself keeps an entry. With ``lease_ttl``,
+        processes waiting for another to fetch a response are served the
+        stale copy in the meantime.
+    :param bus: (Optional) An :class:`InvalidationBus
+        <httpcache.bus.InvalidationBus>` to share invalidations with the
+        caches in other processes over.
+    :param prefetch: (Optional) After storing a response, fetch the resources
+        its ``Link`` header points to (``rel=next``, ``preload`` and
+        ``prefetch``) in the background. To tune prefetching, set the
+        ``prefetcher`` attribute to a :class:`Prefetcher
+        <httpcache.prefetch.Prefetcher>` instead.
+
+    Cache hits never touch the connection pools. Revalidations (requests
+    carrying ``If-Modified-Since`` or ``If-None-Match``) go through a
+    separate, small set of pools: their responses are usually bodiless 304s,
+    so a couple of kept-alive connections per host serve them quickly without
+    queueing behind large downloads. Because most traffic to a warm cache is
+    served locally, ``pool_connections`` and ``pool_maxsize`` can usually be
+    set lower than they would be without the cache.
     """
-    def __init__(self, capacity=50, cache=None, **kwargs):
+    def __init__(self, capacity=50, cache=None, negative_ttls=None,
+                 policy=None, revalidation_pool_connections=4,
+                 revalidation_pool_maxsize=2, write_behind=False,
+                 lease_ttl=None, stale_grace=0, bus=None, prefetch=False,
+                 **kwargs):
+        #: Counters of hits, misses and connection pool waits.
+        self.stats = AdapterStats()
+
         super(CachingHTTPAdapter, self).__init__(**kwargs)
 
+        if policy is not None and not isinstance(policy, CachePolicy):
+            policy = CachePolicy(policy)
+
         #: The HTTP Cache backing the adapter.
-        self.cache = HTTPCache(capacity=capacity, cache=cache)
+        self.cache = HTTPCache(
+            capacity=capacity, cache=cache, negative_ttls=negative_ttls,
+            policy=policy, write_behind=write_behind, lease_ttl=lease_ttl,
+            stale_grace=stale_grace, bus=bus)
+
+        #: The :class:`Prefetcher <httpcache.prefetch.Prefetcher>` that
+        #: fetches linked resources, if prefetching is turned on.
+        self.prefetcher = Prefetcher(self) if prefetch else None
+
+        self._revalidation_adapter = HTTPAdapter(
+            pool_connections=revalidation_pool_connections,
+            pool_maxsize=revalidation_pool_maxsize,
+            max_retries=self.max_retries)
+        _time_pools(self._revalidation_adapter.poolmanager, self.stats)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CachingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+        stats = getattr(self, 'stats', None)
+        if stats is not None:
+            _time_pools(self.poolmanager, stats)
 
     def send(self, request, **kwargs):
         """
@@ -31,29 +113,152 @@ class CachingHTTPAdapter(HTTPAdapter):
             The Requests :class:`PreparedRequest <PreparedRequest>` object to
             send.
         """
+        start = perf_counter()
         cached_resp = self.cache.retrieve(request)
 
         if cached_resp is not None:
+            self.stats.record_hit(perf_counter() - start)
             return cached_resp
-        else:
-            return super(CachingHTTPAdapter, self).send(request, **kwargs)
 
-    def build_response(self, request, response):
+        revalidation = any(h in request.headers for h in CONDITIONAL_HEADERS)
+
+        # If another process is already fetching this, wait for it to store
+        # its response rather than fetching it again. A revalidation can't
+        # store a fresh entry for anyone else, so it isn't worth a lease.
+        lease = None
+        if not revalidation and self.cache.wants_lease(request):
+            lease = self.cache.acquire_lease(request)
+            if lease is None:
+                cached_resp = self.cache.wait_for_fill(request)
+                if cached_resp is not None:
+                    self.stats.record_hit(perf_counter() - start)
+                    return cached_resp
+                revalidation = any(
+                    h in request.headers for h in CONDITIONAL_HEADERS)
+
+        try:
+            request_time = clock()
+
+            if revalidation:
+                resp = self._revalidation_adapter.send(request, **kwargs)
+                resp.connection = self
+            else:
+                resp = super(CachingHTTPAdapter, self).send(request, **kwargs)
+
+            resp = self.cache_response(request, resp, request_time)
+        finally:
+            if lease is not None:
+                self.cache.release_lease(request, lease)
+
+        self.stats.record_miss(perf_counter() - start, revalidation)
+
+        return resp
+
+    def cache_response(self, request, response, request_time=None):
         """
-        Builds a Response object from a urllib3 response. May involve returning
-        a cached Response.
+        Updates the cache with a response from the origin server. May involve
+        returning a cached Response, if the server says ours is still valid.
 
         :param request:
             The Requests :class:`PreparedRequest <PreparedRequest>`
             object sent.
-        :param response: The urllib3 response.
+        :param response: The Requests :class:`Response <Response>` received.
+        :param request_time: (Optional) When the request was sent.
         """
-        resp = super(CachingHTTPAdapter, self).build_response(
-            request, response)
-
-        if resp.status_code == 304:
-            resp = self.cache.handle_304(resp, request)
+        if response.status_code == 304:
+            cached_resp = self.cache.handle_304(response, request)
+            if cached_resp is not None:
+                return cached_resp
         else:
-            self.cache.store(resp, request=request)
+            stored = self.cache.store(
+                response, request=request, request_time=request_time)
+            if stored and self.prefetcher is not None:
+                self.prefetcher.submit(request, response)
 
-        return resp
+        return response
+
+    def close(self):
+        """
+        Disposes of any internal state, including the revalidation pools, and
+        finishes any writes to the cache.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        super(CachingHTTPAdapter, self).close()
+        self._revalidation_adapter.close()
+        self.cache.close()
+
+    def warm(self, urls, workers=8, headers=None, **kwargs):
+        """
+        Fetches a list of URLs in parallel through this adapter, filling the
+        cache ahead of demand. Useful straight after startup, either instead
+        of or as well as loading a snapshot. Failed requests are skipped.
+
+        Returns the number of URLs that were fetched successfully.
+
+        :param urls: An iterable of URLs to GET.
+        :param workers: (Optional) The number of requests to make at once.
+        :param headers: (Optional) Headers to send with every request, e.g.
+            ``Accept-Language``.
+        :param kwargs: (Optional) Extra arguments passed to :meth:`send`, such
+            as ``timeout``.
+        """
+        def fetch(url):
+            request = Request('GET', url, headers=headers).prepare()
+            try:
+                response = self.send(request, **kwargs)
+                response.content
+            except RequestException:
+                return False
+            return True
+
+        pool = ThreadPool(workers)
+        try:
+            return sum(pool.map(fetch, urls))
+        finally:
+            pool.close()
+            pool.join()
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    """
+    An HTTP connection pool that records how long each connection checkout
+    takes in an :class:`AdapterStats <httpcache.stats.AdapterStats>`.
+    """
+    def __init__(self, host, port=None, stats=None, **kwargs):
+        super(TimedHTTPConnectionPool, self).__init__(host, port, **kwargs)
+        self.stats = stats
+
+    def _get_conn(self, timeout=None):
+        start = perf_counter()
+        try:
+            return super(TimedHTTPConnectionPool, self)._get_conn(timeout)
+        finally:
+            self.stats.record_pool_wait(perf_counter() - start)
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    """
+    An HTTPS connection pool that records how long each connection checkout
+    takes in an :class:`AdapterStats <httpcache.stats.AdapterStats>`.
+    """
+    def __init__(self, host, port=None, stats=None, **kwargs):
+        super(TimedHTTPSConnectionPool, self).__init__(host, port, **kwargs)
+        self.stats = stats
+
+    def _get_conn(self, timeout=None):
+        start = perf_counter()
+        try:
+            return super(TimedHTTPSConnectionPool, self)._get_conn(timeout)
+        finally:
+            self.stats.record_pool_wait(perf_counter() - start)
+
+
+def _time_pools(poolmanager, stats):
+    """
+    Makes a pool manager create connection pools that time their checkouts.
+    """
+    poolmanager.pool_classes_by_scheme = {
+        'http': functools.partial(TimedHTTPConnectionPool, stats=stats),
+        'https': functools.partial(TimedHTTPSConnectionPool, stats=stats),
+    }
@@ -1 +1,31 @@
-from .recent_ordered_dict import RecentOrderedDict  # NOQA
+"""
+__init__.py
+~~~~~~~~~~~
+
+Defines the backing caches. :class:`SharedMemoryCache` (and with it
+``multiprocessing``) is only imported when it's first used.
+"""
+import sys
+
+from .recent_ordered_dict import RecentOrderedDict
+
+
+__all__ = ['RecentOrderedDict', 'SharedMemoryCache']
+
+
+def __getattr__(name):
+    if name == 'SharedMemoryCache':
+        from .shared_memory import SharedMemoryCache
+        globals()['SharedMemoryCache'] = SharedMemoryCache
+        return SharedMemoryCache
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# Modules can only have a __getattr__ from Python 3.7.
+if sys.version_info < (3, 7):
+    from .shared_memory import SharedMemoryCache  # NOQA
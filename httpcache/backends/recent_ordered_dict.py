@@ -4,60 +4,67 @@ recent_ordered_dict.py
 
 Defines structures used by the httpcache module.
 """
+from collections import OrderedDict
 
 
 class RecentOrderedDict(dict):
     """
     A custom variant of the dictionary that ensures that the object most
     recently inserted _or_ retrieved from the dictionary is enumerated first.
+
+    Entries are kept in an ``OrderedDict``, so moving one to the most recent
+    position costs the same however many entries there are.
     """
+    #: Entries never leave the process, so the HTTP cache stores them as
+    #: they are rather than encoding them.
+    in_process = True
+
     def __init__(self):
-        self._data = {}
-        self._order = []
+        self._data = OrderedDict()
 
-    def __setitem__(self, key, value):
-        if key in self._data:
-            self._order.remove(key)
+    def _touch(self, key):
+        try:
+            self._data.move_to_end(key)
+        except AttributeError:  # Python 2
+            self._data[key] = self._data.pop(key)
 
-        self._order.append(key)
+    def __setitem__(self, key, value):
         self._data[key] = value
+        self._touch(key)
 
     def __getitem__(self, key):
         value = self._data[key]
-        self._order.remove(key)
-        self._order.append(key)
+        self._touch(key)
         return value
 
     def __delitem__(self, key):
         del self._data[key]
-        self._order.remove(key)
 
     def __iter__(self):
-        return self._order
+        return iter(self.keys())
 
     def __len__(self):
-        return len(self._order)
+        return len(self._data)
 
     def __contains__(self, value):
         return self._data.__contains__(value)
 
     def items(self):
-        return [(key, self._data[key]) for key in self._order]
+        return list(self._data.items())
 
     def keys(self):
-        return self._order
+        return list(self._data.keys())
 
     def values(self):
-        return [self._data[key] for key in self._order]
+        return list(self._data.values())
 
     def clear(self):
-        self._data = {}
-        self._order = []
+        self._data = OrderedDict()
 
     def copy(self):
         c = RecentOrderedDict()
         c._data = self._data.copy()
-        c._order = self._order[:]
+        return c
 
     def get(self, key, return_value=None):
         try:
@@ -75,4 +82,4 @@ class RecentOrderedDict(dict):
         self.__delitem__(key)
 
     def __repr__(self):
-        return repr(self._data)
+        return repr(dict(self._data))
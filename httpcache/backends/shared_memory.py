@@ -0,0 +1,427 @@
+"""
+shared_memory.py
+~~~~~~~~~~~~~~~~
+
+Defines a cache backend that lives in a shared memory segment, so that every
+process on a host (e.g. the workers of a prefork server) shares one copy of
+each cached entry.
+"""
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from ..utils import MAX_RELATIVE_TTL
+
+# This module is only imported when SharedMemoryCache is first used, so these
+# don't slow down importing httpcache.
+try:  # Python 3.8+
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# The segment starts with a header: a magic number, the number of slots, the
+# size of each slot and the number of slots in use.
+ARENA_HEADER = struct.Struct('<4sIIi')
+ARENA_MAGIC = b'HCS2'
+ARENA_HEADER_SIZE = 64
+
+# Each slot starts with a header: a sequence number (the seqlock), the slot
+# state, the key length, the value length, the time the value was stored, the
+# time it expires (zero if it doesn't) and the key itself.
+SLOT_HEADER = struct.Struct('<IBBxxIdd64s')
+MAX_KEY_LENGTH = 64
+
+EMPTY, USED, DELETED = 0, 1, 2
+
+# Writes take microseconds. A slot that has been mid-write for longer than
+# this was being written by a process that died, and is treated as deleted
+# until a writer reuses it.
+STALLED_WRITE = 0.1
+
+# Values are stored with a one byte prefix saying how they're encoded: raw
+# bytes, or text as UTF-8. Any process on the host can write to the segment,
+# so nothing read from it is ever unpickled. (b'\x01' was once used for
+# pickles; values tagged with it are read as misses.)
+RAW, TEXT = b'\x00', b'\x02'
+
+
+class SharedMemoryCache(object):
+    """
+    A fixed-size hash table of fixed-size slots held in a
+    ``multiprocessing.shared_memory`` segment. Any process that opens a
+    segment with the same name sees the same entries, with no serialisation
+    round trip through another server.
+
+    Reads take no locks: each slot carries a sequence number that writers
+    make odd while they're changing the slot, and readers retry if it was odd
+    or changed while they were reading. Writers are serialised by a thread
+    lock and, where available, an ``fcntl`` lock on a file next to the
+    segment, so that unrelated processes can share the segment safely.
+
+    Entries are enumerated oldest first, but reads don't refresh an entry's
+    age: when the table is full, an expired entry in the neighbourhood of a
+    new key is replaced, or failing that the oldest one. Because the table
+    makes room for itself, the ``capacity`` of an :class:`HTTPCache
+    <httpcache.HTTPCache>` using it doesn't apply: the number of slots is the
+    capacity, shared by every process.
+
+    :param name: The name of the shared memory segment. Processes that use
+        the same name share a cache.
+    :param slots: (Optional) The number of entries the segment can hold.
+    :param slot_size: (Optional) The size in bytes of each slot. Values that
+        don't fit aren't stored.
+    :param probes: (Optional) How many slots to search for a key.
+    :param lock_path: (Optional) The file to lock while writing. Defaults to
+        a file in the temporary directory named after the segment.
+
+    Only bytes and text can be stored. HTTPCache stores entries as bytes
+    (see :mod:`httpcache.serializer`), and leases as text.
+    """
+    #: The table evicts entries itself when it's full.
+    evicts = True
+
+    def __init__(self, name, slots=1024, slot_size=64 * 1024, probes=8,
+                 lock_path=None):
+        if shared_memory is None:
+            raise RuntimeError(
+                "SharedMemoryCache requires multiprocessing.shared_memory.")
+
+        self.name = name
+        self.probes = min(probes, slots)
+        size = ARENA_HEADER_SIZE + slots * slot_size
+
+        try:
+            self._shm = _open_segment(name, create=True, size=size)
+        except FileExistsError:
+            self._shm = _open_segment(name)
+            magic, slots, slot_size, _ = _read_arena_header(self._shm)
+            if magic != ARENA_MAGIC:
+                raise ValueError("%s is not an httpcache segment." % name)
+        else:
+            ARENA_HEADER.pack_into(
+                self._shm.buf, 0, ARENA_MAGIC, slots, slot_size, 0)
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self._buf = self._shm.buf
+        self._thread_lock = threading.Lock()
+
+        if lock_path is None:
+            lock_path = os.path.join(
+                tempfile.gettempdir(), 'httpcache-%s.lock' % name)
+        self._lock_file = open(lock_path, 'a') if fcntl else None
+
+    def _lock(self):
+        self._thread_lock.acquire()
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def _offset(self, index):
+        return ARENA_HEADER_SIZE + index * self.slot_size
+
+    def _probe(self, key):
+        start = zlib.crc32(key) % self.slots
+        for i in range(self.probes):
+            yield (start + i) % self.slots
+
+    def _read_header(self, index):
+        """
+        Reads a slot header, waiting for any write in progress to finish. If
+        the write never finishes, because the process making it was killed,
+        the slot is reported as deleted.
+        """
+        deadline = None
+        while True:
+            header = SLOT_HEADER.unpack_from(self._buf, self._offset(index))
+            if not header[0] & 1:
+                return header
+
+            now = time.time()
+            if deadline is None:
+                deadline = now + STALLED_WRITE
+            elif now > deadline:
+                return (header[0], DELETED) + header[2:]
+            time.sleep(0)
+
+    def _write(self, index, state, key=b'', data=b'', expires=0.0):
+        """
+        Rewrites a slot. Must be called holding the write lock.
+        """
+        offset = self._offset(index)
+        seq = SLOT_HEADER.unpack_from(self._buf, offset)[0]
+
+        # Holding the write lock, an odd sequence number can only have been
+        # left by a writer that died. Rewriting the slot recovers it.
+        seq += seq & 1
+
+        struct.pack_into('<I', self._buf, offset, (seq + 1) & 0xffffffff)
+        body = offset + SLOT_HEADER.size
+        self._buf[body:body + len(data)] = data
+        SLOT_HEADER.pack_into(
+            self._buf, offset, (seq + 1) & 0xffffffff, state, len(key),
+            len(data), time.time(), expires, key)
+        struct.pack_into('<I', self._buf, offset, (seq + 2) & 0xffffffff)
+
+    def _find(self, key):
+        """
+        Returns the index of the slot holding ``key``, or None.
+        """
+        for index in self._probe(key):
+            header = self._read_header(index)
+            if header[1] == EMPTY:
+                return None
+            if header[1] == USED and header[6][:header[2]] == key:
+                return index
+        return None
+
+    def _adjust_count(self, change):
+        offset = ARENA_HEADER.size - 4
+        count = struct.unpack_from('<i', self._buf, offset)[0]
+        struct.pack_into('<i', self._buf, offset, count + change)
+
+    def get(self, key, return_value=None):
+        key = _encode_key(key)
+        now = time.time()
+
+        for index in self._probe(key):
+            offset = self._offset(index)
+
+            while True:
+                header = self._read_header(index)
+                seq, state, key_length, length, _, expires = header[:6]
+                matched = state == USED and header[6][:key_length] == key
+                data = None
+                if matched and not 0 < expires <= now:
+                    body = offset + SLOT_HEADER.size
+                    data = bytes(self._buf[body:body + length])
+
+                # If a writer got in while we were reading, read again.
+                if SLOT_HEADER.unpack_from(self._buf, offset)[0] == seq:
+                    break
+
+            if state == EMPTY:
+                return return_value
+            if matched:
+                if data is None:
+                    return return_value
+                try:
+                    return _decode_value(data)
+                except ValueError:
+                    return return_value
+
+        return return_value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value. Returns False if the value is too large for a slot.
+
+        :param ttl: (Optional) The number of seconds to keep the value for.
+            As with memcached, a TTL of more than 30 days is read as the Unix
+            time to keep it until.
+        """
+        return self._store(key, value, ttl, replace=True)
+
+    def add(self, key, value, ttl=None):
+        """
+        Stores a value only if the key isn't already held. Returns True if the
+        value was stored. Used to take leases, so that only one process fills
+        a missing key.
+        """
+        return self._store(key, value, ttl, replace=False)
+
+    def _store(self, key, value, ttl, replace):
+        key = _encode_key(key)
+        data = _encode_value(value)
+        if len(data) > self.slot_size - SLOT_HEADER.size:
+            return False
+
+        now = time.time()
+        expires = 0.0
+        if ttl:
+            expires = ttl if ttl > MAX_RELATIVE_TTL else now + ttl
+
+        self._lock()
+        try:
+            target = self._find(key)
+            if target is None:
+                target = self._free_slot(key)
+            elif not replace and not 0 < self._read_header(target)[5] <= now:
+                return False
+
+            self._write(target, USED, key, data, expires)
+        finally:
+            self._unlock()
+
+        return True
+
+    def _free_slot(self, key):
+        """
+        Returns the index of a slot to store a new key in, evicting an
+        expired entry or the oldest entry near the key if there's no free
+        slot. Must be called holding the write lock.
+        """
+        target, oldest = None, None
+        now = time.time()
+        for index in self._probe(key):
+            header = self._read_header(index)
+            if header[1] != USED:
+                # A slot left mid-write is still counted as in use.
+                if not header[0] & 1:
+                    self._adjust_count(1)
+                return index
+            if 0 < header[5] <= now:
+                return index
+            if oldest is None or header[4] < oldest:
+                target, oldest = index, header[4]
+        return target
+
+    def delete(self, key):
+        """
+        Keep consistency with memcached approach
+        """
+        key = _encode_key(key)
+
+        self._lock()
+        try:
+            index = self._find(key)
+            if index is not None:
+                self._write(index, DELETED)
+                self._adjust_count(-1)
+        finally:
+            self._unlock()
+
+    def _used(self):
+        """
+        Returns (stored time, key, index) for every used slot, oldest first.
+        Expired entries are included until their slots are reused, so that
+        the keys agree with the length.
+        """
+        used = []
+        for index in range(self.slots):
+            header = self._read_header(index)
+            if header[1] == USED:
+                key = header[6][:header[2]].decode('utf-8')
+                used.append((header[4], key, index))
+        used.sort()
+        return used
+
+    def keys(self):
+        return [key for _, key, _ in self._used()]
+
+    def items(self):
+        items = []
+        for key in self.keys():
+            value = self.get(key)
+            if value is not None:
+                items.append((key, value))
+        return items
+
+    def __len__(self):
+        return struct.unpack_from('<i', self._buf, ARENA_HEADER.size - 4)[0]
+
+    def __contains__(self, key):
+        return self._find(_encode_key(key)) is not None
+
+    def clear(self):
+        self._lock()
+        try:
+            for index in range(self.slots):
+                if self._read_header(index)[1] != EMPTY:
+                    self._write(index, EMPTY)
+            self._adjust_count(-len(self))
+        finally:
+            self._unlock()
+
+    def close(self):
+        """
+        Detaches this process from the segment. Other processes are
+        unaffected.
+        """
+        self._buf = None
+        self._shm.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    def unlink(self):
+        """
+        Destroys the segment. Call this once, when no process needs the cache
+        any more.
+        """
+        if not hasattr(self._shm, '_track'):
+            # Python < 3.13 always tells the resource tracker it's gone.
+            _register(self._shm)
+        self._shm.unlink()
+
+
+def _open_segment(name, create=False, size=0):
+    """
+    Opens a segment without leaving it registered with the resource tracker,
+    which would otherwise destroy it when the first process using it exits.
+    The segment lives until :meth:`SharedMemoryCache.unlink` is called.
+    """
+    try:
+        return shared_memory.SharedMemory(
+            name=name, create=create, size=size, track=False)
+    except TypeError:  # Python < 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _register(shm):
+    from multiprocessing import resource_tracker
+    resource_tracker.register(shm._name, 'shared_memory')
+
+
+def _read_arena_header(shm, timeout=1.0):
+    """
+    Reads the header of a segment, giving the process that created it a
+    moment to write it if it hasn't yet.
+    """
+    deadline = time.time() + timeout
+    while True:
+        header = ARENA_HEADER.unpack_from(shm.buf, 0)
+        if header[0] != b'\x00' * 4 or time.time() > deadline:
+            return header
+        time.sleep(0.01)
+
+
+def _encode_key(key):
+    key = key.encode('utf-8')
+    if len(key) > MAX_KEY_LENGTH:
+        key = hashlib.sha224(key).hexdigest().encode('utf-8')
+    return key
+
+
+def _encode_value(value):
+    if isinstance(value, bytes):
+        return RAW + value
+    if isinstance(value, str):
+        return TEXT + value.encode('utf-8')
+    raise TypeError(
+        "SharedMemoryCache can only store bytes and text, not %s." %
+        type(value).__name__)
+
+
+def _decode_value(data):
+    tag = data[:1]
+    if tag == RAW:
+        return data[1:]
+    if tag == TEXT:
+        return data[1:].decode('utf-8')
+    raise ValueError("Unknown value encoding %r." % tag)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+bodies.py
+~~~~~~~~~
+
+Defines the store that lets cache entries with identical bodies share one
+copy of them, e.g. the language variants of a resource that doesn't actually
+vary, or the same resource fetched through two URLs.
+"""
+
+
+class BodyStore(object):
+    """
+    A reference-counted set of response bodies, keyed by their content. Bodies
+    are looked up by hash and confirmed by comparing bytes, so two different
+    bodies can never be confused however their hashes collide.
+
+    Only entries held in this process share bodies: an out-of-process backend
+    holds each entry's bytes itself.
+    """
+    def __init__(self):
+        self._bodies = {}
+
+        #: The total size of the distinct bodies held.
+        self.unique_bytes = 0
+
+        #: The total size of the bodies held, counting each reference.
+        self.referenced_bytes = 0
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def add(self, body):
+        """
+        Takes a reference to ``body``, and returns the copy of it that should
+        be kept. That's ``body`` itself, unless an identical body is already
+        held.
+        """
+        record = self._bodies.get(body)
+        if record is None:
+            record = self._bodies[body] = [body, 0]
+            self.unique_bytes += len(body)
+
+        record[1] += 1
+        self.referenced_bytes += len(body)
+        return record[0]
+
+    def release(self, body):
+        """
+        Drops a reference to ``body`` taken by :meth:`add`. The body is
+        forgotten once nothing refers to it.
+        """
+        record = self._bodies.get(body)
+        if record is None:
+            return
+
+        record[1] -= 1
+        self.referenced_bytes -= len(body)
+        if not record[1]:
+            del self._bodies[body]
+            self.unique_bytes -= len(body)
+
+    def report(self):
+        """
+        Returns a dictionary describing how much memory sharing bodies saves.
+        """
+        return {
+            'bodies': len(self._bodies),
+            'references': sum(record[1] for record in self._bodies.values()),
+            'unique_bytes': self.unique_bytes,
+            'referenced_bytes': self.referenced_bytes,
+            'saved_bytes': self.referenced_bytes - self.unique_bytes,
+        }
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+bus.py
+~~~~~~
+
+Defines the invalidation buses, which carry invalidations between the caches
+in different processes and on different hosts, so that a cache held in one
+process's memory doesn't keep serving an entry another process has
+invalidated.
+"""
+import errno
+import glob
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from .writeback import _wait_for
+
+log = logging.getLogger(__name__)
+
+# The first bytes of every message. Bump the version if the format changes.
+MAGIC = b'HCI1'
+
+# The kinds of invalidation a message carries, by the field they're sent in:
+# cache keys, URLs (every variant), URL prefixes and cache tags.
+FIELDS = (('k', 'keys'), ('u', 'urls'), ('p', 'prefixes'), ('t', 'tags'))
+
+# The most a received message may decompress to. Any host on the multicast
+# group (or any local user, for a socket directory) can send us a message, and
+# a small one can expand enormously.
+MAX_DECOMPRESSED = 1024 * 1024
+
+# The default multicast group and port.
+MULTICAST_GROUP = '239.255.42.99'
+MULTICAST_PORT = 4242
+
+
+class InvalidationBus(object):
+    """
+    The base class of the invalidation buses. A bus collects the invalidations
+    published in this process for ``delay`` seconds, then sends them to every
+    other process on the bus as a few compressed messages. Invalidations
+    received from other processes are passed to the subscribed callbacks.
+
+    Every bus has a random ``origin`` id that's sent with its messages, so
+    that it ignores its own messages if the transport loops them back.
+
+    Subclasses implement :meth:`_send`, and pass what they receive to
+    :meth:`_receive`.
+
+    :param delay: (Optional) How long in seconds to collect invalidations
+        before sending them.
+    :param max_batch: (Optional) The most invalidations sent in one message.
+    :param max_message: (Optional) The largest message to send, in bytes.
+        Batches that compress to more than this are split.
+    """
+    def __init__(self, delay=0.01, max_batch=512, max_message=8192):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.max_message = max_message
+
+        #: The id this bus's messages are sent with.
+        self.origin = uuid.uuid4().hex
+
+        #: The number of messages sent and received, and the number that
+        #: failed to send or couldn't be decoded.
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+        self._callbacks = []
+        self._pending = dict((name, set()) for _, name in FIELDS)
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closed = False
+
+    def subscribe(self, callback):
+        """
+        Calls ``callback`` with every invalidation received from another
+        process, as keyword arguments ``keys``, ``urls``, ``prefixes`` and
+        ``tags``, each a list.
+        """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Stops calling a callback passed to :meth:`subscribe`.
+        """
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def publish(self, keys=(), urls=(), prefixes=(), tags=()):
+        """
+        Queues invalidations to send to the other processes on the bus.
+        """
+        with self._condition:
+            if self._closed:
+                return
+
+            for name, values in (('keys', keys), ('urls', urls),
+                                 ('prefixes', prefixes), ('tags', tags)):
+                self._pending[name].update(values)
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='httpcache-bus')
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Sends every queued invalidation now.
+        """
+        with self._condition:
+            pending = self._pending
+            self._pending = dict((name, set()) for _, name in FIELDS)
+
+        items = []
+        for field, name in FIELDS:
+            items.extend((field, value) for value in sorted(pending[name]))
+
+        for start in range(0, len(items), self.max_batch):
+            for message in self._encode(items[start:start + self.max_batch]):
+                try:
+                    self._send(message)
+                    self.sent += 1
+                except Exception:
+                    self.errors += 1
+                    log.exception("Failed to send invalidations.")
+
+    def close(self):
+        """
+        Sends any queued invalidations and stops the bus.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                _wait_for(
+                    self._condition,
+                    lambda: self._closed or any(self._pending.values()),
+                    None)
+                if self._closed:
+                    return
+
+            # Give the invalidations that come with this one a moment to
+            # arrive, so they go in the same message.
+            time.sleep(self.delay)
+            self.flush()
+
+    def _encode(self, items):
+        """
+        Encodes invalidations as compressed messages, splitting them until
+        each message fits in ``max_message`` bytes.
+        """
+        body = {'o': self.origin}
+        for field, value in items:
+            body.setdefault(field, []).append(value)
+
+        message = MAGIC + zlib.compress(
+            json.dumps(body, separators=(',', ':')).encode('utf-8'))
+        if len(message) <= self.max_message or len(items) == 1:
+            return [message]
+
+        middle = len(items) // 2
+        return self._encode(items[:middle]) + self._encode(items[middle:])
+
+    def _receive(self, message):
+        """
+        Decodes a message from the transport and passes the invalidations in
+        it to the subscribers, unless it came from this bus.
+        """
+        try:
+            if not message.startswith(MAGIC):
+                raise ValueError("Not an invalidation message.")
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(
+                message[len(MAGIC):], MAX_DECOMPRESSED)
+            if decompressor.unconsumed_tail:
+                raise ValueError("Invalidation message is too large.")
+            body = json.loads(data.decode('utf-8'))
+        except (ValueError, TypeError, zlib.error):
+            self.errors += 1
+            log.debug("Ignoring an undecodable invalidation message.")
+            return
+
+        if body.get('o') == self.origin:
+            return
+
+        self.received += 1
+        invalidations = dict(
+            (name, body.get(field) or []) for field, name in FIELDS)
+        for callback in list(self._callbacks):
+            try:
+                callback(**invalidations)
+            except Exception:
+                log.exception("Failed to apply invalidations.")
+
+    def _send(self, message):
+        raise NotImplementedError
+
+
+class LocalBus(InvalidationBus):
+    """
+    A bus between caches in one process, for tests and for running several
+    caches side by side. Messages are encoded and decoded just as they are on
+    the other buses.
+
+    :param network: (Optional) Another :class:`LocalBus`, to join the
+        network it's on. Each bus stands in for one process.
+    """
+    def __init__(self, network=None, **kwargs):
+        super(LocalBus, self).__init__(**kwargs)
+        self._network = [] if network is None else network._network
+        self._network.append(self)
+
+    def close(self):
+        super(LocalBus, self).close()
+        if self in self._network:
+            self._network.remove(self)
+
+    def _send(self, message):
+        for bus in list(self._network):
+            if bus is not self:
+                bus._receive(message)
+
+
+class SocketBus(InvalidationBus):
+    """
+    The base class of the buses that send datagrams over a socket, with a
+    thread that receives them. Subclasses call :meth:`_listen_on` once their
+    socket is bound.
+    """
+    def _listen_on(self, sock):
+        self._socket = sock
+        self._socket.settimeout(0.2)
+
+        self._receiver = threading.Thread(
+            target=self._listen, name='httpcache-bus-receiver')
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    def close(self):
+        super(SocketBus, self).close()
+        self._receiver.join()
+        self._socket.close()
+
+    def _listen(self):
+        while not self._closed:
+            try:
+                message = self._socket.recv(65536)
+            except socket.timeout:
+                continue
+            except socket.error:
+                if not self._closed:
+                    log.exception("Stopped receiving invalidations.")
+                return
+            self._receive(message)
+
+
+class UnixSocketBus(SocketBus):
+    """
+    A bus between the processes on one host, over Unix datagram sockets. Each
+    bus binds a socket in ``directory`` and sends its messages to every other
+    socket there. Sockets left behind by processes that have gone away are
+    removed when sending to them fails.
+
+    :param directory: The directory the processes on the bus share.
+    """
+    def __init__(self, directory, **kwargs):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        super(UnixSocketBus, self).__init__(**kwargs)
+
+        self.path = os.path.join(directory, self.origin + '.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        self._listen_on(sock)
+
+    def close(self):
+        super(UnixSocketBus, self).close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _send(self, message):
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == self.path:
+                continue
+            try:
+                self._socket.sendto(message, path)
+            except socket.error as e:
+                if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                    raise
+                # Its process has gone away.
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+class MulticastBus(SocketBus):
+    """
+    A bus between the processes on a network, over UDP multicast. Every
+    process on the bus joins the same group and port; processes on one host
+    see each other's messages through multicast loopback.
+
+    Multicast is unreliable, so an invalidation can occasionally be lost.
+    Keep entries' lifetimes short enough that that's tolerable.
+
+    :param group: (Optional) The multicast group to join.
+    :param port: (Optional) The UDP port to use.
+    :param ttl: (Optional) How many routers messages may cross. The default of
+        1 keeps them on the local network.
+    :param interface: (Optional) The address of the interface to join the
+        group on.
+    """
+    def __init__(self, group=MULTICAST_GROUP, port=MULTICAST_PORT, ttl=1,
+                 interface='0.0.0.0', **kwargs):
+        kwargs.setdefault('max_message', 1400)
+        super(MulticastBus, self).__init__(**kwargs)
+        self.group = group
+        self.port = port
+
+        sock = socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', port))
+        sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton(group) + socket.inet_aton(interface))
+        sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', ttl))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self._listen_on(sock)
+
+    def _send(self, message):
+        self._socket.sendto(message, (self.group, self.port))
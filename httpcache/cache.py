@@ -5,20 +5,36 @@ cache.py
 
 Contains the primary cache structure used in http-cache.
 """
-from datetime import datetime
 import hashlib
+import math
+import struct
+import threading
+import time
+import uuid
 
+from . import serializer
 from .backends import RecentOrderedDict
+from .bodies import BodyStore
+from .compat import monotonic
+from .hotkeys import KeyStats
+from .index import InvalidationIndex
+from .models import FrozenHeaders, freeze_response, thaw_response
+from .ranges import (
+    add_fragment, is_encoded, parse_content_range, parse_range_header,
+    read_range)
 from .utils import (
-    build_date_header, expires_from_cache_control, parse_date_header,
-    url_contains_query)
+    MAX_RELATIVE_TTL, NoLock, accepts_arguments, build_http_date, cache_tags,
+    clock, corrected_initial_age, etag_matches, invalidated_urls,
+    parse_cache_control, parse_delta_seconds, parse_http_date,
+    synchronized_entries, url_contains_query)
+from .writeback import WriteBehindQueue
 
 
 # RFC 2616 specifies that we can cache 200 OK, 203 Non Authoritative,
 # 206 Partial Content, 300 Multiple Choices, 301 Moved Permanently and
-# 410 Gone responses. We don't cache 206s at the moment because we
-# don't handle Range and Content-Range headers.
-CACHEABLE_RCS = (200, 203, 300, 301, 410)
+# 410 Gone responses. 206s are stored as byte-range fragments of the full
+# resource, and are only served for ranges they completely cover.
+CACHEABLE_RCS = (200, 203, 206, 300, 301, 410)
 
 # Cacheable verbs.
 CACHEABLE_VERBS = ('GET', 'HEAD', 'OPTIONS')
@@ -29,6 +45,30 @@ CACHEABLE_VERBS = ('GET', 'HEAD', 'OPTIONS')
 # verbs. That works out well for us.
 NON_INVALIDATING_VERBS = CACHEABLE_VERBS
 
+# The first line of every snapshot file. Bump the version if the format of
+# the records that follow it changes.
+SNAPSHOT_MAGIC = b'httpcache-snapshot 3\n'
+
+# Each snapshot record is the length of its key and its encoded entry, then
+# the key and the entry.
+SNAPSHOT_RECORD = struct.Struct('<HI')
+
+# The headers a 304 Not Modified response carries over from the cached
+# response, per RFC 7232 Section 4.1.
+NOT_MODIFIED_HEADERS = (
+    'Cache-Control', 'Content-Location', 'Date', 'ETag', 'Expires',
+    'Last-Modified', 'Vary')
+
+# A reasonable set of negative responses to cache when negative caching is
+# turned on, mapped to the base number of seconds to cache them for. These are
+# deliberately short: the aim is to stop a failing upstream being hammered,
+# not to remember failures.
+DEFAULT_NEGATIVE_TTLS = {404: 5, 500: 1, 502: 1, 503: 1, 504: 1}
+
+# Leases are kept in the backing cache next to the entries, under their
+# entry's key with this prefix.
+LEASE_PREFIX = 'lease:'
+
 
 class HTTPCache(object):
     """
@@ -41,91 +81,780 @@ class HTTPCache(object):
     may change in a minor version increase. Be warned.
 
     :param capacity: (Optional) The maximum capacity of the HTTP cache.
+    :param negative_ttls: (Optional) A dictionary mapping status codes of
+        negative responses (e.g. 404, 503) to the base number of seconds they
+        should be cached for. Repeated failures for the same resource double
+        that time, up to ``negative_max_ttl``. Negative caching is disabled if
+        this is not provided; ``DEFAULT_NEGATIVE_TTLS`` is a sensible choice.
+    :param negative_max_ttl: (Optional) The longest time, in seconds, that a
+        negative response will be cached for.
+    :param policy: (Optional) A :class:`CachePolicy <CachePolicy>` that
+        overrides the caching rules for particular hosts and paths.
+    :param write_behind: (Optional) Write entries to the backing cache from a
+        background thread, so that storing a response doesn't wait for a slow
+        backend. Entries waiting to be written are still served by
+        :meth:`retrieve`. Call :meth:`close` to write them before exiting.
+    :param max_pending_writes: (Optional) With ``write_behind``, the number
+        of entries that can wait to be written. Once that many are waiting,
+        new entries are dropped rather than stored.
+    :param max_bytes: (Optional) The most bytes of response bodies, and of
+        the fragments of partial responses, to hold in an in-process backing
+        cache. Entries sharing a body only count it once, so evicting one of
+        them frees nothing until the last goes.
+    :param stale_grace: (Optional) How many seconds past its expiry an entry
+        is kept by a backend that expires entries itself.
+    :param governor: (Optional) A :class:`MemoryGovernor
+        <httpcache.governor.MemoryGovernor>` that scales ``capacity`` and
+        ``max_bytes`` down while memory is short, evicting the coldest
+        entries first.
+    :param lease_ttl: (Optional) Turns on leases, with a backing cache that
+        has an atomic ``add`` method, e.g. memcached. When many processes miss
+        the same key at once, only the one holding the lease fetches it, and
+        the rest wait for it to be stored. A lease expires after this many
+        seconds, in case its holder dies.
+    :param lease_wait: (Optional) The longest time in seconds to wait for
+        another process to fill a key before fetching it anyway.
+    :param max_indexed: (Optional) With a backend outside this process, the
+        most entries to remember for invalidation. Such backends drop entries
+        without telling us, so entries are also forgotten once they've
+        expired.
+    :param hot_keys: (Optional) The number of keys to count lookups and
+        stores for, to find the busiest (see :meth:`top_keys`). Counting
+        costs the same however many keys there are. None turns it off.
+    :param bus: (Optional) An :class:`InvalidationBus
+        <httpcache.bus.InvalidationBus>` shared with the caches in other
+        processes. Invalidations made here, by unsafe requests or by the
+        ``invalidate`` methods, are published on it, and those published by
+        other processes are applied here, so that caches held in process
+        memory stay coherent.
+
+    Out-of-process backends whose ``set`` method takes a third argument are
+    passed a TTL in seconds with each entry, as memcached clients expect, so
+    that they can drop expired entries themselves. Entries without an expiry
+    get no TTL, and negative entries are kept for ``negative_max_ttl`` past
+    their expiry so that their failure counts survive for backoff.
+
+    Backends with a true ``evicts`` attribute, like :class:`SharedMemoryCache
+    <httpcache.backends.SharedMemoryCache>`, make room for new entries
+    themselves, and aren't trimmed to ``capacity``.
+
+    Entries are kept as Python objects in backends that live in this process
+    (those with a true ``in_process`` attribute). Every other backend is sent
+    entries encoded by :mod:`httpcache.serializer`, never pickles.
     """
-    def __init__(self, capacity=50, cache=None):
+    def __init__(self, capacity=50, cache=None, negative_ttls=None,
+                 negative_max_ttl=60, policy=None, write_behind=False,
+                 max_pending_writes=1000, max_bytes=None, stale_grace=0,
+                 governor=None, lease_ttl=None, lease_wait=2.0,
+                 max_indexed=100000, hot_keys=64, bus=None):
         #: The maximum capacity of the HTTP cache. When this many cache entries
         #: end up in the cache, the oldest entries are removed.
         self.capacity = capacity
 
+        #: The status codes that are cached as negative responses, mapped to
+        #: the base time in seconds they're cached for.
+        self.negative_ttls = negative_ttls or {}
+
+        #: The upper bound on the time a negative response is cached for.
+        self.negative_max_ttl = negative_max_ttl
+
+        #: The per-host and per-route caching policy, if any.
+        self.policy = policy
+
+        #: The most bytes of bodies to hold in an in-process backing cache.
+        self.max_bytes = max_bytes
+
+        #: How long past its expiry a backend should keep an entry.
+        self.stale_grace = stale_grace
+
+        #: The memory governor adjusting the capacity, if any.
+        self.governor = governor
+
+        #: How long leases last, how long to wait for another process's lease
+        #: and how often to look for its response while waiting.
+        self.lease_ttl = lease_ttl
+        self.lease_wait = lease_wait
+        self.lease_poll = 0.05
+
+        #: The busiest keys and the stores that went to waste, if counted.
+        self.key_stats = None
+        if hot_keys:
+            self.key_stats = KeyStats(hot_keys)
+
+        #: The bus invalidations are shared with other processes over, if any.
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._apply_invalidations)
+
+        self._lock = threading.RLock()
+
         if cache is None:
             cache = RecentOrderedDict()
         self._cache = cache
+        self._in_process = getattr(cache, 'in_process', False)
+
+        # Entries in process are only removed through us, so the index can't
+        # outgrow the cache. Entries elsewhere can vanish without a word.
+        self._index = InvalidationIndex(
+            None if self._in_process else max_indexed)
+        self._evicts = getattr(cache, 'evicts', False)
 
-    def store(self, response, request):
+        # Entries held in this process are only reached under the lock. The
+        # lock isn't held across calls to a backend elsewhere, so that one
+        # thread's round trip doesn't hold up the rest: only the bookkeeping
+        # kept here (the index, the key statistics) is locked then.
+        self._entry_lock = self._lock if self._in_process else NoLock()
+
+        # Entries held in this process share identical bodies.
+        self._bodies = BodyStore() if self._in_process else None
+
+        # Out-of-process backends that take a TTL expire entries themselves.
+        self._native_ttl = not self._in_process and accepts_arguments(
+            cache.set, 3)
+
+        self._writes = None
+        if write_behind:
+            self._writes = WriteBehindQueue(
+                cache, self._prepare, max_pending=max_pending_writes)
+
+    @synchronized_entries
+    def store(self, response, request, request_time=None):
         """
         Takes an HTTP response object and stores it in the cache according to
         RFC 2616. Returns a boolean value indicating whether the response was
         cached or not.
 
         :param response: Requests :class:`Response <Response>` object to cache.
+        :param request: The request that ``response`` answers.
+        :param request_time: (Optional) When the request was sent, as returned
+            by :func:`httpcache.utils.clock`. Used to account for the time the
+            request spent in flight when working out the response's age.
         """
-        # Define an internal utility function.
-        def date_header_or_default(header_name, default, response):
-            try:
-                date_header = response.headers[header_name]
-            except KeyError:
-                value = default
-            else:
-                value = parse_date_header(date_header)
-            return value
+        method = response.request.method
+        status_code = response.status_code
+        url = response.url
 
-        if response.status_code not in CACHEABLE_RCS:
+        if method not in NON_INVALIDATING_VERBS:
+            if status_code < 400:
+                targets = invalidated_urls(response)
+                for target in targets:
+                    with self._lock:
+                        keys = self._index.keys_for_url(target)
+                    self._invalidate_keys(keys)
+                self._publish(urls=targets)
             return False
 
-        if response.request.method not in CACHEABLE_VERBS:
-            return False
+        rule = None
+        if self.policy is not None:
+            rule = self.policy.match(url)
+            if rule is not None and not rule.cache:
+                return False
 
-        url = response.url
-        now = datetime.utcnow()
+        if status_code in self.negative_ttls:
+            return self._store_negative(response, request)
 
-        # Get the value of the 'Date' header, if it exists. If it doesn't, just
-        # use now.
-        creation = date_header_or_default('Date', now, response)
+        if self.negative_ttls:
+            self._clear_negative(request)
 
-        # Get the value of the 'Cache-Control' header, if it exists.
-        cc = response.headers.get('Cache-Control', None)
-        if cc is not None:
-            expiry = expires_from_cache_control(cc, now)
+        cacheable_rcs = CACHEABLE_RCS
+        if rule is not None and rule.status_codes is not None:
+            cacheable_rcs = rule.status_codes
 
-            # If the above returns None, we are explicitly instructed not to
-            # cache this.
-            if expiry is None:
-                return False
+        if status_code not in cacheable_rcs:
+            return False
 
-        # Get the value of the 'Expires' header, if it exists, and if we don't
-        # have anything from the 'Cache-Control' header.
-        if cc is None:
-            expiry = date_header_or_default('Expires', None, response)
+        if method not in CACHEABLE_VERBS:
+            return False
 
-        # If the expiry date is earlier or the same as the Date header, don't
-        # cache the response at all.
-        if expiry is not None and expiry <= creation:
+        # A response to a HEAD has no body, so it mustn't replace the entry
+        # for a GET, which HEADs are served from.
+        if method == 'HEAD':
             return False
 
-        # Get content lanugage header
-        al = request.headers.get('Accept-Language') or ''
+        # This is the only pass over the response headers: every lookup after
+        # this is a plain dictionary lookup on the frozen copy.
+        headers = FrozenHeaders(response.headers)
+        now = clock()
+        if request_time is None:
+            request_time = now
+
+        if rule is not None and rule.ttl is not None:
+            # Expiries are whole seconds, so round fractional TTLs up.
+            creation = now
+            expiry = now + int(math.ceil(rule.ttl))
+        else:
+            ignore_cc = rule is not None and rule.ignore_cache_control
+            freshness = self._freshness(
+                headers, request_time, now, ignore_cc)
+            if freshness is None:
+                return False
+            creation, expiry = freshness
 
         # If there's a query portion of the url and it's a GET, don't cache
         # this unless explicitly instructed to.
-        if expiry is None and response.request.method == 'GET':
-            if url_contains_query(url):
-                return False
+        if expiry is None and method == 'GET' and url_contains_query(url):
+            return False
 
-        key = self.make_key(url, al)
-        self._cache.set(key, {
-            'response': response,
+        key = self.make_key(url, request.headers.get('Accept-Language') or '')
+
+        if status_code == 206:
+            return self._store_fragment(key, response, creation, expiry)
+
+        stored = self._set(key, {
+            'response': freeze_response(response, headers=headers),
             'creation': creation,
             'expiry': expiry})
 
         self.__reduce_cache_count()
 
+        return stored
+
+    def _freshness(self, headers, request_time, response_time,
+                   ignore_cache_control=False):
+        """
+        Works out when a response was created and when it stops being fresh,
+        following RFC 7234 Section 4.2. Returns a tuple of (creation, expiry),
+        or None if the response must not be cached.
+
+        The creation time is the server's ``Date``, for use in conditional
+        requests. The expiry is a deadline by our own clock, in integer
+        seconds since the epoch, so checking freshness later is a single
+        comparison with :func:`clock <httpcache.utils.clock>`. It is None if
+        the response has no explicit freshness lifetime.
+
+        :param headers: The response's :class:`FrozenHeaders <FrozenHeaders>`.
+        :param request_time: When the request was sent, by our clock.
+        :param response_time: When the response was received, by our clock.
+        """
+        date = parse_http_date(headers.get('date'))
+        creation = response_time if date is None else date
+
+        lifetime = None
+        if not ignore_cache_control:
+            cc = headers.get('cache-control')
+            if cc is not None:
+                directives = parse_cache_control(cc)
+
+                # Right now we don't handle no-cache applied to specific
+                # fields. To be as 'nice' as possible, treat any no-cache as
+                # applying to the whole response.
+                if 'no-cache' in directives or 'no-store' in directives:
+                    return None
+                lifetime = directives.get('max-age')
+
+        # max-age takes priority over the 'Expires' header. Both 'Expires'
+        # and 'Date' come from the server's clock, so the difference between
+        # them is meaningful even if its clock doesn't agree with ours.
+        if lifetime is None:
+            expires = parse_http_date(headers.get('expires'))
+            if expires is None:
+                return creation, None
+            lifetime = expires - creation
+
+        initial_age = corrected_initial_age(
+            parse_delta_seconds(headers.get('age')), date, request_time,
+            response_time)
+        expiry = response_time + lifetime - initial_age
+
+        # If the response was stale when we got it, don't cache it at all.
+        if expiry <= response_time:
+            return None
+
+        return creation, expiry
+
+    def _store_fragment(self, key, response, creation, expiry):
+        """
+        Stores the body of a 206 Partial Content response as a fragment of
+        the full resource, merging it with any fragments we already hold for
+        the same representation. If the fragments end up covering the whole
+        resource, they're promoted to a complete 200 OK entry.
+
+        :param key: The cache key of the full resource.
+        :param response: Requests :class:`Response <Response>` object to cache.
+        """
+        if response.request.method != 'GET':
+            return False
+
+        # Requests has already decoded the body, so it's no longer the bytes
+        # the Content-Range counts.
+        if is_encoded(response):
+            return False
+
+        content_range = parse_content_range(
+            response.headers.get('Content-Range'))
+        if content_range is None or content_range[2] is None:
+            return False
+
+        first, last, length = content_range
+        data = response.content
+        if len(data) != last - first + 1:
+            return False
+
+        fragments = []
+        previous = self._get(key)
+        if previous and 'fragments' in previous:
+            # Fragments can only be combined if they're from the same
+            # representation, per RFC 7233 Section 4.3.
+            if (previous['length'] == length and
+                    self._same_validators(previous['response'], response)):
+                fragments = previous['fragments']
+        elif previous and 'failures' not in previous:
+            # We already have the complete resource.
+            return False
+
+        fragments = add_fragment(fragments, first, data)
+
+        # The fragments hold the body, so the stored response doesn't need to.
+        template = freeze_response(response, content=b'')
+
+        if fragments[0][0] == 0 and len(fragments[0][1]) == length:
+            stored = self._set(key, {
+                'response': freeze_response(self._build_partial(
+                    template, 200, 'OK', fragments[0][1])),
+                'creation': creation,
+                'expiry': expiry})
+        else:
+            stored = self._set(key, {
+                'response': template,
+                'creation': creation,
+                'expiry': expiry,
+                'fragments': fragments,
+                'length': length})
+
+        self.__reduce_cache_count()
+
+        return stored
+
+    def _same_validators(self, first, second):
+        """
+        Returns True if two responses carry the same validators, and so are
+        from the same representation of a resource.
+        """
+        for header in ('ETag', 'Last-Modified'):
+            if first.headers.get(header) != second.headers.get(header):
+                return False
+        return True
+
+    def _build_partial(self, response, status_code, reason, content,
+                       content_range=None):
+        """
+        Builds a response from a frozen cached response with a different
+        status code and body, used when serving byte ranges.
+        """
+        headers = response.headers.replace({
+            'Content-Range': content_range,
+            'Content-Length': str(len(content))})
+
+        return thaw_response(
+            response, status_code=status_code, reason=reason,
+            headers=headers, content=content)
+
+    def _store_negative(self, response, request):
+        """
+        Stores a negative response (e.g. a 404 or a 503) for a short time.
+        Each consecutive failure for the same resource doubles the time the
+        response is cached for, up to ``negative_max_ttl``, so that a failing
+        upstream sees exponentially fewer requests.
+
+        :param response: Requests :class:`Response <Response>` object to cache.
+        """
+        # A HEAD's failure would be served to GETs, which share its key, with
+        # no body.
+        method = response.request.method
+        if method not in CACHEABLE_VERBS or method == 'HEAD':
+            return False
+
+        # Servers that explicitly forbid storing the response get their way,
+        # even when they're broken.
+        cc = response.headers.get('Cache-Control') or ''
+        if 'no-store' in cc:
+            return False
+
+        al = request.headers.get('Accept-Language') or ''
+        key = self.make_key(response.url, al)
+
+        failures = 1
+        previous = self._get(key)
+        if previous and 'failures' in previous:
+            failures = previous['failures'] + 1
+
+        ttl = self.negative_ttls[response.status_code] * 2 ** (failures - 1)
+        ttl = int(math.ceil(min(ttl, self.negative_max_ttl)))
+
+        now = clock()
+        stored = self._set(key, {
+            'response': freeze_response(response),
+            'creation': now,
+            'expiry': now + ttl,
+            'failures': failures})
+
+        self.__reduce_cache_count()
+
+        return stored
+
+    def _clear_negative(self, request):
+        """
+        Removes any negative entry for the resource being requested, resetting
+        the failure count used for backoff. Called whenever a non-negative
+        response is seen.
+        """
+        al = request.headers.get('Accept-Language') or ''
+        key = self.make_key(request.url, al)
+
+        cached_response = self._get(key)
+        if cached_response and 'failures' in cached_response:
+            self._delete(key)
+
+    def _get(self, key):
+        """
+        Gets an entry from the backing cache, decoding it if the backend is
+        out of process. Entries that can't be decoded, e.g. because they
+        were written by another version of httpcache, are treated as missing.
+        """
+        if self._writes is not None:
+            entry = self._writes.get(key)
+            if entry is not None:
+                return entry
+
+        entry = self._cache.get(key)
+        if entry is None or self._in_process:
+            return entry
+
+        try:
+            return serializer.loads(entry)
+        except (ValueError, TypeError):
+            return None
+
+    def _set(self, key, entry):
+        """
+        Puts an entry in the backing cache and indexes it for invalidation.
+        Returns False if the write-behind queue was full and the entry was
+        dropped, otherwise True.
+        """
+        response = entry['response']
+        previous = None
+        if self._bodies is not None:
+            previous = self._get(key)
+            self._share_bodies(entry)
+
+        if self._writes is not None:
+            if not self._writes.put(key, entry):
+                # The write was dropped, so the entry it would have replaced
+                # is still cached, and this one never was.
+                if self._bodies is not None:
+                    self._release_bodies(entry)
+                return False
+        else:
+            value, ttl = self._prepare(entry)
+            if ttl is None:
+                self._cache.set(key, value)
+            else:
+                self._cache.set(key, value, ttl)
+
+        if previous:
+            self._release_bodies(previous)
+
+        expires = None
+        if not self._in_process and entry['expiry'] is not None:
+            expires = entry['expiry'] + self._grace(entry)
+
+        with self._lock:
+            if not self._in_process:
+                self._index.expire(clock())
+            self._index.add(
+                key, response.url, cache_tags(response.headers), expires)
+
+            if self.key_stats is not None:
+                self.key_stats.stored(key, response.url)
+
         return True
 
+    def _prepare(self, entry):
+        """
+        Returns a tuple of the value to hand the backing cache for an entry,
+        and the TTL to give it (or None).
+        """
+        if self._in_process:
+            return entry, None
+
+        value = serializer.dumps(entry)
+        if not self._native_ttl or entry['expiry'] is None:
+            return value, None
+
+        # Zero would mean "never expire".
+        ttl = max(entry['expiry'] - clock() + self._grace(entry), 1)
+        if ttl > MAX_RELATIVE_TTL:
+            ttl += int(time.time())
+        return value, ttl
+
+    def _grace(self, entry):
+        """
+        Returns how long past its expiry a backend should keep an entry.
+        Negative entries are kept so that their failure counts survive for
+        backoff.
+        """
+        if 'failures' in entry:
+            return self.negative_max_ttl
+        return self.stale_grace
+
+    def _share_bodies(self, entry):
+        """
+        Swaps the body of an entry about to be stored, and the data of each of
+        its fragments, for identical bytes that are already held, if there
+        are any, taking a reference to them.
+        """
+        response = entry['response']
+        if response._content:
+            response._content = self._bodies.add(response._content)
+        for fragment in entry.get('fragments') or ():
+            fragment[1] = self._bodies.add(fragment[1])
+
+    def _release_bodies(self, entry):
+        """
+        Drops the references to the body and fragments of an entry taken by
+        :meth:`_share_bodies`.
+        """
+        self._bodies.release(entry['response']._content)
+        for start, data in entry.get('fragments') or ():
+            self._bodies.release(data)
+
+    def _delete(self, key, evicted=False):
+        """
+        Removes an entry from the backing cache and from the index.
+
+        :param evicted: (Optional) Whether the entry is being removed to make
+            room, rather than because it's no longer valid.
+        """
+        if self._bodies is not None:
+            entry = self._get(key)
+            if entry:
+                self._release_bodies(entry)
+
+        self._forget(key, evicted)
+        if self._writes is not None:
+            self._writes.discard(key)
+        try:
+            self._cache.delete(key)
+        except KeyError:
+            pass
+
+    def _forget(self, key, evicted=False):
+        """
+        Removes a key from the index, for an entry the backing cache no longer
+        holds or soon won't.
+        """
+        with self._lock:
+            self._index.remove(key)
+            if self.key_stats is not None:
+                self.key_stats.removed(key, evicted)
+
+    def _invalidate_keys(self, keys):
+        for key in keys:
+            self._delete(key)
+        return len(keys)
+
+    def _publish(self, **invalidations):
+        """
+        Tells the caches in other processes about invalidations made here.
+        """
+        if self.bus is not None:
+            self.bus.publish(**invalidations)
+
+    @synchronized_entries
+    def _apply_invalidations(self, keys=(), urls=(), prefixes=(), tags=()):
+        """
+        Applies invalidations received from another process. They're applied
+        locally only, never published again.
+        """
+        targets = set(keys)
+        with self._lock:
+            for url in urls:
+                targets.update(self._index.keys_for_url(url))
+            for prefix in prefixes:
+                targets.update(self._index.keys_for_prefix(prefix))
+            for tag in tags:
+                targets.update(self._index.keys_for_tag(tag))
+        return self._invalidate_keys(targets)
+
+    @synchronized_entries
+    def invalidate(self, url):
+        """
+        Removes every cached variant of ``url``. Returns the number of entries
+        removed.
+
+        Only entries stored by this object are known about: with a shared
+        backend, entries stored by other processes aren't removed unless they
+        share a ``bus`` with this one.
+        """
+        self._publish(urls=[url])
+        with self._lock:
+            keys = self._index.keys_for_url(url)
+        return self._invalidate_keys(keys)
+
+    @synchronized_entries
+    def invalidate_prefix(self, url_prefix):
+        """
+        Removes every cached entry whose URL starts with ``url_prefix``, e.g.
+        ``'http://example.com/api/items'``. Returns the number of entries
+        removed.
+        """
+        self._publish(prefixes=[url_prefix])
+        with self._lock:
+            keys = self._index.keys_for_prefix(url_prefix)
+        return self._invalidate_keys(keys)
+
+    @synchronized_entries
+    def invalidate_tags(self, *tags):
+        """
+        Removes every cached entry labelled with any of ``tags`` by a
+        ``Surrogate-Key`` or ``Cache-Tag`` response header. Returns the number
+        of entries removed.
+        """
+        self._publish(tags=tags)
+        keys = set()
+        with self._lock:
+            for tag in tags:
+                keys.update(self._index.keys_for_tag(tag))
+        return self._invalidate_keys(keys)
+
+    def body_report(self):
+        """
+        Returns a dictionary describing the response bodies and fragments
+        held in an in-process backing cache: the number of distinct
+        ``bodies``, the number of ``references`` to them, their
+        ``unique_bytes``, the ``referenced_bytes`` they'd take if every entry
+        had its own copy, and the ``saved_bytes`` between the two. Returns
+        None for other backends.
+        """
+        if self._bodies is None:
+            return None
+        with self._lock:
+            return self._bodies.report()
+
+    def top_keys(self, n=10):
+        """
+        Returns a dictionary describing the traffic to the cache by key: the
+        number of ``lookups``, ``hits`` and ``stores``, the number of
+        ``wasted_stores`` whose entries went without ever being served, and
+        how many of those were ``evicted_unused`` to make room. The ``n``
+        busiest keys are listed under ``keys``, busiest first (see
+        :meth:`KeyStats.top <httpcache.hotkeys.KeyStats.top>`).
+
+        Only lookups and stores made by this object are counted. Returns None
+        if keys aren't being counted.
+
+        :param n: (Optional) The number of keys to list.
+        """
+        if self.key_stats is None:
+            return None
+        with self._lock:
+            return self.key_stats.report(n)
+
     def make_key(self, *data):
         data = ''.join(data)
         key = hashlib.sha224(data.encode('utf-8')).hexdigest()
         return key
 
+    def snapshot(self, path):
+        """
+        Writes every entry in the cache to a file, so that a new process can
+        start with a warm cache by calling :meth:`load`. The file is a stream
+        of records encoded by :mod:`httpcache.serializer`, oldest first, so
+        neither writing nor reading it needs the whole cache in memory at
+        once.
+
+        The backing cache must be able to enumerate its entries, which
+        memcached and friends can't do.
+
+        Returns the number of entries written.
+
+        :param path: The path of the file to write.
+        """
+        if not hasattr(self._cache, 'items'):
+            raise TypeError("The backing cache can't enumerate its entries.")
+
+        self.flush()
+        with self._entry_lock:
+            items = [(key, entry) for key, entry in self._cache.items()
+                     if not key.startswith(LEASE_PREFIX)]
+
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            for key, entry in items:
+                if self._in_process:
+                    entry = serializer.dumps(entry)
+                key = key.encode('utf-8')
+                f.write(SNAPSHOT_RECORD.pack(len(key), len(entry)))
+                f.write(key)
+                f.write(entry)
+
+        return len(items)
+
+    def load(self, path):
+        """
+        Loads entries from a snapshot written by :meth:`snapshot`. Entries
+        that have expired since the snapshot was taken are skipped.
+
+        Returns the number of entries loaded.
+
+        :param path: The path of the snapshot file.
+        """
+        now = clock()
+        loaded = 0
+
+        with open(path, 'rb') as f:
+            if f.readline() != SNAPSHOT_MAGIC:
+                raise ValueError("%s is not an httpcache snapshot." % path)
+
+            while True:
+                header = f.read(SNAPSHOT_RECORD.size)
+                if not header:
+                    break
+                if len(header) != SNAPSHOT_RECORD.size:
+                    raise ValueError("%s is truncated." % path)
+
+                key_length, entry_length = SNAPSHOT_RECORD.unpack(header)
+                key = f.read(key_length).decode('utf-8')
+                entry = serializer.loads(f.read(entry_length))
+
+                if entry['expiry'] is not None and entry['expiry'] <= now:
+                    continue
+
+                with self._entry_lock:
+                    if self._set(key, entry):
+                        loaded += 1
+
+        with self._entry_lock:
+            self.__reduce_cache_count()
+
+        return loaded
+
+    def flush(self, timeout=None):
+        """
+        With ``write_behind``, waits until every entry stored so far has been
+        written to the backing cache. Returns False if ``timeout`` seconds
+        pass first.
+        """
+        if self._writes is None:
+            return True
+        return self._writes.flush(timeout)
+
+    def close(self, timeout=None):
+        """
+        With ``write_behind``, writes every waiting entry to the backing cache
+        and stops the background thread. Entries stored afterwards are
+        written straight away. Invalidations waiting to be published on the
+        ``bus`` are sent.
+        """
+        if self.bus is not None:
+            self.bus.flush()
+
+        with self._lock:
+            if self._writes is not None:
+                self._writes.close(timeout)
+                self._writes = None
+
+    @synchronized_entries
     def handle_304(self, response, request):
         """
         Given a 304 response, retrieves the cached entry. This unconditionally
@@ -140,9 +869,116 @@ class HTTPCache(object):
         url = request.url
         al = request.headers.get('Accept-Language') or ''
         key = self.make_key(url, al)
-        cached_response = self._cache.get(key, {})
-        return cached_response.get('response')
+        cached_response = self._get(key) or {}
+        if 'response' not in cached_response:
+            return None
+        if self.key_stats is not None:
+            with self._lock:
+                self.key_stats.served(key)
+        if request.method == 'HEAD':
+            return thaw_response(
+                cached_response['response'], request=request, content=b'')
+        return thaw_response(cached_response['response'], request=request)
+
+    @property
+    def leases(self):
+        """
+        Whether misses are coordinated through leases in the backing cache.
+        """
+        return self.lease_ttl is not None and hasattr(self._cache, 'add')
+
+    def wants_lease(self, request):
+        """
+        Whether a miss for ``request`` should be coordinated through a lease:
+        only GETs whose response the policy lets us cache are worth waiting
+        for.
+        """
+        if not self.leases or request.method != 'GET':
+            return False
+        if self.policy is not None:
+            rule = self.policy.match(request.url)
+            if rule is not None and not rule.cache:
+                return False
+        return True
+
+    def acquire_lease(self, request):
+        """
+        Tries to take the lease to fill the cache entry for ``request``.
+        Returns a token to pass to :meth:`release_lease` if the lease was
+        taken, or None if another process holds it.
+
+        :param request: The request that missed the cache.
+        """
+        token = uuid.uuid4().hex
+        key = self._lease_key(request)
+        if self._cache.add(key, token, self.lease_ttl):
+            return token
+        return None
 
+    def release_lease(self, request, token):
+        """
+        Gives up a lease taken by :meth:`acquire_lease`, once the entry has
+        been stored (or couldn't be). A lease that has expired and been taken
+        by someone else is left alone.
+        """
+        key = self._lease_key(request)
+        if self._cache.get(key) == token:
+            try:
+                self._cache.delete(key)
+            except KeyError:
+                pass
+
+    def wait_for_fill(self, request):
+        """
+        Waits for the process holding the lease for ``request`` to store a
+        response, polling the cache for up to ``lease_wait`` seconds. If the
+        cache still holds a stale copy (see ``stale_grace``), that's returned
+        straight away instead. The wait ends early if the lease is released
+        without a fresh entry being stored, e.g. because the response wasn't
+        cacheable.
+
+        Returns the cached response, or None if there's none to wait for.
+        """
+        stale = self.retrieve_stale(request)
+        if stale is not None:
+            return stale
+
+        lease_key = self._lease_key(request)
+        deadline = monotonic() + self.lease_wait
+        while True:
+            time.sleep(self.lease_poll)
+            response = self.retrieve(request)
+            if response is not None or monotonic() >= deadline:
+                return response
+            if self._cache.get(lease_key) is None:
+                return None
+
+    @synchronized_entries
+    def retrieve_stale(self, request):
+        """
+        Returns a response from the entry for ``request``, even if it has
+        expired, as long as the backing cache still holds it. Returns None if
+        it doesn't.
+        """
+        key = self._request_key(request)
+        cached_response = self._get(key)
+        if (not cached_response or cached_response['expiry'] is None or
+                'failures' in cached_response or
+                'fragments' in cached_response):
+            return None
+        if self.key_stats is not None:
+            with self._lock:
+                self.key_stats.served(key)
+        return self._serve(cached_response, request)
+
+    def _request_key(self, request):
+        al = request.headers.get('Accept-Language') or ''
+        return self.make_key(request.url, al)
+
+    def _lease_key(self, request):
+        return LEASE_PREFIX + self._request_key(request)
+
+    @synchronized_entries
     def retrieve(self, request):
         """
         Retrieves a cached response if possible.
@@ -155,37 +991,168 @@ class HTTPCache(object):
         :param request:
             The Requests :class:`PreparedRequest <PreparedRequest>` object.
         """
-        return_response = None
         url = request.url
         al = request.headers.get('Accept-Language') or ''
 
+        if self.policy is not None:
+            rule = self.policy.match(url)
+            if rule is not None and not rule.cache:
+                return None
+
         key = self.make_key(url, al)
 
-        cached_response = self._cache.get(key)
+        if request.method not in NON_INVALIDATING_VERBS:
+            self._publish(keys=[key])
+            if self._get(key):
+                self._delete(key)
+            else:
+                self._forget(key)
+            return None
+
+        response = self._lookup(key, request)
+        if self.key_stats is not None:
+            with self._lock:
+                self.key_stats.lookup(key, url, response is not None)
+        return response
+
+    def _lookup(self, key, request):
+        """
+        Finds the response to serve for a cacheable request, if there is one.
+        """
+        return_response = None
+        cached_response = self._get(key)
         if not cached_response:
+            # The backend may have evicted the entry on its own.
+            self._forget(key, evicted=True)
             return
 
-        if request.method not in NON_INVALIDATING_VERBS:
-            self._cache.delete(key)
-            return None
+        range_header = request.headers.get('Range')
+        if 'fragments' in cached_response or (
+                range_header is not None and request.method == 'GET' and
+                cached_response['response'].status_code == 200):
+            return self._retrieve_range(key, cached_response, request)
 
         if cached_response['expiry'] is None:
             # We have no explicit expiry time, so we weren't instructed to
             # cache. Add an 'If-Modified-Since' header.
             creation = cached_response['creation']
-            header = build_date_header(creation)
+            header = build_http_date(creation)
             request.headers['If-Modified-Since'] = header
         else:
             # We have an explicit expiry time. If we're earlier than the expiry
             # time, return the response.
-            now = datetime.utcnow()
-            if now <= cached_response['expiry']:
-                return_response = cached_response['response']
-            else:
-                self._cache.delete(key)
+            if clock() < cached_response['expiry']:
+                return_response = self._serve(cached_response, request)
+            elif 'failures' not in cached_response:
+                # Expired negative entries are left in place so that the
+                # failure count survives for backoff. They'll be replaced by
+                # the next response for the resource. Backends with native
+                # TTLs drop expired entries on their own, so there's no need
+                # for another round trip to delete it.
+                if self._native_ttl:
+                    self._forget(key)
+                else:
+                    self._delete(key)
 
         return return_response
 
+    def _serve(self, cached_response, request):
+        """
+        Builds the response to a request from a fresh cache entry: a 304 Not
+        Modified if the request is conditional and the entry matches it, the
+        entry's headers alone for a HEAD, or the entry itself.
+        """
+        response = cached_response['response']
+
+        if (response.status_code == 200 and request.method != 'OPTIONS' and
+                self._not_modified(response, request)):
+            headers = dict(
+                (name, response.headers[name])
+                for name in NOT_MODIFIED_HEADERS if name in response.headers)
+            return thaw_response(
+                response, request=request, status_code=304,
+                reason='Not Modified', headers=FrozenHeaders(headers),
+                content=b'')
+
+        if request.method == 'HEAD':
+            return thaw_response(response, request=request, content=b'')
+
+        return thaw_response(response, request=request)
+
+    def _not_modified(self, response, request):
+        """
+        Evaluates a client's own conditional request against a cached
+        response, per RFC 7232 Section 6: If-None-Match if it's present,
+        otherwise If-Modified-Since.
+        """
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag_matches(if_none_match, response.headers.get('ETag'))
+
+        if_modified_since = parse_http_date(
+            request.headers.get('If-Modified-Since'))
+        if if_modified_since is None:
+            return False
+
+        last_modified = parse_http_date(response.headers.get('Last-Modified'))
+        return (last_modified is not None and
+                last_modified <= if_modified_since)
+
+    def _retrieve_range(self, key, cached_response, request):
+        """
+        Serves a Range request from a complete cached response or from cached
+        fragments. Only fresh entries are used: a conditional range request
+        can't sensibly be completed by a 304, so anything else is left for the
+        origin.
+
+        Returns a 206 Partial Content response, or None.
+        """
+        expiry = cached_response['expiry']
+        if expiry is None:
+            return None
+
+        if clock() >= expiry:
+            if self._native_ttl:
+                self._forget(key)
+            else:
+                self._delete(key)
+            return None
+
+        range_header = request.headers.get('Range')
+        if range_header is None or 'If-Range' in request.headers:
+            return None
+
+        # The body we hold has been decoded, so byte offsets into it aren't
+        # offsets into what the origin would send.
+        response = cached_response['response']
+        if is_encoded(response):
+            return None
+
+        fragments = cached_response.get('fragments')
+        if fragments is not None:
+            length = cached_response['length']
+        else:
+            content = response.content
+            length = len(content)
+
+        byte_range = parse_range_header(range_header, length)
+        if byte_range is None:
+            return None
+
+        first, last = byte_range
+        if fragments is not None:
+            data = read_range(fragments, first, last)
+            if data is None:
+                return None
+        else:
+            data = content[first:last + 1]
+
+        content_range = 'bytes %d-%d/%d' % (first, last, length)
+        partial = self._build_partial(
+            response, 206, 'Partial Content', data, content_range)
+        partial.request = request
+        return partial
+
     def __reduce_cache_count(self):
         """
         Drops the number of entries in the cache to the capacity of the cache.
@@ -195,27 +1162,67 @@ class HTTPCache(object):
         cached until the number of cache entries drops to the capacity. If this
         leaves the cache above capacity, begins deleting the least-used cache
         entries that are still valid until the cache has space.
+
+        First, if the bodies held in process take more than ``max_bytes``,
+        deletes the least-used entries until they don't. Both limits are
+        scaled down by the memory governor, if there is one.
         """
+        capacity = self.capacity
+        max_bytes = self.max_bytes
+        if self.governor is not None:
+            capacity = self.governor.capacity(capacity)
+            if max_bytes is not None:
+                max_bytes = int(max_bytes * self.governor.fraction)
+
+        if max_bytes is not None and self._bodies is not None:
+            self.__reduce_body_bytes(max_bytes)
+
+        # Backends that make room for themselves (and whose length may count
+        # other processes' entries) are left to it.
+        if self._evicts:
+            return
+
         try:
-            if len(self._cache) <= self.capacity:
+            if len(self._cache) <= capacity:
                 return
         except TypeError:
             # memcached does not like to return everything
             return
 
-        to_delete = len(self._cache) - self.capacity
-        keys = list(self._cache.keys())
+        # Leases live alongside the entries, but aren't entries: deleting one
+        # would let another process fetch a key that's already being fetched.
+        keys = [key for key in self._cache.keys()
+                if not key.startswith(LEASE_PREFIX)]
+        to_delete = len(keys) - capacity
+        if to_delete <= 0:
+            return
 
         for key in keys:
-            if self._cache.get(key, {}).get('expiry') is None:
-                self._cache.delete(key)
+            if (self._get(key) or {}).get('expiry') is None:
+                self._delete(key, evicted=True)
                 to_delete -= 1
 
             if to_delete == 0:
                 return
 
-        keys = list(self._cache.keys())
+        keys = [key for key in self._cache.keys()
+                if not key.startswith(LEASE_PREFIX)]
 
         for i in range(to_delete):
-            self._cache.delete(keys[i])
+            self._delete(keys[i], evicted=True)
         return
+
+    def __reduce_body_bytes(self, max_bytes):
+        """
+        Deletes the least-used entries until the distinct bodies held take no
+        more than ``max_bytes``. Deleting an entry whose body is shared with
+        another entry frees nothing, so this keeps going until enough bodies
+        have lost their last reference.
+        """
+        if self._bodies.unique_bytes <= max_bytes:
+            return
+
+        for key in list(self._cache.keys()):
+            if self._bodies.unique_bytes <= max_bytes:
+                return
+            self._delete(key, evicted=True)
@@ -6,5 +6,13 @@ compat.py
 Defines cross-platform functions and classes needed to achieve proper
 functionality.
 """
+import time
 
-pass
+try:  # Python 3.3+
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping  # NOQA
+
+# Python 2 has no monotonic clock, so the best we can do is the system clock.
+monotonic = getattr(time, 'monotonic', time.time)
+perf_counter = getattr(time, 'perf_counter', time.time)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+governor.py
+~~~~~~~~~~~
+
+Defines the memory governor, which shrinks the capacity of the cache when the
+process or its container is running short of memory and grows it back when
+the pressure is off.
+"""
+import os
+
+from .compat import monotonic
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# cgroup v1 reports "no limit" as a huge number rather than "max".
+UNLIMITED = 1 << 60
+
+
+class MemoryGovernor(object):
+    """
+    Adjusts the capacity of an :class:`HTTPCache <httpcache.HTTPCache>` to
+    the memory pressure on the process.
+
+    Memory use is sampled at most once every ``interval`` seconds, as a
+    fraction of the limit. When it reaches ``high``, the capacity is cut by
+    ``step`` of its current value, and the cache evicts its coldest entries
+    to fit. When it falls to ``low``, the capacity grows back by ``step`` of
+    the configured capacity. In between nothing changes, so that the
+    evictions from a cut don't immediately cause the capacity to grow again.
+
+    :param limit: (Optional) The memory this process may use, in bytes. If
+        it's given, the process's resident set size is compared with it.
+        Otherwise the cgroup's usage is compared with the cgroup's limit, and
+        without a cgroup limit the governor does nothing.
+    :param high: (Optional) The fraction of the limit at which the capacity
+        is cut.
+    :param low: (Optional) The fraction of the limit at which the capacity
+        grows back.
+    :param step: (Optional) How much to cut or grow the capacity by.
+    :param min_fraction: (Optional) The smallest fraction of the configured
+        capacity the cache can be cut to.
+    :param interval: (Optional) The least time in seconds between samples.
+    :param sampler: (Optional) A function returning a tuple of the memory
+        used and the limit, in bytes, to use instead of the defaults. The
+        limit may be None if there isn't one.
+    """
+    def __init__(self, limit=None, high=0.85, low=0.7, step=0.25,
+                 min_fraction=0.1, interval=1.0, sampler=None):
+        if not 0 < low < high:
+            raise ValueError("The low watermark must be below the high one.")
+
+        self.limit = limit
+        self.high = high
+        self.low = low
+        self.step = step
+        self.min_fraction = min_fraction
+        self.interval = interval
+        self.sampler = sampler
+
+        #: The fraction of the configured capacity the cache may use.
+        self.fraction = 1.0
+
+        #: The memory pressure when last sampled, or None if it's unknown.
+        self.pressure = None
+
+        self._last_sample = None
+
+    def capacity(self, capacity):
+        """
+        Returns the capacity the cache should have now, given the capacity it
+        was configured with.
+        """
+        self.update()
+        return max(int(capacity * self.fraction), 1)
+
+    def update(self):
+        """
+        Samples the memory pressure, if it's time to, and adjusts the
+        fraction of the configured capacity the cache may use.
+        """
+        now = monotonic()
+        if (self._last_sample is not None and
+                now - self._last_sample < self.interval):
+            return
+        self._last_sample = now
+
+        used, limit = self.sample()
+        if used is None or not limit:
+            self.pressure = None
+            return
+
+        self.pressure = float(used) / limit
+        if self.pressure >= self.high:
+            self.fraction = max(
+                self.fraction * (1 - self.step), self.min_fraction)
+        elif self.pressure <= self.low:
+            self.fraction = min(self.fraction + self.step, 1.0)
+
+    def sample(self):
+        """
+        Returns a tuple of the memory used and the limit, in bytes. Either
+        may be None if it can't be found.
+        """
+        if self.sampler is not None:
+            return self.sampler()
+
+        if self.limit is not None:
+            return process_rss(), self.limit
+
+        usage = cgroup_memory()
+        if usage is None:
+            return None, None
+        return usage
+
+
+def process_rss():
+    """
+    Returns the resident set size of this process in bytes, or None if it
+    can't be found.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def cgroup_memory(root=CGROUP_ROOT):
+    """
+    Returns a tuple of the memory used by this process's cgroup and its limit
+    in bytes, from cgroup v2 or failing that v1. The limit is None if there
+    isn't one. Returns None if there's no cgroup memory controller.
+    """
+    for current, maximum in (
+            ('memory.current', 'memory.max'),
+            ('memory/memory.usage_in_bytes', 'memory/memory.limit_in_bytes')):
+        used = _read_bytes(os.path.join(root, current))
+        if used is None:
+            continue
+
+        limit = _read_bytes(os.path.join(root, maximum))
+        if limit is not None and limit >= UNLIMITED:
+            limit = None
+        return used, limit
+
+    return None
+
+
+def _read_bytes(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except (IOError, OSError):
+        return None
+
+    if value == 'max':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
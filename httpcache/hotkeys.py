@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+hotkeys.py
+~~~~~~~~~~
+
+Defines the per-key statistics the cache keeps: which keys see the most
+traffic, and how many stored entries go to waste.
+"""
+from collections import OrderedDict
+
+
+class KeyStats(object):
+    """
+    Finds the busiest cache keys with the Space-Saving algorithm (Metwally,
+    Agrawal and El Abbadi, 2005), and counts stores that are never read.
+
+    At most ``size`` keys are counted at once. A lookup or store for a key
+    that isn't counted takes the place of a key with the lowest count,
+    inheriting that count as its possible overcount (its ``error``). Any key
+    that makes up more than 1/``size`` of the traffic is sure to be counted.
+    Keys are held in buckets by count, so every update is O(1) however many
+    keys are counted.
+
+    A store is *wasted* if its entry is replaced, invalidated, expires or is
+    evicted before it's ever served. Evictions of entries that were never
+    served are also counted on their own, since they mean the cache is too
+    small for what's being put in it, or is holding things nobody reads.
+    Only the ``max_unserved`` most recently stored entries that haven't been
+    served yet are remembered: backends that expire or evict entries on
+    their own never say so, and the memory mustn't grow without bound.
+    Older stores are forgotten without being counted either way.
+
+    :param size: (Optional) The number of keys to count.
+    :param max_unserved: (Optional) The number of unserved stores to
+        remember.
+    """
+    def __init__(self, size=64, max_unserved=10000):
+        self.size = size
+        self.max_unserved = max_unserved
+
+        #: The number of lookups, how many of them were hits, and the number
+        #: of entries stored.
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+
+        #: The number of entries removed without ever being served.
+        self.wasted_stores = 0
+
+        #: How many of those were evicted to make room.
+        self.evicted_unused = 0
+
+        self._counters = {}
+        self._buckets = {}
+        self._min = 0
+
+        # The keys stored in this process that haven't been served since,
+        # oldest first.
+        self._unhit = OrderedDict()
+
+    def lookup(self, key, url, hit):
+        """
+        Records a lookup for ``key``, the key for ``url``, and whether it hit.
+        """
+        self.lookups += 1
+        counter = self._count(key, url)
+        if hit:
+            self.hits += 1
+            counter.hits += 1
+            self._unhit.pop(key, None)
+        else:
+            counter.misses += 1
+
+    def served(self, key):
+        """
+        Records that the entry for ``key`` was served other than by a hit,
+        e.g. after revalidating it.
+        """
+        self._unhit.pop(key, None)
+
+    def stored(self, key, url):
+        """
+        Records that an entry was stored for ``key``, the key for ``url``.
+        """
+        self.stores += 1
+        self._count(key, url).stores += 1
+
+        # The entry this one replaces was never served.
+        if self._unhit.pop(key, None) is not None:
+            self.wasted_stores += 1
+        self._unhit[key] = True
+        if len(self._unhit) > self.max_unserved:
+            self._unhit.popitem(last=False)
+
+    def removed(self, key, evicted=False):
+        """
+        Records that the entry for ``key`` is gone, and whether it was evicted
+        to make room.
+        """
+        if self._unhit.pop(key, None) is None:
+            return
+
+        self.wasted_stores += 1
+        if evicted:
+            self.evicted_unused += 1
+
+    def top(self, n=10):
+        """
+        Returns the ``n`` busiest keys, busiest first, as dictionaries of the
+        ``key``, its ``url``, its ``count`` of lookups and stores, the most
+        that count may be over by (``error``), and its ``hits``, ``misses``
+        and ``stores``.
+        """
+        counters = sorted(
+            self._counters.items(), key=lambda item: -item[1].count)
+        return [{
+            'key': key,
+            'url': counter.url,
+            'count': counter.count,
+            'error': counter.error,
+            'hits': counter.hits,
+            'misses': counter.misses,
+            'stores': counter.stores,
+        } for key, counter in counters[:n]]
+
+    def report(self, n=10):
+        """
+        Returns a dictionary of the totals, with the ``n`` busiest keys under
+        ``keys``.
+        """
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'stores': self.stores,
+            'wasted_stores': self.wasted_stores,
+            'evicted_unused': self.evicted_unused,
+            'keys': self.top(n),
+        }
+
+    def _count(self, key, url):
+        counter = self._counters.get(key)
+        if counter is not None:
+            self._move(key, counter.count)
+            counter.count += 1
+            return counter
+
+        if len(self._counters) < self.size:
+            counter = self._counters[key] = _Counter(url, 1, 0)
+            self._buckets.setdefault(1, set()).add(key)
+            self._min = 1
+            return counter
+
+        # Take the place of a key with the lowest count.
+        lowest = self._min
+        victim = self._buckets[lowest].pop()
+        del self._counters[victim]
+        self._buckets[lowest].add(key)
+        self._move(key, lowest)
+
+        counter = self._counters[key] = _Counter(url, lowest + 1, lowest)
+        return counter
+
+    def _move(self, key, count):
+        """
+        Moves ``key`` from the bucket for ``count`` to the next one up.
+        """
+        bucket = self._buckets[count]
+        bucket.remove(key)
+        if not bucket:
+            del self._buckets[count]
+            if self._min == count:
+                self._min = count + 1
+        self._buckets.setdefault(count + 1, set()).add(key)
+
+
+class _Counter(object):
+    __slots__ = ('url', 'count', 'error', 'hits', 'misses', 'stores')
+
+    def __init__(self, url, count, error):
+        self.url = url
+        self.count = count
+        self.error = error
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
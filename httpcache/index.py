@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+index.py
+~~~~~~~~
+
+Defines the secondary index used to find cache entries by URL, URL prefix and
+tag, so that purging a set of entries costs time proportional to the number of
+entries purged rather than to the size of the cache.
+"""
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import heapq
+
+
+class InvalidationIndex(object):
+    """
+    Maps URLs and tags to the cache keys stored for them. A single URL may
+    have several keys, one for each variant (e.g. ``Accept-Language``).
+
+    URLs are also kept in a sorted list so that every URL starting with a
+    given prefix can be found with a binary search.
+
+    With a backend that drops entries on its own, e.g. memcached, nothing
+    tells the index an entry has gone. So that it doesn't grow without bound,
+    keys can be given a time after which they're forgotten (see
+    :meth:`expire`), and the index can be capped at ``max_keys``, forgetting
+    the keys added longest ago first.
+
+    :param max_keys: (Optional) The most keys to index.
+    """
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys
+
+        self._urls = []
+        self._url_keys = {}
+        self._tag_keys = {}
+        self._key_info = OrderedDict()
+        self._expiries = []
+
+    def __len__(self):
+        return len(self._key_info)
+
+    def add(self, key, url, tags=(), expires=None):
+        """
+        Records that ``key`` holds an entry for ``url`` carrying ``tags``.
+
+        :param expires: (Optional) When to forget the key, by
+            :func:`clock <httpcache.utils.clock>`.
+        """
+        if key in self._key_info:
+            self.remove(key)
+
+        self._key_info[key] = (url, tags, expires)
+
+        if expires is not None:
+            heapq.heappush(self._expiries, (expires, key))
+            # Keys that are re-added leave their old expiry behind.
+            if len(self._expiries) > 2 * len(self._key_info) + 64:
+                self._expiries = [
+                    (info[2], k) for k, info in self._key_info.items()
+                    if info[2] is not None]
+                heapq.heapify(self._expiries)
+
+        if self.max_keys is not None and len(self._key_info) > self.max_keys:
+            self.remove(next(iter(self._key_info)))
+
+        if url not in self._url_keys:
+            self._url_keys[url] = set()
+            insort(self._urls, url)
+        self._url_keys[url].add(key)
+
+        for tag in tags:
+            self._tag_keys.setdefault(tag, set()).add(key)
+
+    def remove(self, key):
+        """
+        Forgets about ``key``. Does nothing if the key isn't indexed.
+        """
+        try:
+            url, tags, _ = self._key_info.pop(key)
+        except KeyError:
+            return
+
+        keys = self._url_keys[url]
+        keys.discard(key)
+        if not keys:
+            del self._url_keys[url]
+            del self._urls[bisect_left(self._urls, url)]
+
+        for tag in tags:
+            keys = self._tag_keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tag_keys[tag]
+
+    def expire(self, now):
+        """
+        Forgets every key whose time to be forgotten is before ``now``.
+        Returns the number of keys forgotten.
+        """
+        expired = 0
+        while self._expiries and self._expiries[0][0] < now:
+            expires, key = heapq.heappop(self._expiries)
+            info = self._key_info.get(key)
+            if info is not None and info[2] == expires:
+                self.remove(key)
+                expired += 1
+        return expired
+
+    def keys_for_url(self, url):
+        """
+        Returns the keys of every variant stored for ``url``.
+        """
+        return set(self._url_keys.get(url, ()))
+
+    def keys_for_prefix(self, prefix):
+        """
+        Returns the keys of every entry whose URL starts with ``prefix``.
+        """
+        keys = set()
+        i = bisect_left(self._urls, prefix)
+
+        while i < len(self._urls) and self._urls[i].startswith(prefix):
+            keys.update(self._url_keys[self._urls[i]])
+            i += 1
+
+        return keys
+
+    def keys_for_tag(self, tag):
+        """
+        Returns the keys of every entry carrying ``tag``.
+        """
+        return set(self._tag_keys.get(tag, ()))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+models.py
+~~~~~~~~~
+
+Defines the structures used to hold responses in the cache. Responses are
+frozen when they're stored, and every cache hit gets a new, lightweight copy
+that shares the frozen body and headers rather than copying them.
+"""
+import io
+
+from .compat import Mapping
+
+
+class FrozenHeaders(Mapping):
+    """
+    An immutable, case-insensitive mapping of HTTP headers. Because it can't
+    be changed it can safely be shared between every response served from a
+    single cache entry, and between threads.
+    """
+    def __init__(self, headers=None):
+        # Requests' CaseInsensitiveDict keeps its headers in exactly the same
+        # layout we do, so copy that in one go rather than header by header.
+        store = getattr(headers, '_store', None)
+        if store is not None:
+            self._store = dict(store)
+            return
+
+        self._store = {}
+        for name, value in (headers or {}).items():
+            self._store[name.lower()] = (name, value)
+
+    def __getitem__(self, key):
+        return self._store[key.lower()][1]
+
+    def __iter__(self):
+        return (name for name, value in self._store.values())
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key.lower() in self._store
+
+    def get(self, key, default=None):
+        try:
+            return self._store[key.lower()][1]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.lower_items() == dict(
+            (name.lower(), value) for name, value in other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __setitem__(self, key, value):
+        raise TypeError("Cached response headers can't be modified.")
+
+    def __delitem__(self, key):
+        raise TypeError("Cached response headers can't be modified.")
+
+    def lower_items(self):
+        """
+        Returns a dictionary of the headers with lowercased names.
+        """
+        return dict((key, pair[1]) for key, pair in self._store.items())
+
+    def copy(self):
+        """
+        Returns a mutable copy of the headers, as the Requests
+        ``CaseInsensitiveDict`` that responses normally have.
+        """
+        # Requests is only imported when headers are first copied, so the
+        # cache can be used without it.
+        from requests.structures import CaseInsensitiveDict
+
+        copied = CaseInsensitiveDict()
+        copied._store = self._store.copy()
+        return copied
+
+    def replace(self, headers):
+        """
+        Returns new frozen headers with some headers replaced. Headers whose
+        new value is None are removed.
+
+        :param headers: A dictionary of the headers to change.
+        """
+        replaced = FrozenHeaders()
+        replaced._store = self._store.copy()
+        for name, value in headers.items():
+            if value is None:
+                replaced._store.pop(name.lower(), None)
+            else:
+                replaced._store[name.lower()] = (name, value)
+        return replaced
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def _copy_response(response):
+    """
+    Makes a shallow copy of a response without going through its pickling
+    machinery, which would be much slower.
+    """
+    copied = response.__class__.__new__(response.__class__)
+    copied.__dict__.update(response.__dict__)
+    return copied
+
+
+def _copy_cookies(response):
+    """
+    Gives a copied response a cookie jar of its own, since a jar can be
+    changed by whoever holds it.
+    """
+    cookies = response.__dict__.get('cookies')
+    if cookies is None or not hasattr(cookies, 'copy'):
+        return
+
+    # Most responses set no cookies, and a new empty jar is cheaper than a
+    # copy of one.
+    if len(cookies):
+        response.cookies = cookies.copy()
+    else:
+        response.cookies = cookies.__class__(cookies.get_policy())
+
+
+def freeze_response(response, content=None, headers=None):
+    """
+    Takes an immutable snapshot of a response for storage in the cache. The
+    body is read in full and the headers frozen, so that nothing the caller
+    later does to ``response``, including to its cookies, can change the
+    cached copy.
+
+    :param response: The Requests :class:`Response <Response>` to freeze.
+    :param content: (Optional) The body to store, if not the response's own.
+    :param headers: (Optional) The response's headers, if already frozen.
+    """
+    if content is None:
+        content = response.content or b''
+    if headers is None:
+        headers = FrozenHeaders(response.headers)
+
+    frozen = _copy_response(response)
+    frozen.headers = headers
+    frozen._content = content
+    frozen._content_consumed = True
+    frozen.raw = None
+    _copy_cookies(frozen)
+    return frozen
+
+
+def thaw_response(frozen, **attributes):
+    """
+    Builds a new response from a frozen one, to hand to a caller on a cache
+    hit. The body and headers are shared with the frozen response, so this
+    costs the same however large the body is. Each response gets its own
+    ``raw`` stream over the body and its own cookie jar, so reading or
+    changing them doesn't affect other hits.
+
+    :param frozen: A response returned by :func:`freeze_response`.
+    :param attributes: (Optional) Attributes to change on the new response,
+        e.g. ``status_code`` or ``headers``. ``content`` replaces the body.
+    """
+    response = _copy_response(frozen)
+
+    if 'content' in attributes:
+        attributes['_content'] = attributes.pop('content')
+    response.__dict__.update(attributes)
+
+    response.raw = io.BytesIO(response._content)
+    response.history = list(getattr(frozen, 'history', ()))
+    _copy_cookies(response)
+    return response
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+policy.py
+~~~~~~~~~
+
+Defines per-host and per-route caching policies, which override the default
+RFC 2616 behaviour of the cache for particular upstreams.
+"""
+import re
+
+try:  # Python 2
+    from urlparse import urlsplit
+except ImportError:  # Python 3
+    from urllib.parse import urlsplit
+
+
+class Rule(object):
+    """
+    A caching policy for the URLs on a host under a path prefix.
+
+    :param host: The host the rule applies to. May be a hostname, a wildcard
+        like ``'*.example.com'`` (which doesn't match ``example.com``
+        itself), or ``'*'`` for every host.
+    :param path: (Optional) The path prefix the rule applies to.
+    :param cache: (Optional) Set to False to never cache these URLs.
+    :param ttl: (Optional) Cache responses for exactly this many seconds,
+        ignoring the caching headers sent by the server.
+    :param ignore_cache_control: (Optional) Ignore the ``Cache-Control``
+        header sent by the server, falling back to ``Expires``.
+    :param status_codes: (Optional) The status codes that may be cached, if
+        not the usual ones.
+    """
+    def __init__(self, host, path='/', cache=True, ttl=None,
+                 ignore_cache_control=False, status_codes=None):
+        self.host = host.lower()
+        self.path = path
+        self.cache = cache
+        self.ttl = ttl
+        self.ignore_cache_control = ignore_cache_control
+        self.status_codes = status_codes
+
+    def __repr__(self):
+        return '<Rule %s%s>' % (self.host, self.path)
+
+
+class CachePolicy(object):
+    """
+    A table of :class:`Rule <Rule>` objects, compiled so that finding the
+    rule for a URL costs a couple of dictionary lookups and one regular
+    expression match, however many rules there are.
+
+    Rules for an exact host are preferred to wildcard rules, and wildcard
+    rules to rules for ``'*'``. For a given host, the rule with the longest
+    matching path prefix wins.
+
+    :param rules: An iterable of :class:`Rule <Rule>` objects.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        by_host = {}
+        for rule in self.rules:
+            by_host.setdefault(rule.host, []).append(rule)
+
+        self._matchers = {}
+        for host, rules in by_host.items():
+            rules.sort(key=lambda rule: len(rule.path), reverse=True)
+            pattern = '|'.join('(%s)' % re.escape(rule.path) for rule in rules)
+            self._matchers[host] = (re.compile(pattern), rules)
+
+    def match(self, url):
+        """
+        Returns the rule that applies to ``url``, or None if there isn't one.
+        """
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+        path = parts.path or '/'
+
+        for candidate in self._candidate_hosts(host):
+            try:
+                matcher, rules = self._matchers[candidate]
+            except KeyError:
+                continue
+
+            match = matcher.match(path)
+            if match is not None:
+                return rules[match.lastindex - 1]
+
+        return None
+
+    def _candidate_hosts(self, host):
+        yield host
+
+        labels = host.split('.')
+        for i in range(1, len(labels)):
+            yield '*.' + '.'.join(labels[i:])
+
+        yield '*'
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+prefetch.py
+~~~~~~~~~~~
+
+Defines the prefetcher that fetches the resources a response links to before
+they're asked for, so that e.g. walking a paginated API doesn't pay a round
+trip for every page.
+"""
+import logging
+import threading
+
+from requests import Request
+from requests.utils import parse_header_links
+
+from .compat import monotonic
+
+try:  # Python 2
+    from Queue import Queue, Full
+    from urlparse import urljoin, urlsplit
+except ImportError:  # Python 3
+    from queue import Queue, Full
+    from urllib.parse import urljoin, urlsplit
+
+log = logging.getLogger(__name__)
+
+# The link relations that are worth fetching ahead of time.
+PREFETCH_RELS = ('next', 'preload', 'prefetch')
+
+# Request headers that only make sense for the request they were sent with,
+# and so aren't copied to prefetch requests.
+UNCOPIED_HEADERS = (
+    'content-length', 'content-type', 'if-match', 'if-modified-since',
+    'if-none-match', 'if-range', 'if-unmodified-since', 'range')
+
+# Request headers carrying credentials, which are only copied to prefetch
+# requests for the same origin, as Requests does when following redirects.
+CREDENTIAL_HEADERS = ('authorization', 'cookie', 'proxy-authorization')
+
+
+class Prefetcher(object):
+    """
+    Fetches the URLs linked from responses through a
+    :class:`CachingHTTPAdapter <httpcache.CachingHTTPAdapter>` on a small
+    pool of background threads, filling its cache ahead of demand.
+
+    Prefetching is best-effort. URLs are dropped, not queued, if the queue is
+    full, if an origin already has ``max_per_origin`` prefetches outstanding,
+    or if it has been sent more than ``rate`` prefetches a second. URLs that
+    are already cached aren't fetched again.
+
+    :param adapter: The adapter to fetch through.
+    :param workers: (Optional) The number of prefetches to make at once.
+    :param max_queue: (Optional) The number of URLs that can wait to be
+        prefetched.
+    :param rate: (Optional) The most prefetches a second sent to one origin.
+    :param max_per_origin: (Optional) The most prefetches outstanding for one
+        origin at once.
+    :param depth: (Optional) How many links to follow from a response the
+        caller asked for. With the default of 1, only the resources it links
+        to directly are prefetched.
+    :param rels: (Optional) The ``Link`` relations to follow.
+    :param extract: (Optional) A function that takes a response and returns
+        more URLs to prefetch, e.g. from pagination fields in the body.
+    :param timeout: (Optional) The timeout for each prefetch request.
+    """
+    def __init__(self, adapter, workers=4, max_queue=100, rate=5.0,
+                 max_per_origin=4, depth=1, rels=PREFETCH_RELS, extract=None,
+                 timeout=10):
+        self.adapter = adapter
+        self.workers = workers
+        self.rate = rate
+        self.max_per_origin = max_per_origin
+        self.depth = depth
+        self.rels = rels
+        self.extract = extract
+        self.timeout = timeout
+
+        #: The number of URLs fetched, and dropped without being fetched.
+        self.fetched = 0
+        self.dropped = 0
+
+        self._queue = Queue(max_queue)
+        self._lock = threading.Lock()
+        self._outstanding = {}
+        self._buckets = {}
+        self._queued = set()
+        self._threads = []
+        self._local = threading.local()
+
+    def submit(self, request, response):
+        """
+        Queues the resources ``response`` links to for prefetching. Called by
+        the adapter after it stores a response it fetched.
+
+        :param request: The request ``response`` answers. Its headers are
+            copied to the prefetch requests, except that credentials are
+            only copied to URLs with the same origin as ``response``.
+        :param response: The response to find links in.
+        """
+        depth = getattr(self._local, 'depth', 0) + 1
+        if depth > self.depth:
+            return
+
+        headers = dict(
+            (name, value) for name, value in request.headers.items()
+            if name.lower() not in UNCOPIED_HEADERS)
+        anonymous = dict(
+            (name, value) for name, value in headers.items()
+            if name.lower() not in CREDENTIAL_HEADERS)
+
+        source = _origin(response.url)
+        for url in self.links(response):
+            if _origin(url) == source:
+                self._enqueue(url, headers, depth)
+            else:
+                self._enqueue(url, anonymous, depth)
+
+    def links(self, response):
+        """
+        Returns the absolute URLs to prefetch for ``response``.
+        """
+        urls = []
+        for link in parse_header_links(response.headers.get('Link') or ''):
+            rels = (link.get('rel') or '').split()
+            if link.get('url') and any(rel in self.rels for rel in rels):
+                urls.append(link['url'])
+
+        if self.extract is not None:
+            urls.extend(self.extract(response) or ())
+
+        return [urljoin(response.url, url) for url in urls]
+
+    def close(self):
+        """
+        Stops the worker threads once the URLs already queued have been
+        fetched.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _enqueue(self, url, headers, depth):
+        origin = _origin(url)
+        if origin is None:
+            return
+
+        with self._lock:
+            if url in self._queued:
+                return
+
+            if (self._outstanding.get(origin, 0) >= self.max_per_origin or
+                    not self._take_token(origin)):
+                self.dropped += 1
+                return
+
+            try:
+                self._queue.put_nowait((url, origin, headers, depth))
+            except Full:
+                self.dropped += 1
+                return
+
+            self._queued.add(url)
+            self._outstanding[origin] = self._outstanding.get(origin, 0) + 1
+
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name='httpcache-prefetch')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _take_token(self, origin):
+        """
+        A token bucket per origin, holding up to a second's worth of tokens.
+        """
+        now = monotonic()
+        tokens, last = self._buckets.get(origin, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - last) * self.rate)
+
+        if tokens < 1:
+            self._buckets[origin] = (tokens, now)
+            return False
+
+        self._buckets[origin] = (tokens - 1, now)
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            url, origin, headers, depth = item
+            try:
+                self._fetch(url, headers, depth)
+            except Exception:
+                log.debug("Failed to prefetch %s.", url, exc_info=True)
+            finally:
+                with self._lock:
+                    self._queued.discard(url)
+                    self._outstanding[origin] -= 1
+                    if not self._outstanding[origin]:
+                        del self._outstanding[origin]
+
+    def _fetch(self, url, headers, depth):
+        request = Request('GET', url, headers=headers).prepare()
+        if self.adapter.cache.retrieve(request) is not None:
+            return
+
+        # Anything this prefetch links to is one step further from what the
+        # caller asked for.
+        self._local.depth = depth
+        try:
+            response = self.adapter.send(request, timeout=self.timeout)
+            response.content
+        finally:
+            self._local.depth = 0
+
+        with self._lock:
+            self.fetched += 1
+
+
+def _origin(url):
+    """
+    Returns the scheme and authority of an HTTP(S) URL, or None for any other
+    URL.
+    """
+    parts = urlsplit(url or '')
+    if parts.scheme not in ('http', 'https'):
+        return None
+    return '%s://%s' % (parts.scheme, parts.netloc.lower())
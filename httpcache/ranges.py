@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+ranges.py
+~~~~~~~~~
+
+Utilities for handling byte ranges, as described by RFC 7233. Partial
+responses are stored as a sorted list of non-overlapping ``[start, data]``
+fragments, which are merged as new fragments arrive.
+"""
+import re
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_content_range(header):
+    """
+    Given a Content-Range header, returns a tuple of (first byte, last byte,
+    complete length). The complete length is None if the server didn't
+    know it. Returns None if the header can't be parsed.
+    """
+    match = CONTENT_RANGE_RE.match((header or '').strip())
+    if match is None:
+        return None
+
+    first, last, length = match.groups()
+    first, last = int(first), int(last)
+    length = None if length == '*' else int(length)
+
+    if last < first or (length is not None and last >= length):
+        return None
+
+    return first, last, length
+
+
+def parse_range_header(header, length):
+    """
+    Given a Range header and the complete length of the representation,
+    returns a tuple of the (first byte, last byte) requested, clamped to the
+    representation.
+
+    Only single byte ranges are supported. Returns None for anything this
+    cache can't serve locally: multiple ranges, malformed headers, or ranges
+    that can't be satisfied.
+    """
+    match = RANGE_RE.match((header or '').replace(' ', ''))
+    if match is None or length is None:
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        # Suffix range: the final N bytes.
+        if not last or int(last) == 0:
+            return None
+        first = max(length - int(last), 0)
+        last = length - 1
+    else:
+        first = int(first)
+        last = int(last) if last else length - 1
+        last = min(last, length - 1)
+
+    if first > last or first >= length:
+        return None
+
+    return first, last
+
+
+def add_fragment(fragments, first, data):
+    """
+    Merges a fragment of ``data`` starting at ``first`` into a sorted list of
+    ``[start, data]`` fragments, coalescing any that overlap or touch. Returns
+    the new list of fragments.
+    """
+    merged = []
+    last = first + len(data)
+
+    for start, existing in fragments:
+        end = start + len(existing)
+
+        if end < first or start > last:
+            merged.append([start, existing])
+            continue
+
+        # The fragments overlap or touch, so fold the existing one into the
+        # new one. Bytes from the new fragment take precedence.
+        if start < first:
+            data = existing[:first - start] + data
+            first = start
+        if end > last:
+            data = data + existing[last - start:]
+            last = end
+
+    merged.append([first, data])
+    merged.sort(key=lambda fragment: fragment[0])
+    return merged
+
+
+def read_range(fragments, first, last):
+    """
+    Returns the bytes from ``first`` to ``last`` inclusive if a single
+    fragment covers all of them, or None if it doesn't. Because fragments are
+    always coalesced, a range spanning two fragments is never fully covered.
+    """
+    for start, data in fragments:
+        if start <= first and last < start + len(data):
+            return data[first - start:last - start + 1]
+
+    return None
+
+
+def is_encoded(response):
+    """
+    Returns whether ``response`` has a content coding other than identity.
+    Requests decodes such bodies, so byte ranges of the representation can't
+    be taken from or stored as what it holds.
+    """
+    encoding = response.headers.get('Content-Encoding') or 'identity'
+    return encoding.strip().lower() != 'identity'
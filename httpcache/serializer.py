@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+serializer.py
+~~~~~~~~~~~~~
+
+Defines the binary format cache entries are stored in when they leave the
+process, e.g. in memcached or in shared memory. Unlike pickle, decoding an
+entry can't run arbitrary code, so a cache server shared with other clients
+can't be used to attack this one.
+
+An entry is a fixed-size header followed by length-prefixed fields: the URL,
+the reason phrase, the encoding, a block of headers, the body and any byte
+range fragments. The header block is only parsed when a header is first
+looked up, and the body is sliced straight out of the encoded entry.
+"""
+from datetime import timedelta
+import struct
+
+from .models import FrozenHeaders
+
+# The version is bumped whenever the layout changes. Entries written in any
+# other version are treated as missing.
+MAGIC = b'HCE'
+VERSION = 1
+
+# The magic number and version, flags, the status code, the creation time,
+# the expiry, the complete length of a fragmented resource, the failure
+# count of a negative entry, the response's elapsed time in microseconds,
+# and the lengths of the variable-length fields that follow.
+ENTRY_HEADER = struct.Struct('<3sBBxHqqqIqIHHIII')
+
+# Each header is the length of its name and value, then the name and value.
+HEADER_FIELD = struct.Struct('<HI')
+
+# Each fragment is its first byte and its length, then its data.
+FRAGMENT = struct.Struct('<qI')
+
+HAS_EXPIRY = 1
+NEGATIVE = 2
+FRAGMENTED = 4
+
+_response_class = None
+
+
+def dumps(entry):
+    """
+    Encodes a cache entry as bytes.
+
+    :param entry: A cache entry, as built by :class:`HTTPCache <HTTPCache>`.
+    """
+    response = entry['response']
+    expiry = entry['expiry']
+    fragments = entry.get('fragments')
+
+    flags = 0
+    if expiry is not None:
+        flags |= HAS_EXPIRY
+    if 'failures' in entry:
+        flags |= NEGATIVE
+    if fragments is not None:
+        flags |= FRAGMENTED
+
+    url = _encode_text(response.url)
+    reason = _encode_text(response.reason)
+    encoding = _encode_text(response.encoding)
+    headers = _encode_headers(response.headers)
+    body = response._content or b''
+    elapsed = getattr(response, 'elapsed', None)
+    elapsed = 0 if elapsed is None else (
+        (elapsed.days * 86400 + elapsed.seconds) * 1000000 +
+        elapsed.microseconds)
+
+    parts = [
+        ENTRY_HEADER.pack(
+            MAGIC, VERSION, flags, response.status_code, entry['creation'],
+            expiry or 0, entry.get('length') or 0, entry.get('failures', 0),
+            elapsed, len(url), len(reason), len(encoding), len(headers),
+            len(body), len(fragments or ())),
+        url, reason, encoding, headers, body]
+
+    for start, data in fragments or ():
+        parts.append(FRAGMENT.pack(start, len(data)))
+        parts.append(data)
+
+    return b''.join(parts)
+
+
+def loads(data):
+    """
+    Decodes a cache entry encoded by :func:`dumps`. Raises ValueError if
+    ``data`` isn't an entry in this version of the format.
+
+    :param data: The encoded entry, as bytes or any buffer.
+    """
+    view = memoryview(data)
+    try:
+        (magic, version, flags, status_code, creation, expiry, length,
+         failures, elapsed, url_length, reason_length, encoding_length,
+         headers_length, body_length,
+         fragment_count) = ENTRY_HEADER.unpack_from(view, 0)
+    except struct.error:
+        raise ValueError("Cache entry is truncated.")
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version %d cache entry." % VERSION)
+
+    offset = ENTRY_HEADER.size
+    url, offset = _decode_text(view, offset, url_length)
+    reason, offset = _decode_text(view, offset, reason_length)
+    encoding, offset = _decode_text(view, offset, encoding_length)
+
+    headers = LazyHeaders(view[offset:offset + headers_length])
+    offset += headers_length
+
+    body = bytes(view[offset:offset + body_length])
+    offset += body_length
+
+    fragments = []
+    for i in range(fragment_count):
+        try:
+            start, size = FRAGMENT.unpack_from(view, offset)
+        except struct.error:
+            raise ValueError("Cache entry is truncated.")
+        offset += FRAGMENT.size
+        fragments.append([start, bytes(view[offset:offset + size])])
+        offset += size
+
+    if offset != len(view):
+        raise ValueError("Cache entry is truncated.")
+
+    response = _new_response()
+    response.status_code = status_code
+    response.url = url
+    response.reason = reason
+    response.encoding = encoding
+    response.headers = headers
+    response.elapsed = timedelta(microseconds=elapsed)
+    response._content = body
+    response._content_consumed = True
+    response.raw = None
+
+    entry = {
+        'response': response,
+        'creation': creation,
+        'expiry': expiry if flags & HAS_EXPIRY else None}
+
+    if flags & NEGATIVE:
+        entry['failures'] = failures
+    if flags & FRAGMENTED:
+        entry['fragments'] = fragments
+        entry['length'] = length
+
+    return entry
+
+
+class LazyHeaders(FrozenHeaders):
+    """
+    Frozen headers that are only decoded from an encoded header block when
+    they're first used. Most cache hits are served without anyone looking at
+    the headers, and those that are only decode them once.
+    """
+    def __init__(self, block):
+        self._block = block
+
+    def __getattr__(self, name):
+        if name != '_store':
+            raise AttributeError(name)
+
+        # Two threads may both decode the block, but they'll come up with
+        # the same answer.
+        self._store = _decode_headers(self._block)
+        return self._store
+
+    def __reduce__(self):
+        return FrozenHeaders, (dict(self.items()),)
+
+
+def _new_response():
+    global _response_class
+
+    # Requests is only imported the first time an entry is decoded, so the
+    # format can be used without it.
+    if _response_class is None:
+        from requests.models import Response
+        _response_class = Response
+
+    return _response_class()
+
+
+def _encode_text(value):
+    if value is None:
+        return b''
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _decode_text(view, offset, length):
+    end = offset + length
+    if not length:
+        return None, end
+
+    value = view[offset:end].tobytes()
+    if str is not bytes:
+        value = value.decode('utf-8')
+    return value, end
+
+
+def _encode_headers(headers):
+    parts = []
+    for name, value in headers.items():
+        name = _encode_text(name)
+        value = _encode_text(value)
+        parts.append(HEADER_FIELD.pack(len(name), len(value)))
+        parts.append(name)
+        parts.append(value)
+    return b''.join(parts)
+
+
+def _decode_headers(block):
+    store = {}
+    offset = 0
+    end = len(block)
+
+    while offset < end:
+        name_length, value_length = HEADER_FIELD.unpack_from(block, offset)
+        offset += HEADER_FIELD.size
+        name, offset = _decode_text(block, offset, name_length)
+        value, offset = _decode_text(block, offset, value_length)
+        store[name.lower()] = (name, value or '')
+
+    return store
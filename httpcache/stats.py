@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+stats.py
+~~~~~~~~
+
+Defines the counters the caching adapter keeps about its own performance.
+"""
+import threading
+
+
+class AdapterStats(object):
+    """
+    Counts cache hits, misses and revalidations made through a
+    :class:`CachingHTTPAdapter <httpcache.CachingHTTPAdapter>`, how long each
+    took, and how long requests waited to check a connection out of the
+    connection pools. All times are in seconds.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Sets every counter back to zero.
+        """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.revalidations = 0
+            self.hit_time = 0.0
+            self.miss_time = 0.0
+            self.pool_checkouts = 0
+            self.pool_wait_time = 0.0
+            self.pool_wait_max = 0.0
+
+    def record_hit(self, elapsed):
+        with self._lock:
+            self.hits += 1
+            self.hit_time += elapsed
+
+    def record_miss(self, elapsed, revalidation=False):
+        with self._lock:
+            self.misses += 1
+            self.miss_time += elapsed
+            if revalidation:
+                self.revalidations += 1
+
+    def record_pool_wait(self, elapsed):
+        with self._lock:
+            self.pool_checkouts += 1
+            self.pool_wait_time += elapsed
+            self.pool_wait_max = max(self.pool_wait_max, elapsed)
+
+    def report(self):
+        """
+        Returns a dictionary summarising the counters, including the hit ratio
+        and mean latencies.
+        """
+        def mean(total, count):
+            return total / count if count else 0.0
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'hit_ratio': mean(float(self.hits), self.hits + self.misses),
+                'mean_hit_time': mean(self.hit_time, self.hits),
+                'mean_miss_time': mean(self.miss_time, self.misses),
+                'pool_checkouts': self.pool_checkouts,
+                'mean_pool_wait': mean(
+                    self.pool_wait_time, self.pool_checkouts),
+                'max_pool_wait': self.pool_wait_max,
+            }
@@ -5,16 +5,38 @@ utils.py
 
 Utility functions for use with httpcache.
 """
-from datetime import datetime, timedelta
+import calendar
+from datetime import datetime
+from email.utils import formatdate
+import functools
+import re
+import time
 
 try:  # Python 2
-    from urlparse import urlparse
+    from urlparse import urljoin, urlparse
 except ImportError:  # Python 3
-    from urllib.parse import urlparse
+    from urllib.parse import urljoin, urlparse
+
+from .compat import monotonic
 
 RFC_1123_DT_STR = "%a, %d %b %Y %H:%M:%S GMT"
 RFC_850_DT_STR = "%A, %d-%b-%y %H:%M:%S GMT"
 
+# The monotonic clock is anchored to the epoch once, so that the times it
+# gives can be compared with dates from servers but never jump when the system
+# clock is changed.
+EPOCH_OFFSET = time.time() - monotonic()
+
+# Memcached reads a TTL longer than this as an absolute Unix time, and so do
+# our own backends.
+MAX_RELATIVE_TTL = 30 * 24 * 60 * 60
+
+ENTITY_TAG_RE = re.compile(r'(?:W/)?"[^"]*"')
+
+MONTHS = dict((month, i) for i, month in enumerate((
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+
 
 def parse_date_header(header):
     """
@@ -43,48 +65,102 @@ def parse_date_header(header):
     return dt
 
 
-def build_date_header(dt):
+def clock():
+    """
+    Returns the current time, in integer seconds since the epoch, read from a
+    monotonic clock.
+    """
+    return int(EPOCH_OFFSET + monotonic())
+
+
+def parse_delta_seconds(header):
+    """
+    Given a header whose value is a number of seconds, like ``Age``, returns
+    it as an integer. Returns 0 if the header is missing or invalid.
+    """
+    try:
+        return max(int(header), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def corrected_initial_age(age, date, request_time, response_time):
     """
-    Given a Python datetime object, build a Date header value according to
-    RFC 2616.
+    Calculates how old a response was when we received it, according to
+    RFC 7234 Section 4.2.3. Takes into account both the ``Age`` header and
+    the time the request spent in flight, so that a server whose clock is
+    ahead of ours can't make a response look younger than it is.
 
-    RFC 2616 specifies that the RFC 1123 form is to be preferred, so that is
-    what we use.
+    :param age: The value of the ``Age`` header, in seconds.
+    :param date: The value of the ``Date`` header, in seconds since the epoch,
+        or None.
+    :param request_time: When the request was sent, by our clock.
+    :param response_time: When the response was received, by our clock.
     """
-    return dt.strftime(RFC_1123_DT_STR)
+    apparent_age = 0
+    if date is not None:
+        apparent_age = max(0, response_time - date)
+
+    response_delay = response_time - request_time
+    corrected_age_value = age + response_delay
+
+    return max(apparent_age, corrected_age_value)
 
 
-def expires_from_cache_control(header, current_time):
+def parse_http_date(header):
     """
-    Given a Cache-Control header, builds a Python datetime object corresponding
-    to the expiry time (in UTC). This function should respect all relevant
-    Cache-Control directives.
+    Given a date header in the form specified by RFC 2616, return the number
+    of seconds since the epoch as an integer, or None if the header can't be
+    parsed.
+
+    The preferred RFC 1123 form is parsed by hand, because it's fixed-width
+    and strptime is slow. Anything else goes through
+    :func:`parse_date_header`.
+    """
+    try:
+        if len(header) == 29 and header[3] == ',' and header[25:] == ' GMT':
+            return calendar.timegm((
+                int(header[12:16]), MONTHS[header[8:11]], int(header[5:7]),
+                int(header[17:19]), int(header[20:22]), int(header[23:25])))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    dt = parse_date_header(header)
+    if dt is None:
+        return None
+    return calendar.timegm(dt.utctimetuple())
 
-    Takes current_time as an argument to ensure that 'max-age=0' generates the
-    correct behaviour without being special-cased.
 
-    Returns None to indicate that a request must not be cached.
+def build_http_date(timestamp):
     """
-    # Cache control header values are made of multiple comma separated fields.
-    # Splitting them like this is probably a bad idea, but I'm going to roll
-    # with it for now. We'll come back to it.
-    fields = header.split(', ')
-    duration = None
+    Given a number of seconds since the epoch, build a Date header value in
+    the RFC 1123 form.
+    """
+    return formatdate(timestamp, usegmt=True)
+
 
-    for field in fields:
-        # Right now we don't handle no-cache applied to specific fields. To be
-        # as 'nice' as possible, treat any no-cache as applying to the whole
-        # request. Bail early, because there's no reason to stick around.
-        if field.startswith('no-cache') or field == 'no-store':
-            return None
+def parse_cache_control(header):
+    """
+    Given a Cache-Control header, returns a dictionary of its directives.
+    Directive names are lowercased. Directives without a value map to True,
+    and ``max-age`` is converted to an integer (or dropped if it isn't one).
+    """
+    directives = {}
 
-        if field.startswith('max-age'):
-            _, duration = field.split('=')
-            duration = int(duration)
+    for field in header.split(','):
+        name, _, value = field.partition('=')
+        name = name.strip().lower()
+        if not name:
+            continue
+        directives[name] = value.strip().strip('"') if value else True
 
-    interval = timedelta(seconds=int(duration))
+    if 'max-age' in directives:
+        try:
+            directives['max-age'] = int(directives['max-age'])
+        except (TypeError, ValueError):
+            del directives['max-age']
 
-    return current_time + interval
+    return directives
 
 
 def url_contains_query(url):
@@ -92,7 +168,117 @@ def url_contains_query(url):
     A very stupid function for determining if a URL contains a query string
     or not.
     """
-    if urlparse(url).query:
+    # Equivalent to checking urlparse(url).query, but much cheaper.
+    return bool(url.partition('#')[0].partition('?')[2])
+
+
+def cache_tags(headers):
+    """
+    Returns the tags a response has been labelled with for purging, from the
+    ``Surrogate-Key`` (space separated) and ``Cache-Tag`` (comma separated)
+    headers.
+    """
+    surrogate_key = headers.get('Surrogate-Key')
+    cache_tag = headers.get('Cache-Tag')
+    if surrogate_key is None and cache_tag is None:
+        return ()
+
+    tags = (surrogate_key or '').split()
+    tags.extend((cache_tag or '').split(','))
+    return tuple(set(tag.strip() for tag in tags if tag.strip()))
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Returns True if an ``If-None-Match`` header matches an entity tag, using
+    the weak comparison RFC 7232 Section 3.2 calls for.
+    """
+    if etag is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for candidate in ENTITY_TAG_RE.findall(if_none_match):
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def invalidated_urls(response):
+    """
+    Returns the URLs that must be invalidated after a successful response to
+    an unsafe request, per RFC 7234 Section 4.4: the request URI, and the
+    ``Location`` and ``Content-Location`` URIs if they're on the same host.
+    """
+    url = response.request.url
+    host = urlparse(url).netloc
+    urls = [url]
+
+    for header in ('Location', 'Content-Location'):
+        target = response.headers.get(header)
+        if target is None:
+            continue
+
+        target = urljoin(url, target)
+        if urlparse(target).netloc == host:
+            urls.append(target)
+
+    return urls
+
+
+def synchronized_entries(method):
+    """
+    Decorates a cache method so that it runs holding the cache's
+    ``_entry_lock``, making it safe to share between threads. That's the
+    cache's own lock if its entries are held in process, where they're cheap
+    to reach but not safe to share, and nothing if they're held elsewhere, so
+    that round trips to the backend don't wait for each other.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._entry_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class NoLock(object):
+    """
+    A lock that never blocks, for code that only sometimes needs one.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def accepts_arguments(function, count):
+    """
+    Returns True if ``function`` can be called with ``count`` positional
+    arguments. Functions that can't be inspected, like those written in C,
+    are assumed to accept them.
+    """
+    # inspect is slow to import, and only needed for out-of-process backends.
+    import inspect
+
+    try:
+        signature = inspect.signature(function)
+    except AttributeError:  # Python 2
+        try:
+            spec = inspect.getargspec(function)
+        except TypeError:
+            return True
+        bound = 1 if inspect.ismethod(function) else 0
+        return spec.varargs is not None or len(spec.args) - bound >= count
+    except (TypeError, ValueError):
         return True
-    else:
+
+    try:
+        signature.bind(*([None] * count))
+    except TypeError:
         return False
+    return True
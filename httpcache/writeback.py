@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+writeback.py
+~~~~~~~~~~~~
+
+Defines the write-behind queue that lets the cache hand entries to a slow
+backend (e.g. memcached on another host) without making the caller wait for
+the write.
+"""
+from collections import OrderedDict
+import logging
+import threading
+
+from .compat import monotonic
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    """
+    Holds entries waiting to be written to a backend, and a background thread
+    that writes them in batches. Until an entry has been written it can still
+    be read from the queue, so readers in this process never see a write go
+    missing.
+
+    The queue is bounded: when it's full, new writes are dropped rather than
+    making the caller wait. Writes to a key that's already waiting replace the
+    waiting entry, so a hot key only costs one backend write per batch.
+
+    :param backend: The backend to write to. If it has a ``set_multi`` method
+        each batch is written with one call to it per distinct TTL.
+    :param prepare: (Optional) A function applied to each entry just before
+        it's written, in the background thread. It returns a tuple of the
+        value to write and its TTL in seconds, or None for no TTL.
+    :param max_pending: (Optional) The most entries that can wait at once.
+    :param batch_size: (Optional) The most entries written in one batch.
+    """
+    def __init__(self, backend, prepare=None, max_pending=1000,
+                 batch_size=64):
+        self.backend = backend
+        self.prepare = prepare
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+
+        #: The number of writes dropped because the queue was full.
+        self.dropped = 0
+
+        #: The number of writes the backend failed.
+        self.failed = 0
+
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._cancelled = set()
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending) + len(self._writing)
+
+    def get(self, key):
+        """
+        Returns the entry waiting to be written for ``key``, or None.
+        """
+        with self._condition:
+            entry = self._pending.get(key)
+            if entry is None and key not in self._cancelled:
+                entry = self._writing.get(key)
+            return entry
+
+    def put(self, key, entry):
+        """
+        Queues ``entry`` to be written to ``key``. Returns False if the write
+        was dropped because the queue is full.
+        """
+        with self._condition:
+            if self._closed:
+                raise ValueError("Write-behind queue is closed.")
+
+            if key not in self._pending:
+                if len(self._pending) >= self.max_pending:
+                    self.dropped += 1
+                    return False
+
+            self._pending[key] = entry
+            self._cancelled.discard(key)
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='httpcache-write-behind')
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._condition.notify_all()
+            return True
+
+    def discard(self, key):
+        """
+        Forgets any write waiting for ``key``. If the entry is being written
+        right now, it's deleted from the backend once the write finishes.
+        """
+        with self._condition:
+            self._pending.pop(key, None)
+            if key in self._writing:
+                self._cancelled.add(key)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued entry has been written. Returns False if
+        ``timeout`` seconds pass first.
+        """
+        with self._condition:
+            return _wait_for(
+                self._condition,
+                lambda: not self._pending and not self._writing, timeout)
+
+    def close(self, timeout=None):
+        """
+        Writes every queued entry and stops the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                _wait_for(
+                    self._condition,
+                    lambda: self._pending or self._closed, None)
+                if not self._pending:
+                    self._condition.notify_all()
+                    return
+
+                while self._pending and len(self._writing) < self.batch_size:
+                    key, entry = self._pending.popitem(last=False)
+                    self._writing[key] = entry
+                batch = dict(self._writing)
+
+            self._write(batch)
+
+            with self._condition:
+                self._writing.clear()
+                cancelled = self._cancelled
+                self._cancelled = set()
+                self._condition.notify_all()
+
+            for key in cancelled:
+                try:
+                    self.backend.delete(key)
+                except Exception:
+                    log.exception("Failed to delete %s from the cache.", key)
+
+    def _write(self, batch):
+        try:
+            by_ttl = {}
+            for key, entry in batch.items():
+                value, ttl = (
+                    (entry, None) if self.prepare is None
+                    else self.prepare(entry))
+                by_ttl.setdefault(ttl, {})[key] = value
+
+            set_multi = getattr(self.backend, 'set_multi', None)
+            for ttl, values in by_ttl.items():
+                args = () if ttl is None else (ttl,)
+                if set_multi is not None:
+                    set_multi(values, *args)
+                else:
+                    for key, value in values.items():
+                        self.backend.set(key, value, *args)
+        except Exception:
+            # The entries are lost, but they were only cache entries. The
+            # worker has to keep going either way.
+            self.failed += len(batch)
+            log.exception("Failed to write %d cache entries.", len(batch))
+
+
+def _wait_for(condition, predicate, timeout):
+    """
+    ``Condition.wait_for``, which Python 2 doesn't have.
+    """
+    if timeout is None:
+        while not predicate():
+            condition.wait()
+        return True
+
+    deadline = monotonic() + timeout
+    while not predicate():
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return bool(predicate())
+        condition.wait(remaining)
+    return True
@@ -5,10 +5,35 @@ test-httpcache.py
 
 Test cases for httpcache.
 """
-from datetime import datetime, timedelta
+import calendar
+from datetime import datetime
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
 
 import httpcache
-from httpcache.backends import RecentOrderedDict
+from httpcache.backends import RecentOrderedDict, SharedMemoryCache
+from httpcache.backends.shared_memory import SLOT_HEADER, shared_memory
+from httpcache.bus import (
+    MAGIC, MAX_DECOMPRESSED, LocalBus, MulticastBus, UnixSocketBus)
+from httpcache.governor import MemoryGovernor, cgroup_memory, process_rss
+from httpcache.hotkeys import KeyStats
+from httpcache.index import InvalidationIndex
+from httpcache import serializer
+from httpcache.prefetch import Prefetcher
+from httpcache.ranges import (
+    add_fragment, parse_content_range, parse_range_header, read_range)
+from httpcache.utils import (
+    accepts_arguments, build_http_date, clock, corrected_initial_age,
+    etag_matches,
+    parse_cache_control, parse_http_date)
 import mockcache
 import pytest
 import requests
@@ -57,14 +82,16 @@ class TestHTTPCache(object):
         cache.store(resp, req)
         cached_resp = cache.handle_304(resp, req)
 
-        assert resp is cached_resp
+        assert cached_resp is not resp
+        assert cached_resp.url == resp.url
+        assert cached_resp.headers == resp.headers
 
     def test_can_extract_creation_date_from_response_RFC_1123(self, cache):
         req = MockRequestsPreparedRequest()
         resp = MockRequestsResponse(
             headers={'Date': 'Sun, 06 Nov 1994 08:49:37 GMT'})
         cache = httpcache.HTTPCache()
-        dt = datetime(1994, 11, 6, 8, 49, 37)
+        dt = calendar.timegm(datetime(1994, 11, 6, 8, 49, 37).timetuple())
 
         cache.store(resp, req)
         key = cache.make_key(req.url, '')
@@ -75,7 +102,7 @@ class TestHTTPCache(object):
         resp = MockRequestsResponse(
             headers={'Date': 'Sunday, 06-Nov-94 08:49:37 GMT'})
         cache = httpcache.HTTPCache()
-        dt = datetime(1994, 11, 6, 8, 49, 37)
+        dt = calendar.timegm(datetime(1994, 11, 6, 8, 49, 37).timetuple())
 
         cache.store(resp, req)
         key = cache.make_key(resp.url, '')
@@ -103,7 +130,7 @@ class TestHTTPCache(object):
         cache.store(resp, req)
         cached_resp = cache.retrieve(req)
 
-        assert cached_resp is resp
+        assert cached_resp.headers == resp.headers
 
     def test_expires_headers_invalidate(self, cache):
         req = MockRequestsPreparedRequest()
@@ -124,14 +151,14 @@ class TestHTTPCache(object):
             'Expires': 'Sun, 04 Nov 2012 08:49:37 GMT'})
         cache = httpcache.HTTPCache()
         req = MockRequestsPreparedRequest()
-        earlier = timedelta(seconds=-60)
-        much_earlier = timedelta(days=-1)
+        earlier = -60
+        much_earlier = -24 * 60 * 60
 
         key = cache.make_key(resp.url, '')
         cache._cache[key] = {
             'response': resp,
-            'creation': datetime.utcnow() + much_earlier,
-            'expiry': datetime.utcnow() + earlier}
+            'creation': int(time.time()) + much_earlier,
+            'expiry': int(time.time()) + earlier}
 
         cached_resp = cache.retrieve(req)
 
@@ -145,7 +172,7 @@ class TestHTTPCache(object):
         assert cache.store(resp, req)
 
         cached_resp = cache.retrieve(req)
-        assert cached_resp is resp
+        assert cached_resp.headers == resp.headers
 
     def test_we_respect_no_cache(self, cache):
         req = MockRequestsPreparedRequest()
@@ -183,16 +210,16 @@ class TestHTTPCache(object):
         cache.store(resp2, req)
 
         cachelist = list(cache._cache.items())
-        assert cachelist[0][1]['response'] is resp1
-        assert cachelist[1][1]['response'] is resp3
-        assert cachelist[2][1]['response'] is resp2
+        assert cachelist[0][1]['response'].url == resp1.url
+        assert cachelist[1][1]['response'].url == resp3.url
+        assert cachelist[2][1]['response'].url == resp2.url
 
         cache.handle_304(req, req)
 
         cachelist = list(cache._cache.items())
-        assert cachelist[0][1]['response'] is resp3
-        assert cachelist[1][1]['response'] is resp2
-        assert cachelist[2][1]['response'] is resp1
+        assert cachelist[0][1]['response'].url == resp3.url
+        assert cachelist[1][1]['response'].url == resp2.url
+        assert cachelist[2][1]['response'].url == resp1.url
 
     def test_do_not_cache_query_strings(self, cache):
         req = MockRequestsPreparedRequest()
@@ -212,7 +239,7 @@ class TestHTTPCache(object):
         assert cache.store(resp, req)
 
         cached_resp = cache.handle_304(resp, req)
-        assert cached_resp is resp
+        assert cached_resp.url == resp.url
 
     def test_we_dont_cache_some_methods(self, cache):
         req = MockRequestsPreparedRequest()
@@ -289,6 +316,2071 @@ class TestHTTPCache(object):
             cache._cache[key] for key in list(cache._cache.keys())]
 
 
+class TestNegativeCaching(object):
+    """
+    Tests for the short-lived caching of negative responses.
+    """
+    def test_negative_responses_not_cached_by_default(self):
+        req = MockRequestsPreparedRequest()
+        resp = MockRequestsResponse(status_code=404)
+        cache = httpcache.HTTPCache()
+
+        assert not cache.store(resp, req)
+
+    def test_can_cache_negative_responses(self):
+        req = MockRequestsPreparedRequest()
+        resp = MockRequestsResponse(status_code=503)
+        cache = httpcache.HTTPCache(negative_ttls={503: 5})
+
+        assert cache.store(resp, req)
+        assert cache.retrieve(req).status_code == 503
+
+    def test_negative_responses_respect_no_store(self):
+        req = MockRequestsPreparedRequest()
+        resp = MockRequestsResponse(
+            status_code=404, headers={'Cache-Control': 'no-store'})
+        cache = httpcache.HTTPCache(negative_ttls={404: 5})
+
+        assert not cache.store(resp, req)
+
+    def test_repeated_failures_back_off(self):
+        req = MockRequestsPreparedRequest()
+        cache = httpcache.HTTPCache(
+            negative_ttls={503: 2}, negative_max_ttl=5)
+        key = cache.make_key(req.url, '')
+
+        lifetimes = []
+        for i in range(4):
+            resp = MockRequestsResponse(status_code=503)
+            assert cache.store(resp, req)
+            entry = cache._cache[key]
+            lifetimes.append(entry['expiry'] - entry['creation'])
+
+        assert lifetimes == [2, 4, 5, 5]
+        assert entry['failures'] == 4
+
+    def test_expired_negative_entries_keep_failure_count(self):
+        req = MockRequestsPreparedRequest()
+        cache = httpcache.HTTPCache(negative_ttls={503: 2})
+        key = cache.make_key(req.url, '')
+
+        assert cache.store(MockRequestsResponse(status_code=503), req)
+        cache._cache[key]['expiry'] = int(time.time()) - 1
+
+        assert cache.retrieve(req) is None
+        assert cache.store(MockRequestsResponse(status_code=503), req)
+        assert cache._cache[key]['failures'] == 2
+
+    def test_success_resets_backoff(self):
+        req = MockRequestsPreparedRequest()
+        cache = httpcache.HTTPCache(negative_ttls={503: 2})
+        key = cache.make_key(req.url, '')
+
+        assert cache.store(MockRequestsResponse(status_code=503), req)
+        assert not cache.store(MockRequestsResponse(
+            headers={'Cache-Control': 'no-store'}), req)
+
+        assert key not in cache._cache
+
+
+class TestUtils(object):
+    """
+    Tests for the header parsing utilities.
+    """
+    def test_parse_http_date(self):
+        assert parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT') == 784111777
+        assert parse_http_date('Sunday, 06-Nov-94 08:49:37 GMT') == 784111777
+        assert parse_http_date('Sun, 06 Foo 1994 08:49:37 GMT') is None
+        assert parse_http_date('0') is None
+        assert parse_http_date(None) is None
+
+    def test_parse_cache_control(self):
+        directives = parse_cache_control('Max-Age=60,no-cache="Set-Cookie"')
+        assert directives == {'max-age': 60, 'no-cache': 'Set-Cookie'}
+        assert parse_cache_control('max-age=soon') == {}
+
+    def test_accepts_arguments(self):
+        assert accepts_arguments(lambda a, b, c=None: None, 3)
+        assert accepts_arguments(lambda *args: None, 3)
+        assert not accepts_arguments(lambda a, b: None, 3)
+        assert accepts_arguments(mockcache.Client([]).set, 3)
+        assert not accepts_arguments(RecentOrderedDict().set, 3)
+
+    def test_etag_matches(self):
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches('W/"abc"', '"abc"')
+        assert etag_matches('"x", W/"abc"', 'W/"abc"')
+        assert etag_matches('*', '"abc"')
+        assert not etag_matches('"ab"', '"abc"')
+        assert not etag_matches('"abc"', None)
+
+    def test_cache_control_without_max_age_falls_back_to_expires(self):
+        req = MockRequestsPreparedRequest()
+        resp = MockRequestsResponse(headers={
+            'Cache-Control': 'public',
+            'Date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+            'Expires': 'Sun, 06 Nov 2034 08:49:37 GMT'})
+        cache = httpcache.HTTPCache()
+
+        assert cache.store(resp, req)
+        assert cache.retrieve(req) is not None
+
+
+class TestFreshness(object):
+    """
+    Tests for the RFC 7234 age and freshness calculations.
+    """
+    def expiry(self, request_time=None, **headers):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers=headers)
+        req = MockRequestsPreparedRequest()
+
+        if not cache.store(resp, req, request_time=request_time):
+            return None
+        return cache._cache[cache.make_key(resp.url, '')]['expiry']
+
+    def http_date(self, offset):
+        return build_http_date(time.time() + offset)
+
+    def test_age_header_reduces_lifetime(self):
+        expiry = self.expiry(**{'Cache-Control': 'max-age=100', 'Age': '40'})
+        assert abs(expiry - (clock() + 60)) <= 1
+
+    def test_responses_stale_on_arrival_are_not_cached(self):
+        expiry = self.expiry(**{'Cache-Control': 'max-age=100', 'Age': '200'})
+        assert expiry is None
+
+    def test_server_clock_ahead_doesnt_extend_lifetime(self):
+        expiry = self.expiry(
+            Date=self.http_date(3600), Expires=self.http_date(3700))
+        assert abs(expiry - (clock() + 100)) <= 1
+
+    def test_server_clock_behind_ages_response(self):
+        expiry = self.expiry(**{
+            'Date': self.http_date(-3600), 'Cache-Control': 'max-age=7200'})
+        assert abs(expiry - (clock() + 3600)) <= 1
+
+    def test_request_time_counts_towards_age(self):
+        expiry = self.expiry(
+            request_time=clock() - 10, **{'Cache-Control': 'max-age=100'})
+        assert abs(expiry - (clock() + 90)) <= 1
+
+    def test_corrected_initial_age(self):
+        assert corrected_initial_age(0, None, 100, 100) == 0
+        assert corrected_initial_age(5, 90, 98, 100) == 10
+        assert corrected_initial_age(5, 99, 95, 100) == 10
+        assert corrected_initial_age(0, 200, 100, 100) == 0
+
+
+class TestCachedResponses(object):
+    """
+    Tests for the responses handed out on cache hits.
+    """
+    def store_and_retrieve(self, content=b'hello'):
+        resp = MockRequestsResponse(
+            headers={'Cache-Control': 'max-age=3600'}, content=content)
+        cache = httpcache.HTTPCache()
+        assert cache.store(resp, MockRequestsPreparedRequest())
+        return resp, cache
+
+    def test_each_hit_gets_a_new_response(self):
+        resp, cache = self.store_and_retrieve()
+        req = MockRequestsPreparedRequest()
+
+        first = cache.retrieve(req)
+        second = cache.retrieve(req)
+
+        assert first is not second
+        assert first is not resp
+        assert first.request is req
+
+    def test_hits_share_the_body_and_headers(self):
+        resp, cache = self.store_and_retrieve()
+        req = MockRequestsPreparedRequest()
+
+        first = cache.retrieve(req)
+        second = cache.retrieve(req)
+
+        assert first.content is second.content
+        assert first.headers is second.headers
+
+    def test_cached_headers_are_immutable(self):
+        resp, cache = self.store_and_retrieve()
+        hit = cache.retrieve(MockRequestsPreparedRequest())
+
+        assert hit.headers['cache-control'] == 'max-age=3600'
+        with pytest.raises(TypeError):
+            hit.headers['Cache-Control'] = 'no-cache'
+
+    def test_copied_headers_are_mutable(self):
+        resp, cache = self.store_and_retrieve()
+        hit = cache.retrieve(MockRequestsPreparedRequest())
+
+        headers = hit.headers.copy()
+        headers['Cache-Control'] = 'no-cache'
+        assert headers['cache-control'] == 'no-cache'
+        assert hit.headers['Cache-Control'] == 'max-age=3600'
+
+        del headers['CACHE-CONTROL']
+        assert 'Cache-Control' not in headers
+        assert 'Cache-Control' in hit.headers
+
+    def test_hits_have_their_own_cookies(self):
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        resp.cookies = requests.cookies.RequestsCookieJar()
+        resp.cookies.set('session', 'abc')
+        cache = httpcache.HTTPCache()
+        assert cache.store(resp, MockRequestsPreparedRequest())
+        resp.cookies.set('session', 'changed')
+
+        req = MockRequestsPreparedRequest()
+        first = cache.retrieve(req)
+        first.cookies.set('session', 'mine')
+        first.cookies.set('other', 'mine')
+
+        second = cache.retrieve(req)
+        assert second.cookies.get_dict() == {'session': 'abc'}
+
+    def test_changing_the_original_response_doesnt_change_the_cache(self):
+        resp, cache = self.store_and_retrieve()
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.status_code = 500
+
+        hit = cache.retrieve(MockRequestsPreparedRequest())
+        assert hit.headers['Cache-Control'] == 'max-age=3600'
+        assert hit.status_code == 200
+
+    def test_reading_raw_doesnt_affect_other_hits(self):
+        resp, cache = self.store_and_retrieve()
+        req = MockRequestsPreparedRequest()
+
+        assert cache.retrieve(req).raw.read() == b'hello'
+        assert cache.retrieve(req).raw.read() == b'hello'
+
+
+class TestLocalResponses(object):
+    """
+    Tests for answering HEAD and conditional requests from cached GETs.
+    """
+    @pytest.fixture
+    def cache(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(content=b'body', headers={
+            'Cache-Control': 'max-age=3600',
+            'Content-Length': '4',
+            'ETag': '"abc"',
+            'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'})
+        assert cache.store(resp, MockRequestsPreparedRequest())
+        return cache
+
+    def test_head_is_served_from_get(self, cache):
+        resp = cache.retrieve(MockRequestsPreparedRequest(method='HEAD'))
+
+        assert resp.status_code == 200
+        assert resp.content == b''
+        assert resp.headers['Content-Length'] == '4'
+        assert cache.retrieve(MockRequestsPreparedRequest()).content == b'body'
+
+    def test_head_responses_dont_replace_gets(self, cache):
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=60'})
+        resp.request.method = 'HEAD'
+
+        assert not cache.store(resp, MockRequestsPreparedRequest())
+        assert cache.retrieve(MockRequestsPreparedRequest()).content == b'body'
+
+    def test_head_failures_arent_served_to_gets(self):
+        cache = httpcache.HTTPCache(negative_ttls={404: 60})
+        resp = MockRequestsResponse(status_code=404)
+        resp.request.method = 'HEAD'
+
+        assert not cache.store(resp, MockRequestsPreparedRequest())
+        assert cache.retrieve(MockRequestsPreparedRequest()) is None
+
+    @pytest.mark.parametrize('headers', [
+        {'If-None-Match': '"abc"'},
+        {'If-None-Match': '"x", W/"abc"'},
+        {'If-Modified-Since': 'Sun, 06 Nov 1994 08:49:37 GMT'},
+        {'If-Modified-Since': 'Mon, 07 Nov 1994 08:49:37 GMT'},
+    ])
+    def test_matching_conditionals_get_304s(self, cache, headers):
+        resp = cache.retrieve(MockRequestsPreparedRequest(headers=headers))
+
+        assert resp.status_code == 304
+        assert resp.content == b''
+        assert resp.headers == {
+            'Cache-Control': 'max-age=3600', 'ETag': '"abc"',
+            'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'}
+
+    @pytest.mark.parametrize('headers', [
+        {'If-None-Match': '"xyz"'},
+        {'If-None-Match': '"xyz"',
+         'If-Modified-Since': 'Mon, 07 Nov 1994 08:49:37 GMT'},
+        {'If-Modified-Since': 'Sat, 05 Nov 1994 08:49:37 GMT'},
+    ])
+    def test_other_conditionals_get_the_entry(self, cache, headers):
+        resp = cache.retrieve(MockRequestsPreparedRequest(headers=headers))
+
+        assert resp.status_code == 200
+        assert resp.content == b'body'
+
+
+class TestRanges(object):
+    """
+    Tests for the byte range utilities.
+    """
+    def test_parse_content_range(self):
+        assert parse_content_range('bytes 0-99/1000') == (0, 99, 1000)
+        assert parse_content_range('bytes 10-19/*') == (10, 19, None)
+        assert parse_content_range('bytes 10-9/1000') is None
+        assert parse_content_range('bytes 0-1000/1000') is None
+        assert parse_content_range(None) is None
+
+    def test_parse_range_header(self):
+        assert parse_range_header('bytes=0-99', 1000) == (0, 99)
+        assert parse_range_header('bytes=900-', 1000) == (900, 999)
+        assert parse_range_header('bytes=-100', 1000) == (900, 999)
+        assert parse_range_header('bytes=990-2000', 1000) == (990, 999)
+        assert parse_range_header('bytes=1000-', 1000) is None
+        assert parse_range_header('bytes=0-1,5-6', 1000) is None
+        assert parse_range_header('bytes=0-99', None) is None
+
+    def test_fragments_are_coalesced(self):
+        fragments = add_fragment([], 10, b'klmno')
+        fragments = add_fragment(fragments, 0, b'abcde')
+        assert fragments == [[0, b'abcde'], [10, b'klmno']]
+
+        fragments = add_fragment(fragments, 5, b'fghij')
+        assert fragments == [[0, b'abcdefghijklmno']]
+
+    def test_read_range_needs_full_coverage(self):
+        fragments = [[0, b'abcde'], [10, b'klmno']]
+        assert read_range(fragments, 1, 3) == b'bcd'
+        assert read_range(fragments, 12, 14) == b'mno'
+        assert read_range(fragments, 3, 11) is None
+
+
+class TestRangeCaching(object):
+    """
+    Tests for caching of 206 Partial Content responses.
+    """
+    def partial(self, content_range, content, **headers):
+        headers['Content-Range'] = content_range
+        headers.setdefault('Cache-Control', 'max-age=3600')
+        return MockRequestsResponse(
+            status_code=206, headers=headers, content=content)
+
+    def test_partial_responses_are_served_for_covered_ranges(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-4'})
+
+        assert cache.store(self.partial('bytes 0-4/20', b'abcde'), req)
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=1-3'})
+        resp = cache.retrieve(req)
+        assert resp.status_code == 206
+        assert resp.content == b'bcd'
+        assert resp.headers['Content-Range'] == 'bytes 1-3/20'
+
+    def test_uncovered_ranges_miss(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-4'})
+        assert cache.store(self.partial('bytes 0-4/20', b'abcde'), req)
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=3-8'})
+        assert cache.retrieve(req) is None
+        assert 'If-Modified-Since' not in req.headers
+        assert cache.retrieve(MockRequestsPreparedRequest()) is None
+
+    def test_fragments_are_merged(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-4'})
+
+        assert cache.store(self.partial('bytes 0-4/20', b'abcde'), req)
+        assert cache.store(self.partial('bytes 5-9/20', b'fghij'), req)
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=3-8'})
+        assert cache.retrieve(req).content == b'defghi'
+
+    def test_fragments_from_different_representations_are_not_merged(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-4'})
+
+        assert cache.store(
+            self.partial('bytes 0-4/20', b'abcde', ETag='"a"'), req)
+        assert cache.store(
+            self.partial('bytes 5-9/20', b'fghij', ETag='"b"'), req)
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-1'})
+        assert cache.retrieve(req) is None
+
+    def test_complete_fragments_become_a_full_response(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-4'})
+
+        assert cache.store(self.partial('bytes 0-4/10', b'abcde'), req)
+        assert cache.store(self.partial('bytes 5-9/10', b'fghij'), req)
+
+        resp = cache.retrieve(MockRequestsPreparedRequest())
+        assert resp.status_code == 200
+        assert resp.content == b'abcdefghij'
+        assert 'Content-Range' not in resp.headers
+
+    def test_full_responses_answer_range_requests(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(
+            headers={'Cache-Control': 'max-age=3600'}, content=b'abcdefghij')
+        assert cache.store(resp, MockRequestsPreparedRequest())
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=-3'})
+        partial = cache.retrieve(req)
+        assert partial.status_code == 206
+        assert partial.content == b'hij'
+        assert partial.headers['Content-Range'] == 'bytes 7-9/10'
+        assert resp.status_code == 200
+        assert resp.content == b'abcdefghij'
+
+    def test_encoded_responses_dont_answer_range_requests(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(
+            headers={'Cache-Control': 'max-age=3600',
+                     'Content-Encoding': 'gzip'},
+            content=b'abcdefghij')
+        assert cache.store(resp, MockRequestsPreparedRequest())
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-3'})
+        assert cache.retrieve(req) is None
+        assert cache.retrieve(MockRequestsPreparedRequest()) is not None
+
+    def test_encoded_partial_responses_arent_stored(self):
+        cache = httpcache.HTTPCache()
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-4'})
+        resp = self.partial('bytes 0-4/20', b'abcde', **{
+            'Content-Encoding': 'gzip'})
+
+        assert not cache.store(resp, req)
+        assert cache.retrieve(req) is None
+
+    def test_stale_full_responses_dont_answer_range_requests(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(content=b'abcdefghij')
+        assert cache.store(resp, MockRequestsPreparedRequest())
+
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-3'})
+        assert cache.retrieve(req) is None
+        assert 'If-Modified-Since' not in req.headers
+
+
+class TestSnapshots(object):
+    """
+    Tests for snapshotting and loading the cache.
+    """
+    def test_snapshots_round_trip(self, tmpdir):
+        path = str(tmpdir.join('cache.snapshot'))
+        req = MockRequestsPreparedRequest()
+        cache = httpcache.HTTPCache()
+
+        for i in range(3):
+            resp = MockRequestsResponse(
+                headers={'Cache-Control': 'max-age=3600'}, content=b'body')
+            resp.url += str(i)
+            assert cache.store(resp, req)
+
+        assert cache.snapshot(path) == 3
+
+        new_cache = httpcache.HTTPCache()
+        assert new_cache.load(path) == 3
+        assert list(new_cache._cache.keys()) == list(cache._cache.keys())
+
+        key = new_cache.make_key('http://www.test.com/0', '')
+        assert new_cache._cache[key]['response'].content == b'body'
+
+    def test_expired_entries_are_not_loaded(self, tmpdir):
+        path = str(tmpdir.join('cache.snapshot'))
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        cache = httpcache.HTTPCache()
+        assert cache.store(resp, MockRequestsPreparedRequest())
+
+        key = cache.make_key(resp.url, '')
+        cache._cache[key]['expiry'] = int(time.time()) - 1
+        cache.snapshot(path)
+
+        assert httpcache.HTTPCache().load(path) == 0
+
+    def test_loading_respects_capacity(self, tmpdir):
+        path = str(tmpdir.join('cache.snapshot'))
+        req = MockRequestsPreparedRequest()
+        cache = httpcache.HTTPCache(capacity=10)
+
+        for i in range(10):
+            resp = MockRequestsResponse(
+                headers={'Cache-Control': 'max-age=3600'})
+            resp.url += str(i)
+            assert cache.store(resp, req)
+        cache.snapshot(path)
+
+        new_cache = httpcache.HTTPCache(capacity=4)
+        new_cache.load(path)
+        assert len(new_cache._cache) == 4
+
+    def test_loading_rejects_other_files(self, tmpdir):
+        path = tmpdir.join('not.snapshot')
+        path.write('hello')
+
+        with pytest.raises(ValueError):
+            httpcache.HTTPCache().load(str(path))
+
+
+class TestSerializer(object):
+    """
+    Tests for the binary format used by out-of-process backends.
+    """
+    def entry(self, **extra):
+        resp = MockRequestsResponse(
+            headers={'Cache-Control': 'max-age=3600', 'ETag': '"abc"'},
+            content=b'body')
+        resp.reason = 'OK'
+        entry = {'response': resp, 'creation': 1000, 'expiry': 4600}
+        entry.update(extra)
+        return entry
+
+    def test_round_trip(self):
+        entry = serializer.loads(serializer.dumps(self.entry()))
+        resp = entry['response']
+
+        assert entry['creation'] == 1000
+        assert entry['expiry'] == 4600
+        assert resp.status_code == 200
+        assert resp.reason == 'OK'
+        assert resp.encoding is None
+        assert resp.url == 'http://www.test.com/'
+        assert resp.content == b'body'
+        assert resp.headers['etag'] == '"abc"'
+        assert resp.headers == {
+            'Cache-Control': 'max-age=3600', 'ETag': '"abc"'}
+
+    def test_optional_fields_round_trip(self):
+        entry = serializer.loads(serializer.dumps(self.entry(
+            expiry=None, failures=3, fragments=[[0, b'ab'], [10, b'cd']],
+            length=20)))
+
+        assert entry['expiry'] is None
+        assert entry['failures'] == 3
+        assert entry['fragments'] == [[0, b'ab'], [10, b'cd']]
+        assert entry['length'] == 20
+
+    def test_headers_are_decoded_lazily(self):
+        headers = serializer.loads(
+            serializer.dumps(self.entry()))['response'].headers
+
+        assert '_store' not in headers.__dict__
+        assert 'ETag' in headers
+        assert '_store' in headers.__dict__
+
+    def test_rejects_other_data(self):
+        data = serializer.dumps(self.entry())
+
+        for bad in (b'', b'garbage' * 20, data[:-1], data + b'x',
+                    data[:3] + b'\x02' + data[4:]):
+            with pytest.raises(ValueError):
+                serializer.loads(bad)
+
+    def test_out_of_process_backends_get_bytes(self):
+        cache = httpcache.HTTPCache(cache=mockcache.Client(['127.0.0.1:0']))
+        resp = MockRequestsResponse(
+            headers={'Cache-Control': 'max-age=3600'}, content=b'body')
+        assert cache.store(resp, MockRequestsPreparedRequest())
+
+        key = cache.make_key(resp.url, '')
+        assert isinstance(cache._cache.get(key), bytes)
+        assert cache.retrieve(MockRequestsPreparedRequest()).content == b'body'
+
+    def test_undecodable_entries_are_misses(self):
+        backend = mockcache.Client(['127.0.0.1:0'])
+        cache = httpcache.HTTPCache(cache=backend)
+        backend.set(cache.make_key('http://www.test.com/', ''), b'garbage')
+
+        assert cache.retrieve(MockRequestsPreparedRequest()) is None
+
+
+class TestBodySharing(object):
+    """
+    Tests for sharing identical bodies between cache entries.
+    """
+    def store(self, cache, body, url='http://www.test.com/', language=''):
+        resp = MockRequestsResponse(
+            url=url, headers={'Cache-Control': 'max-age=3600'},
+            content=body)
+        req = MockRequestsPreparedRequest(
+            url=url, headers={'Accept-Language': language})
+        assert cache.store(resp, req)
+        return req
+
+    def test_variants_share_a_body(self):
+        cache = httpcache.HTTPCache()
+        en = self.store(cache, b'x' * 100, language='en')
+        fr = self.store(cache, b'x' * 100, language='fr')
+
+        assert cache.retrieve(en).content is cache.retrieve(fr).content
+        assert cache.body_report() == {
+            'bodies': 1, 'references': 2, 'unique_bytes': 100,
+            'referenced_bytes': 200, 'saved_bytes': 100}
+
+    def test_bodies_are_released(self):
+        cache = httpcache.HTTPCache()
+        self.store(cache, b'body', url='http://www.test.com/a')
+        self.store(cache, b'body', url='http://www.test.com/b')
+        self.store(cache, b'other', url='http://www.test.com/b')
+
+        assert cache.body_report()['bodies'] == 2
+
+        cache.invalidate('http://www.test.com/a')
+        cache.invalidate('http://www.test.com/b')
+        assert cache.body_report() == {
+            'bodies': 0, 'references': 0, 'unique_bytes': 0,
+            'referenced_bytes': 0, 'saved_bytes': 0}
+
+    def test_max_bytes_counts_shared_bodies_once(self):
+        cache = httpcache.HTTPCache(max_bytes=10)
+        for language in ('en', 'fr', 'de'):
+            self.store(cache, b'abcd', language=language)
+        assert len(cache._cache) == 3
+
+        self.store(cache, b'efgh', url='http://www.test.com/other')
+        assert len(cache._cache) == 4
+
+        self.store(cache, b'ijkl', url='http://www.test.com/last')
+        assert cache.body_report()['unique_bytes'] == 8
+        assert len(cache._cache) == 2
+
+    def test_max_bytes_counts_fragments(self):
+        cache = httpcache.HTTPCache(max_bytes=1000)
+        for i in range(20):
+            url = 'http://www.test.com/%d' % i
+            resp = MockRequestsResponse(
+                url=url, status_code=206, content=b'%04d' % i * 125,
+                headers={'Cache-Control': 'max-age=3600',
+                         'Content-Range': 'bytes 0-499/10000'})
+            req = MockRequestsPreparedRequest(
+                url=url, headers={'Range': 'bytes=0-499'})
+            assert cache.store(resp, req)
+
+        assert len(cache._cache) == 2
+        assert cache.body_report()['referenced_bytes'] == 1000
+
+        cache.invalidate('http://www.test.com/18')
+        cache.invalidate('http://www.test.com/19')
+        assert cache.body_report()['referenced_bytes'] == 0
+
+    def test_dropped_writes_dont_keep_bodies(self):
+        class BlockingDict(RecentOrderedDict):
+            release = threading.Event()
+
+            def set(self, key, value):
+                self.release.wait(5)
+                super(BlockingDict, self).set(key, value)
+
+        cache = httpcache.HTTPCache(
+            cache=BlockingDict(), write_behind=True, max_pending_writes=1)
+        for i in range(5):
+            for body in (b'body %d' % i, b'new body %d' % i):
+                resp = MockRequestsResponse(
+                    headers={'Cache-Control': 'max-age=3600'}, content=body)
+                req = MockRequestsPreparedRequest(
+                    headers={'Accept-Language': str(i)})
+                cache.store(resp, req)
+
+        BlockingDict.release.set()
+        cache.close()
+
+        report = cache.body_report()
+        assert report['references'] == len(cache._cache)
+        assert report['bodies'] == len(cache._cache)
+
+    def test_out_of_process_backends_dont_share(self):
+        cache = httpcache.HTTPCache(cache=mockcache.Client(['127.0.0.1:0']))
+        assert cache.body_report() is None
+
+
+class TTLBackend(object):
+    """
+    A backend that records the TTLs it's given.
+    """
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.deleted = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = value
+        self.ttls[key] = ttl
+
+    def delete(self, key):
+        self.deleted.append(key)
+        del self.data[key]
+
+
+class SlowRoundTrips(TTLBackend):
+    """
+    A backend whose every call takes a network round trip.
+    """
+    def get(self, key):
+        time.sleep(0.05)
+        return super(SlowRoundTrips, self).get(key)
+
+
+class TestConcurrency(object):
+    """
+    Tests that threads sharing a cache don't wait for each other's round
+    trips to an out-of-process backend.
+    """
+    def test_lookups_run_concurrently(self):
+        cache = httpcache.HTTPCache(cache=SlowRoundTrips())
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        assert cache.store(resp, resp.request)
+
+        hits = []
+
+        def lookup():
+            hits.append(cache.retrieve(MockRequestsPreparedRequest()))
+
+        threads = [threading.Thread(target=lookup) for i in range(8)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert all(hit is not None for hit in hits)
+        assert time.time() - start < 0.3
+        assert cache.top_keys()['hits'] == 8
+
+
+class TestTTLPushDown(object):
+    """
+    Tests for handing TTLs to backends that expire entries themselves.
+    """
+    def store(self, cache, status_code=200, **headers):
+        resp = MockRequestsResponse(status_code=status_code, headers=headers)
+        assert cache.store(resp, MockRequestsPreparedRequest())
+        return cache.make_key(resp.url, '')
+
+    def test_ttl_follows_expiry(self):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(cache=backend, stale_grace=30)
+        key = self.store(cache, **{'Cache-Control': 'max-age=3600'})
+
+        assert 3629 <= backend.ttls[key] <= 3630
+
+    def test_long_ttls_are_absolute(self):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(cache=backend)
+        key = self.store(cache, **{'Cache-Control': 'max-age=31536000'})
+
+        assert backend.ttls[key] >= time.time() + 31535000
+
+    def test_negative_entries_outlive_their_expiry(self):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(
+            cache=backend, negative_ttls={404: 5}, negative_max_ttl=60)
+        key = self.store(cache, status_code=404)
+
+        assert 64 <= backend.ttls[key] <= 65
+
+    def test_fractional_ttls_are_rounded_up(self):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(
+            cache=backend, negative_ttls={404: 0.5},
+            policy=httpcache.CachePolicy([
+                httpcache.Rule('www.test.com', ttl=1.5)]))
+        key = self.store(cache)
+        assert cache.retrieve(MockRequestsPreparedRequest()) is not None
+        assert backend.ttls[key] == 2
+
+        resp = MockRequestsResponse(
+            status_code=404, url='http://www.test.com/gone')
+        assert cache.store(resp, MockRequestsPreparedRequest(url=resp.url))
+        entry = cache._get(cache.make_key(resp.url, ''))
+        assert entry['expiry'] - entry['creation'] == 1
+
+    def test_entries_without_expiry_get_no_ttl(self):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(cache=backend)
+        key = self.store(
+            cache, **{'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'})
+
+        assert backend.ttls[key] is None
+
+    def test_backends_without_ttls_still_work(self):
+        backend = RecentOrderedDict()
+        backend.in_process = False
+        cache = httpcache.HTTPCache(cache=backend)
+        self.store(cache, **{'Cache-Control': 'max-age=3600'})
+
+        assert cache.retrieve(MockRequestsPreparedRequest()) is not None
+
+    def test_expired_entries_are_left_to_the_backend(self, monkeypatch):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(cache=backend, stale_grace=30)
+        self.store(cache, **{'Cache-Control': 'max-age=60'})
+
+        now = clock()
+        monkeypatch.setattr(httpcache.cache, 'clock', lambda: now + 61)
+        assert cache.retrieve(MockRequestsPreparedRequest()) is None
+        assert not backend.deleted
+
+    def test_expired_ranges_are_left_to_the_backend(self, monkeypatch):
+        backend = TTLBackend()
+        cache = httpcache.HTTPCache(cache=backend, stale_grace=30)
+        self.store(cache, **{'Cache-Control': 'max-age=60'})
+
+        now = clock()
+        monkeypatch.setattr(httpcache.cache, 'clock', lambda: now + 61)
+        req = MockRequestsPreparedRequest(headers={'Range': 'bytes=0-3'})
+        assert cache.retrieve(req) is None
+        assert not backend.deleted
+
+
+class TestMemoryGovernor(object):
+    """
+    Tests for adapting the capacity of the cache to memory pressure.
+    """
+    def governor(self, usage, **kwargs):
+        return MemoryGovernor(
+            sampler=lambda: (usage[0], 100), interval=0, **kwargs)
+
+    def test_capacity_follows_pressure(self):
+        usage = [90]
+        governor = self.governor(usage)
+
+        assert governor.capacity(100) == 75
+        assert governor.capacity(100) == 56
+
+        # Between the watermarks, nothing changes.
+        usage[0] = 80
+        assert governor.capacity(100) == 56
+
+        usage[0] = 50
+        assert governor.capacity(100) == 81
+        assert governor.capacity(100) == 100
+        assert governor.capacity(100) == 100
+
+    def test_capacity_has_a_floor(self):
+        governor = self.governor([100], min_fraction=0.2)
+
+        for i in range(20):
+            capacity = governor.capacity(50)
+        assert capacity == 10
+
+    def test_samples_are_rate_limited(self):
+        samples = []
+        governor = MemoryGovernor(
+            sampler=lambda: samples.append(1) or (90, 100), interval=60)
+
+        governor.capacity(100)
+        governor.capacity(100)
+        assert len(samples) == 1
+
+    def test_unknown_pressure_changes_nothing(self):
+        governor = MemoryGovernor(sampler=lambda: (90, None), interval=0)
+
+        assert governor.capacity(100) == 100
+        assert governor.pressure is None
+
+    def test_watermarks_must_be_ordered(self):
+        with pytest.raises(ValueError):
+            MemoryGovernor(high=0.5, low=0.7)
+
+    def test_reads_cgroups(self, tmpdir):
+        assert cgroup_memory(str(tmpdir)) is None
+
+        tmpdir.join('memory').mkdir()
+        tmpdir.join('memory', 'memory.usage_in_bytes').write('300\n')
+        tmpdir.join('memory', 'memory.limit_in_bytes').write(
+            '9223372036854771712\n')
+        assert cgroup_memory(str(tmpdir)) == (300, None)
+
+        tmpdir.join('memory.current').write('100\n')
+        tmpdir.join('memory.max').write('max\n')
+        assert cgroup_memory(str(tmpdir)) == (100, None)
+
+        tmpdir.join('memory.max').write('1000\n')
+        assert cgroup_memory(str(tmpdir)) == (100, 1000)
+
+    @pytest.mark.skipif(
+        not os.path.exists('/proc/self/statm'), reason="needs procfs")
+    def test_reads_process_rss(self):
+        assert process_rss() > 0
+
+    def test_cache_evicts_coldest_entries_under_pressure(self):
+        usage = [10]
+        cache = httpcache.HTTPCache(
+            capacity=8, governor=self.governor(usage))
+        req = MockRequestsPreparedRequest()
+
+        for i in range(8):
+            resp = MockRequestsResponse(
+                url='http://www.test.com/%d' % i,
+                headers={'Cache-Control': 'max-age=3600'})
+            assert cache.store(resp, req)
+        cache.retrieve(MockRequestsPreparedRequest(
+            url='http://www.test.com/0'))
+
+        usage[0] = 95
+        resp = MockRequestsResponse(
+            url='http://www.test.com/8',
+            headers={'Cache-Control': 'max-age=3600'})
+        cache.store(resp, req)
+
+        assert len(cache._cache) == 6
+        assert cache._index.keys_for_url('http://www.test.com/0')
+        assert not cache._index.keys_for_url('http://www.test.com/1')
+
+
+class TestHotKeys(object):
+    """
+    Tests for counting the busiest keys and the stores that go to waste.
+    """
+    def test_heavy_hitters_are_found(self):
+        stats = KeyStats(size=8)
+        for i in range(1000):
+            stats.lookup('hot', '/hot', True)
+            if i % 2:
+                stats.lookup('warm', '/warm', True)
+            stats.lookup('cold%d' % i, '/cold/%d' % i, False)
+
+        top = stats.top(2)
+        assert [item['key'] for item in top] == ['hot', 'warm']
+        assert top[0]['count'] - top[0]['error'] <= 1000 <= top[0]['count']
+        assert top[0]['hits'] == 1000
+        assert len(stats._counters) == 8
+
+    def test_counts_are_exact_below_capacity(self):
+        stats = KeyStats(size=8)
+        for key, times in (('a', 5), ('b', 3), ('c', 1)):
+            for i in range(times):
+                stats.lookup(key, '/' + key, False)
+        stats.stored('b', '/b')
+
+        counts = [(item['key'], item['count'], item['error'])
+                  for item in stats.top()]
+        assert counts == [('a', 5, 0), ('b', 4, 0), ('c', 1, 0)]
+
+    def test_buckets_stay_consistent(self):
+        stats = KeyStats(size=3)
+        for key in 'aabcdddeab':
+            stats.lookup(key, '/' + key, False)
+
+        buckets = {}
+        for key, counter in stats._counters.items():
+            buckets.setdefault(counter.count, set()).add(key)
+        assert buckets == stats._buckets
+        assert stats._min == min(buckets)
+        assert sum(c.count for c in stats._counters.values()) == 10
+
+    def test_unserved_stores_are_wasted(self):
+        stats = KeyStats()
+        stats.stored('a', '/a')
+        stats.stored('a', '/a')
+        stats.stored('b', '/b')
+        stats.lookup('b', '/b', True)
+        stats.removed('b')
+        stats.stored('c', '/c')
+        stats.removed('c', evicted=True)
+        stats.removed('c', evicted=True)
+
+        assert stats.wasted_stores == 2
+        assert stats.evicted_unused == 1
+
+    def test_unserved_stores_are_bounded(self):
+        stats = KeyStats(size=4, max_unserved=100)
+        for i in range(1000):
+            stats.stored('key-%d' % i, '/%d' % i)
+
+        assert len(stats._unhit) == 100
+        stats.removed('key-0')
+        stats.removed('key-999')
+        assert stats.wasted_stores == 1
+
+    def test_cache_reports_top_keys(self):
+        cache = httpcache.HTTPCache(capacity=2)
+        for path in ('/a', '/b', '/c'):
+            resp = MockRequestsResponse(
+                url='http://www.test.com' + path,
+                headers={'Cache-Control': 'max-age=3600'})
+            assert cache.store(resp, resp.request)
+
+        for i in range(3):
+            cache.retrieve(MockRequestsPreparedRequest(
+                url='http://www.test.com/c'))
+        cache.retrieve(MockRequestsPreparedRequest(
+            url='http://www.test.com/a'))
+
+        report = cache.top_keys(1)
+        assert report['lookups'] == 4
+        assert report['hits'] == 3
+        assert report['stores'] == 3
+        assert report['wasted_stores'] == 1
+        assert report['evicted_unused'] == 1
+        assert report['keys'][0]['url'] == 'http://www.test.com/c'
+        assert report['keys'][0]['count'] == 4
+
+    def test_invalidated_entries_are_wasted(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        assert cache.store(resp, resp.request)
+        assert cache.invalidate(resp.url) == 1
+
+        assert cache.top_keys()['wasted_stores'] == 1
+
+    def test_can_be_turned_off(self):
+        cache = httpcache.HTTPCache(hot_keys=None)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+        assert cache.store(resp, resp.request)
+        assert cache.retrieve(MockRequestsPreparedRequest()) is not None
+        assert cache.top_keys() is None
+
+
+class StandInMemcached(object):
+    """
+    An in-process stand-in for a memcached server shared by several
+    processes, with atomic ``add`` and expiring keys.
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.data.get(key, (None, None))
+            if expires and expires <= time.time():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=0):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl if ttl else None)
+        return True
+
+    def add(self, key, value, ttl=0):
+        if self.get(key) is not None:
+            return False
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = (value, time.time() + ttl if ttl else None)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+@pytest.fixture
+def origin(request, monkeypatch):
+    """
+    Puts a :class:`MockOrigin` behind every HTTPAdapter. Parametrise it
+    indirectly with a dictionary of the arguments to give the origin.
+    """
+    server = MockOrigin(**getattr(request, 'param', {}))
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', server.send)
+    return server
+
+
+class TestLeases(object):
+    """
+    Tests for coordinating misses between processes with leases.
+    """
+    SLOW = {'delay': 0.2, 'headers': {'Cache-Control': 'max-age=60'}}
+
+    def test_one_lease_at_a_time(self):
+        backend = StandInMemcached()
+        first = httpcache.HTTPCache(cache=backend, lease_ttl=5)
+        second = httpcache.HTTPCache(cache=backend, lease_ttl=5)
+        req = MockRequestsPreparedRequest()
+
+        token = first.acquire_lease(req)
+        assert token is not None
+        assert second.acquire_lease(req) is None
+
+        first.release_lease(req, token)
+        assert second.acquire_lease(req) is not None
+
+    def test_leases_expire_if_the_holder_dies(self):
+        backend = StandInMemcached()
+        first = httpcache.HTTPCache(cache=backend, lease_ttl=0.05)
+        second = httpcache.HTTPCache(cache=backend, lease_ttl=5)
+        req = MockRequestsPreparedRequest()
+
+        token = first.acquire_lease(req)
+        time.sleep(0.1)
+        assert second.acquire_lease(req) is not None
+
+        # The first holder's late release leaves the new lease alone.
+        first.release_lease(req, token)
+        assert first.acquire_lease(req) is None
+
+    def test_leases_need_add(self):
+        cache = httpcache.HTTPCache(lease_ttl=5)
+        assert not cache.leases
+
+    @pytest.mark.parametrize('origin', [SLOW], indirect=True)
+    def test_only_one_process_fetches(self, origin):
+        backend = StandInMemcached()
+        pods = [httpcache.CachingHTTPAdapter(cache=backend, lease_ttl=5)
+                for i in range(20)]
+        start = threading.Event()
+        bodies = []
+
+        def fetch(pod):
+            start.wait()
+            bodies.append(pod.send(requests.Request(
+                'GET', 'http://www.test.com/').prepare()).content)
+
+        threads = [threading.Thread(target=fetch, args=(pod,))
+                   for pod in pods]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        assert origin.urls == ['http://www.test.com/']
+        assert bodies == [b'body'] * 20
+
+    @pytest.mark.parametrize('origin', [SLOW], indirect=True)
+    def test_waiters_get_stale_copies(self, origin, monkeypatch):
+        backend = StandInMemcached()
+        pod = httpcache.CachingHTTPAdapter(
+            cache=backend, lease_ttl=5, stale_grace=60)
+        req = requests.Request('GET', 'http://www.test.com/').prepare()
+        pod.send(req)
+
+        now = clock()
+        monkeypatch.setattr(httpcache.cache, 'clock', lambda: now + 120)
+        other = httpcache.CachingHTTPAdapter(cache=backend, lease_ttl=5)
+        assert other.cache.acquire_lease(req) is not None
+
+        assert pod.send(req).content == b'body'
+        assert len(origin.sent) == 1
+
+    @pytest.mark.parametrize('origin', [
+        {'delay': 0.1, 'headers': {'Cache-Control': 'no-store'}}],
+        indirect=True)
+    def test_waiters_stop_when_nothing_is_stored(self, origin):
+        backend = StandInMemcached()
+        pods = [httpcache.CachingHTTPAdapter(cache=backend, lease_ttl=5)
+                for i in range(5)]
+        times = []
+
+        def fetch(pod):
+            start = time.time()
+            pod.send(requests.Request('GET', 'http://www.test.com/').prepare())
+            times.append(time.time() - start)
+
+        threads = [threading.Thread(target=fetch, args=(pod,))
+                   for pod in pods]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert max(times) < 1
+
+    def test_no_leases_for_uncacheable_requests(self):
+        backend = StandInMemcached()
+        cache = httpcache.HTTPCache(
+            cache=backend, lease_ttl=5,
+            policy=httpcache.CachePolicy([
+                httpcache.Rule('www.test.com', cache=False)]))
+
+        assert not cache.wants_lease(MockRequestsPreparedRequest())
+        other = 'http://www.other.com/'
+        assert not cache.wants_lease(
+            MockRequestsPreparedRequest(url=other, method='HEAD'))
+        assert cache.wants_lease(MockRequestsPreparedRequest(url=other))
+
+
+class SlowBackend(object):
+    """
+    An out-of-process style backend whose writes block until released.
+    """
+    def __init__(self):
+        self.data = {}
+        self.batches = []
+        self.release = threading.Event()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.set_multi({key: value})
+
+    def set_multi(self, mapping):
+        self.release.wait(5)
+        self.batches.append(sorted(mapping))
+        self.data.update(mapping)
+
+    def delete(self, key):
+        del self.data[key]
+
+
+class TestWriteBehind(object):
+    """
+    Tests for writing entries to the backing cache in the background.
+    """
+    def store(self, cache, path=''):
+        resp = MockRequestsResponse(
+            headers={'Cache-Control': 'max-age=3600'}, content=b'body')
+        resp.url += path
+        return cache.store(resp, MockRequestsPreparedRequest(url=resp.url))
+
+    def test_stores_dont_wait_for_the_backend(self):
+        backend = SlowBackend()
+        cache = httpcache.HTTPCache(cache=backend, write_behind=True)
+
+        assert self.store(cache)
+        assert not backend.data
+
+        resp = cache.retrieve(MockRequestsPreparedRequest())
+        assert resp.content == b'body'
+
+        backend.release.set()
+        assert cache.flush(5)
+        key = cache.make_key('http://www.test.com/', '')
+        assert isinstance(backend.data[key], bytes)
+
+    def test_writes_are_batched(self):
+        backend = SlowBackend()
+        cache = httpcache.HTTPCache(cache=backend, write_behind=True)
+
+        for i in range(5):
+            self.store(cache, str(i))
+        backend.release.set()
+        cache.close()
+
+        assert len(backend.data) == 5
+        assert len(backend.batches) < 5
+
+    def test_writes_are_dropped_when_the_queue_is_full(self):
+        backend = SlowBackend()
+        cache = httpcache.HTTPCache(
+            cache=backend, write_behind=True, max_pending_writes=1)
+
+        stored = [self.store(cache, str(i)) for i in range(3)]
+
+        writes = cache._writes
+        assert writes.dropped >= 1
+        assert stored.count(False) == writes.dropped
+        backend.release.set()
+        cache.close()
+        assert len(backend.data) == 3 - writes.dropped
+
+    def test_invalidation_cancels_pending_writes(self):
+        backend = SlowBackend()
+        cache = httpcache.HTTPCache(cache=backend, write_behind=True)
+        self.store(cache)
+
+        assert cache.invalidate('http://www.test.com/') == 1
+        assert cache.retrieve(MockRequestsPreparedRequest()) is None
+
+        backend.release.set()
+        cache.flush(5)
+        assert not backend.data
+
+    def test_stores_after_close_are_written_directly(self):
+        backend = mockcache.Client(['127.0.0.1:0'])
+        cache = httpcache.HTTPCache(cache=backend, write_behind=True)
+        cache.close()
+
+        assert self.store(cache)
+        assert backend.get(cache.make_key('http://www.test.com/', ''))
+
+
+class TestInvalidationIndex(object):
+    """
+    Tests for the secondary index used for invalidation.
+    """
+    def test_finds_keys_by_prefix(self):
+        index = InvalidationIndex()
+        index.add('a', 'http://test.com/items/1')
+        index.add('b', 'http://test.com/items/1/related')
+        index.add('c', 'http://test.com/items?page=2')
+        index.add('d', 'http://test.com/other')
+
+        assert index.keys_for_prefix('http://test.com/items') == set('abc')
+        assert index.keys_for_prefix('http://test.com/items/1') == set('ab')
+        assert index.keys_for_prefix('http://test.com/nothing') == set()
+
+    def test_finds_keys_by_tag(self):
+        index = InvalidationIndex()
+        index.add('a', 'http://test.com/1', ('items', 'item-1'))
+        index.add('b', 'http://test.com/2', ('items',))
+
+        assert index.keys_for_tag('items') == set('ab')
+        assert index.keys_for_tag('item-1') == set('a')
+
+    def test_removed_keys_are_forgotten(self):
+        index = InvalidationIndex()
+        index.add('a', 'http://test.com/1', ('items',))
+        index.add('b', 'http://test.com/1', ('items',))
+        index.remove('a')
+        index.remove('a')
+
+        assert index.keys_for_url('http://test.com/1') == set('b')
+        assert index.keys_for_tag('items') == set('b')
+
+        index.remove('b')
+        assert len(index) == 0
+        assert index._urls == []
+        assert index._tag_keys == {}
+
+    def test_expired_keys_are_forgotten(self):
+        index = InvalidationIndex()
+        index.add('a', 'http://test.com/1', ('items',), expires=10)
+        index.add('b', 'http://test.com/2', expires=20)
+        index.add('a', 'http://test.com/1', expires=30)
+
+        assert index.expire(25) == 1
+        assert index.keys_for_url('http://test.com/2') == set()
+        assert index.keys_for_url('http://test.com/1') == set('a')
+        assert index.expire(31) == 1
+        assert len(index) == 0
+
+    def test_oldest_keys_are_dropped_over_the_cap(self):
+        index = InvalidationIndex(max_keys=100)
+        for i in range(1000):
+            index.add('key-%d' % i, 'http://test.com/%d' % i)
+
+        assert len(index) == 100
+        assert len(index._urls) == 100
+        assert index.keys_for_url('http://test.com/999') == set(['key-999'])
+
+    def test_cache_forgets_entries_a_shared_backend_expired(
+            self, monkeypatch):
+        cache = httpcache.HTTPCache(cache=TTLBackend(), stale_grace=5)
+        now = [httpcache.cache.clock()]
+        monkeypatch.setattr(httpcache.cache, 'clock', lambda: now[0])
+
+        for i in range(100):
+            resp = MockRequestsResponse(
+                url='http://www.test.com/%d' % i,
+                headers={'Cache-Control': 'max-age=60'})
+            assert cache.store(resp, resp.request)
+        assert len(cache._index) == 100
+
+        now[0] += 66
+        resp = MockRequestsResponse(
+            url='http://www.test.com/new',
+            headers={'Cache-Control': 'max-age=60'})
+        assert cache.store(resp, resp.request)
+        assert len(cache._index) == 1
+
+
+class TestInvalidation(object):
+    """
+    Tests for the invalidation API of the HTTPCache object.
+    """
+    def fill(self, cache, paths, **headers):
+        headers.setdefault('Cache-Control', 'max-age=3600')
+        for path in paths:
+            resp = MockRequestsResponse(
+                url='http://www.test.com' + path, headers=dict(headers))
+            req = MockRequestsPreparedRequest(url=resp.url)
+            assert cache.store(resp, req)
+
+    def cached(self, cache, path):
+        req = MockRequestsPreparedRequest(url='http://www.test.com' + path)
+        return cache.retrieve(req) is not None
+
+    def test_invalidate_prefix(self):
+        cache = httpcache.HTTPCache()
+        self.fill(cache, ['/api/items/42', '/api/items?page=2',
+                          '/api/items/42/related', '/api/users/1'])
+
+        assert cache.invalidate_prefix('http://www.test.com/api/items') == 3
+        assert not self.cached(cache, '/api/items/42/related')
+        assert self.cached(cache, '/api/users/1')
+
+    def test_invalidate_removes_all_variants(self):
+        cache = httpcache.HTTPCache()
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+
+        for language in ('en', 'fr'):
+            req = MockRequestsPreparedRequest(
+                headers={'Accept-Language': language})
+            assert cache.store(resp, req)
+
+        assert cache.invalidate(resp.url) == 2
+        assert len(cache._cache) == 0
+
+    def test_invalidate_tags(self):
+        cache = httpcache.HTTPCache()
+        self.fill(cache, ['/a'], **{'Surrogate-Key': 'items item-1'})
+        self.fill(cache, ['/b'], **{'Cache-Tag': 'items, item-2'})
+        self.fill(cache, ['/c'])
+
+        assert cache.invalidate_tags('item-2') == 1
+        assert self.cached(cache, '/a')
+        assert cache.invalidate_tags('items') == 1
+        assert not self.cached(cache, '/a')
+        assert self.cached(cache, '/c')
+
+    def test_unsafe_responses_invalidate_location(self):
+        cache = httpcache.HTTPCache()
+        self.fill(cache, ['/items', '/items/42', '/items/43'])
+
+        resp = MockRequestsResponse(
+            status_code=201, url='http://www.test.com/items',
+            headers={'Location': '/items/42',
+                     'Content-Location': 'http://other.com/items/43'})
+        resp.request.method = 'POST'
+
+        assert not cache.store(resp, resp.request)
+        assert not self.cached(cache, '/items')
+        assert not self.cached(cache, '/items/42')
+        assert self.cached(cache, '/items/43')
+
+    def test_failed_unsafe_responses_dont_invalidate(self):
+        cache = httpcache.HTTPCache()
+        self.fill(cache, ['/items'])
+
+        resp = MockRequestsResponse(
+            status_code=500, url='http://www.test.com/items')
+        resp.request.method = 'POST'
+
+        assert not cache.store(resp, resp.request)
+        assert self.cached(cache, '/items')
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class TestInvalidationBus(object):
+    """
+    Tests for sharing invalidations between caches in different processes.
+    """
+    def fill(self, cache, path, **headers):
+        headers.setdefault('Cache-Control', 'max-age=3600')
+        resp = MockRequestsResponse(
+            url='http://www.test.com' + path, headers=headers)
+        assert cache.store(resp, resp.request)
+
+    def cached(self, cache, path):
+        req = MockRequestsPreparedRequest(url='http://www.test.com' + path)
+        return cache.retrieve(req) is not None
+
+    def pair(self, **kwargs):
+        first = LocalBus(**kwargs)
+        second = LocalBus(first, **kwargs)
+        caches = (httpcache.HTTPCache(bus=first),
+                  httpcache.HTTPCache(bus=second))
+        for cache in caches:
+            for path in ('/items/1', '/items/2', '/users/1'):
+                self.fill(cache, path, **{'Surrogate-Key': 'items'})
+        return caches
+
+    def test_unsafe_requests_invalidate_other_caches(self):
+        first, second = self.pair()
+
+        req = MockRequestsPreparedRequest(url='http://www.test.com/items/1')
+        req.method = 'POST'
+        first.retrieve(req)
+        first.bus.flush()
+
+        assert not self.cached(second, '/items/1')
+        assert self.cached(second, '/items/2')
+
+    def test_unsafe_responses_invalidate_other_caches(self):
+        first, second = self.pair()
+
+        resp = MockRequestsResponse(
+            status_code=201, url='http://www.test.com/users',
+            headers={'Location': '/items/2'})
+        resp.request.method = 'POST'
+        first.store(resp, resp.request)
+        first.bus.flush()
+
+        assert not self.cached(second, '/items/2')
+        assert self.cached(second, '/items/1')
+
+    def test_invalidate_methods_are_shared(self):
+        first, second = self.pair()
+
+        first.invalidate_prefix('http://www.test.com/users')
+        first.bus.flush()
+        assert not self.cached(second, '/users/1')
+        assert self.cached(second, '/items/1')
+
+        first.invalidate_tags('items')
+        first.bus.flush()
+        assert not self.cached(second, '/items/2')
+
+    def test_received_invalidations_are_not_republished(self):
+        first, second = self.pair()
+
+        first.invalidate('http://www.test.com/items/1')
+        first.bus.flush()
+        second.bus.flush()
+
+        assert first.bus.sent == 1
+        assert second.bus.received == 1
+        assert second.bus.sent == 0
+
+    def test_invalidations_are_batched(self):
+        first, second = self.pair(delay=0.05)
+
+        for i in range(100):
+            first.invalidate('http://www.test.com/items/%d' % i)
+
+        assert wait_until(lambda: not self.cached(second, '/items/2'))
+        assert first.bus.sent == 1
+
+    def test_large_batches_are_split(self):
+        bus = LocalBus(max_message=256)
+        received = []
+        LocalBus(bus).subscribe(
+            lambda **kwargs: received.extend(kwargs['keys']))
+
+        keys = [uuid.uuid4().hex for i in range(100)]
+        bus.publish(keys=keys)
+        bus.flush()
+
+        assert bus.sent > 1
+        assert sorted(received) == sorted(keys)
+
+    def test_own_and_garbled_messages_are_ignored(self):
+        bus = LocalBus()
+        received = []
+        bus.subscribe(lambda **kwargs: received.append(kwargs))
+
+        bus._receive(bus._encode([('k', 'a')])[0])
+        bus._receive(b'HCI1 not compressed')
+        bus._receive(b'something else')
+
+        assert received == []
+        assert bus.errors == 2
+
+    def test_huge_messages_are_ignored(self):
+        bus = LocalBus()
+        received = []
+        bus.subscribe(lambda **kwargs: received.append(kwargs))
+
+        body = b'{"k":["' + b'a' * MAX_DECOMPRESSED + b'"]}'
+        bus._receive(MAGIC + zlib.compress(body))
+
+        assert received == []
+        assert bus.errors == 1
+
+    def test_unix_socket_bus(self, tmpdir):
+        first = UnixSocketBus(str(tmpdir), delay=0)
+        second = UnixSocketBus(str(tmpdir), delay=0)
+        received = []
+        second.subscribe(lambda **kwargs: received.append(kwargs['urls']))
+
+        # A socket left behind by a process that's gone away.
+        gone = str(tmpdir.join('gone.sock'))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(gone)
+        sock.close()
+
+        try:
+            first.publish(urls=['http://www.test.com/'])
+            assert wait_until(lambda: received)
+            assert received == [['http://www.test.com/']]
+            assert not os.path.exists(gone)
+        finally:
+            first.close()
+            second.close()
+
+    def test_multicast_bus(self):
+        try:
+            first = MulticastBus(port=42424, delay=0)
+            second = MulticastBus(port=42424, delay=0)
+        except (OSError, IOError) as e:
+            pytest.skip("Multicast isn't available: %s" % e)
+
+        received = []
+        second.subscribe(lambda **kwargs: received.append(kwargs['keys']))
+
+        try:
+            first.publish(keys=['a'])
+            if not wait_until(lambda: received, timeout=2):
+                pytest.skip("Multicast isn't routed here.")
+            assert received == [['a']]
+            assert first.received == 0
+        finally:
+            first.close()
+            second.close()
+
+
+@pytest.fixture
+def shm_cache():
+    cache = SharedMemoryCache(
+        'httpcache-test-' + uuid.uuid4().hex[:8], slots=16, slot_size=4096)
+    yield cache
+    cache.close()
+    cache.unlink()
+
+
+def _store_in_shared_memory(name, key, value):
+    cache = SharedMemoryCache(name)
+    cache.set(key, value)
+    cache.close()
+
+
+@pytest.mark.skipif(shared_memory is None, reason="needs shared_memory")
+class TestSharedMemoryCache(object):
+    """
+    Tests for the shared memory backend.
+    """
+    def test_can_set_get_and_delete(self, shm_cache):
+        shm_cache.set('a', u'text \u2713')
+        shm_cache.set('b', b'raw bytes')
+
+        assert shm_cache.get('a') == u'text \u2713'
+        assert shm_cache.get('b') == b'raw bytes'
+        assert shm_cache.get('c', 'default') == 'default'
+        assert len(shm_cache) == 2
+
+        shm_cache.delete('a')
+        assert shm_cache.get('a') is None
+        assert 'a' not in shm_cache
+        assert len(shm_cache) == 1
+
+    def test_overwriting_keeps_one_entry(self, shm_cache):
+        shm_cache.set('a', '1')
+        shm_cache.set('a', '2')
+
+        assert shm_cache.get('a') == '2'
+        assert len(shm_cache) == 1
+
+    def test_keys_are_oldest_first(self, shm_cache):
+        for key in ('c', 'a', 'b'):
+            shm_cache.set(key, key)
+
+        assert shm_cache.keys() == ['c', 'a', 'b']
+        assert shm_cache.items() == [('c', 'c'), ('a', 'a'), ('b', 'b')]
+
+    def test_values_are_never_unpickled(self, shm_cache):
+        with pytest.raises(TypeError):
+            shm_cache.set('a', {'value': 1})
+
+        # A value written as a pickle by another process on the host.
+        shm_cache.set('b', b'placeholder')
+        index = shm_cache._find(b'b')
+        body = shm_cache._offset(index) + SLOT_HEADER.size
+        shm_cache._buf[body:body + 1] = b'\x01'
+
+        assert shm_cache.get('b') is None
+
+    def test_values_too_large_are_not_stored(self, shm_cache):
+        assert not shm_cache.set('a', b'x' * 4096)
+        assert 'a' not in shm_cache
+
+    def test_writers_killed_mid_write_dont_hang_others(self, shm_cache):
+        shm_cache.set('a', b'value')
+        index = shm_cache._find(b'a')
+
+        # Leave the slot as a writer killed halfway through would.
+        offset = shm_cache._offset(index)
+        seq = struct.unpack_from('<I', shm_cache._buf, offset)[0]
+        struct.pack_into('<I', shm_cache._buf, offset, seq + 1)
+
+        start = time.time()
+        assert shm_cache.get('a') is None
+        assert time.time() - start < 1
+
+        shm_cache.set('a', b'again')
+        assert shm_cache.get('a') == b'again'
+        assert len(shm_cache) == 1
+        assert shm_cache.keys() == ['a']
+
+    def test_entries_expire(self, shm_cache):
+        shm_cache.set('a', b'1', 0.05)
+        shm_cache.set('b', b'2', int(time.time()) - 1)
+        shm_cache.set('c', b'3', 3600)
+
+        time.sleep(0.1)
+        assert shm_cache.get('a') is None
+        assert shm_cache.get('b') is None
+        assert shm_cache.get('c') == b'3'
+
+    def test_full_table_replaces_expired_entries_first(self):
+        cache = SharedMemoryCache(
+            'httpcache-test-' + uuid.uuid4().hex[:8], slots=16,
+            slot_size=512, probes=16)
+        try:
+            cache.set('old', 'old')
+            for i in range(15):
+                cache.set(str(i), str(i), 0.01)
+            time.sleep(0.05)
+
+            for i in range(15):
+                cache.set('new%d' % i, str(i))
+
+            assert cache.get('old') == 'old'
+            assert cache.get('new14') == '14'
+        finally:
+            cache.close()
+            cache.unlink()
+
+    def test_add_only_stores_new_keys(self, shm_cache):
+        assert shm_cache.add('a', '1', 0.05)
+        assert not shm_cache.add('a', '2')
+        assert shm_cache.get('a') == '1'
+
+        time.sleep(0.1)
+        assert shm_cache.add('a', '3')
+        assert shm_cache.get('a') == '3'
+
+    def test_leases_survive_trims_and_snapshots(self, shm_cache, tmpdir):
+        holder = httpcache.HTTPCache(cache=shm_cache, lease_ttl=5)
+        other = httpcache.HTTPCache(cache=shm_cache, capacity=2, lease_ttl=5)
+
+        req = MockRequestsPreparedRequest(url='http://www.test.com/leased')
+        assert holder.acquire_lease(req) is not None
+
+        for i in range(4):
+            resp = MockRequestsResponse(
+                url='http://www.test.com/%d' % i,
+                headers={'Cache-Control': 'max-age=3600'})
+            assert other.store(resp, resp.request)
+
+        assert other.acquire_lease(req) is None
+        assert other.snapshot(str(tmpdir.join('snapshot'))) >= 2
+
+    def test_full_table_replaces_old_entries(self, shm_cache):
+        for i in range(40):
+            assert shm_cache.set(str(i), str(i))
+
+        assert len(shm_cache) <= 16
+        assert shm_cache.get('39') == '39'
+
+    def test_works_as_http_cache_backend(self, shm_cache):
+        cache = httpcache.HTTPCache(capacity=5, cache=shm_cache)
+        req = MockRequestsPreparedRequest()
+
+        for i in range(10):
+            resp = MockRequestsResponse(
+                headers={'Cache-Control': 'max-age=3600'}, content=b'body')
+            resp.url += str(i)
+            assert cache.store(resp, req)
+
+        # The table makes room for itself, shared by every process, so the
+        # per-process capacity doesn't apply.
+        assert len(shm_cache) == 10
+        req.url += '9'
+        assert cache.retrieve(req).content == b'body'
+
+    def test_entries_are_shared_between_processes(self, shm_cache):
+        process = multiprocessing.Process(
+            target=_store_in_shared_memory,
+            args=(shm_cache.name, 'key', b'from the child'))
+        process.start()
+        process.join()
+
+        assert shm_cache.get('key') == b'from the child'
+
+
+class TestCachePolicy(object):
+    """
+    Tests for per-host and per-route caching policies.
+    """
+    def test_most_specific_path_wins(self):
+        api = httpcache.Rule('api.test.com', ttl=60)
+        users = httpcache.Rule('api.test.com', path='/users', cache=False)
+        policy = httpcache.CachePolicy([api, users])
+
+        assert policy.match('http://api.test.com/items') is api
+        assert policy.match('http://api.test.com/users/1') is users
+        assert policy.match('http://other.test.com/users') is None
+
+    def test_exact_hosts_beat_wildcards(self):
+        exact = httpcache.Rule('a.test.com')
+        wildcard = httpcache.Rule('*.test.com')
+        anything = httpcache.Rule('*')
+        policy = httpcache.CachePolicy([anything, wildcard, exact])
+
+        assert policy.match('https://A.test.com:8080/x') is exact
+        assert policy.match('http://b.a.test.com/') is wildcard
+        assert policy.match('http://test.com/') is anything
+
+    def test_wildcard_used_when_host_paths_dont_match(self):
+        exact = httpcache.Rule('a.test.com', path='/api')
+        wildcard = httpcache.Rule('*.test.com')
+        policy = httpcache.CachePolicy([exact, wildcard])
+
+        assert policy.match('http://a.test.com/static') is wildcard
+
+    def test_never_cache(self):
+        policy = httpcache.CachePolicy(
+            [httpcache.Rule('www.test.com', cache=False)])
+        cache = httpcache.HTTPCache(policy=policy)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'})
+
+        assert not cache.store(resp, MockRequestsPreparedRequest())
+
+    def test_forced_ttl_ignores_headers(self):
+        policy = httpcache.CachePolicy(
+            [httpcache.Rule('www.test.com', ttl=60)])
+        cache = httpcache.HTTPCache(policy=policy)
+        resp = MockRequestsResponse(headers={'Cache-Control': 'no-cache'})
+        resp.url += '?a=b'
+        req = MockRequestsPreparedRequest(url=resp.url)
+
+        assert cache.store(resp, req)
+        entry = cache._cache[cache.make_key(resp.url, '')]
+        assert entry['expiry'] - entry['creation'] == 60
+        assert cache.retrieve(req) is not None
+
+    def test_ignore_cache_control(self):
+        policy = httpcache.CachePolicy(
+            [httpcache.Rule('www.test.com', ignore_cache_control=True)])
+        cache = httpcache.HTTPCache(policy=policy)
+        resp = MockRequestsResponse(headers={
+            'Cache-Control': 'no-store',
+            'Date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+            'Expires': 'Sun, 06 Nov 2034 08:49:37 GMT'})
+
+        assert cache.store(resp, MockRequestsPreparedRequest())
+        assert cache.retrieve(MockRequestsPreparedRequest()) is not None
+
+    def test_status_codes(self):
+        policy = httpcache.CachePolicy(
+            [httpcache.Rule('www.test.com', status_codes=(200, 404))])
+        cache = httpcache.HTTPCache(policy=policy)
+
+        resp = MockRequestsResponse(status_code=404)
+        assert cache.store(resp, MockRequestsPreparedRequest())
+
+    def test_adapter_accepts_a_list_of_rules(self):
+        adapter = httpcache.CachingHTTPAdapter(
+            policy=[httpcache.Rule('www.test.com', ttl=60)])
+
+        assert isinstance(adapter.cache.policy, httpcache.CachePolicy)
+
+
+class TestAdapterStats(object):
+    """
+    Tests for the adapter's hit, miss and connection pool counters.
+    """
+    def test_hits_skip_the_connection_pool(self):
+        adapter = httpcache.CachingHTTPAdapter()
+        adapter.cache.store(
+            MockRequestsResponse(headers={'Cache-Control': 'max-age=3600'}),
+            MockRequestsPreparedRequest())
+
+        resp = adapter.send(MockRequestsPreparedRequest())
+
+        assert resp.status_code == 200
+        report = adapter.stats.report()
+        assert report['hits'] == 1
+        assert report['misses'] == 0
+        assert report['hit_ratio'] == 1.0
+        assert report['pool_checkouts'] == 0
+
+    def test_pool_checkouts_are_timed(self):
+        adapter = httpcache.CachingHTTPAdapter()
+        pool = adapter.poolmanager.connection_from_url('http://www.test.com/')
+
+        pool._put_conn(pool._get_conn())
+
+        report = adapter.stats.report()
+        assert report['pool_checkouts'] == 1
+        assert report['max_pool_wait'] >= 0
+        assert report['mean_pool_wait'] <= report['max_pool_wait']
+
+    def test_revalidations_use_their_own_pools(self, monkeypatch):
+        adapter = httpcache.CachingHTTPAdapter()
+        adapter.cache.store(
+            MockRequestsResponse(headers={
+                'Last-Modified': 'Sun, 06 Nov 1994 08:49:37 GMT'},
+                content=b'cached'),
+            MockRequestsPreparedRequest())
+        sent = []
+
+        def send(request, **kwargs):
+            sent.append(request)
+            return MockRequestsResponse(status_code=304)
+
+        monkeypatch.setattr(adapter._revalidation_adapter, 'send', send)
+        resp = adapter.send(MockRequestsPreparedRequest())
+
+        assert len(sent) == 1
+        assert 'If-Modified-Since' in sent[0].headers
+        assert resp.content == b'cached'
+        assert adapter.stats.revalidations == 1
+        assert adapter.stats.misses == 1
+
+    def test_reset(self):
+        stats = httpcache.stats.AdapterStats()
+        stats.record_hit(0.5)
+        stats.record_miss(1.5)
+        stats.reset()
+
+        assert stats.report()['hits'] == 0
+        assert stats.report()['hit_ratio'] == 0.0
+
+
+def _next_page(request):
+    page = int(request.url.rsplit('/', 1)[1])
+    return MockRequestsResponse(
+        url=request.url, content=b'page',
+        headers={'Cache-Control': 'max-age=3600',
+                 'Link': '</pages/%d>; rel="next"' % (page + 1)})
+
+
+class TestPrefetch(object):
+    """
+    Tests for prefetching linked resources.
+    """
+    def test_finds_links(self):
+        prefetcher = Prefetcher(
+            None, extract=lambda resp: ['/from-body'])
+        resp = MockRequestsResponse(
+            url='http://www.test.com/a/b',
+            headers={'Link': '<c>; rel="next", <http://x.com/d>; rel=preload'
+                             ', </e>; rel="author"'})
+
+        assert prefetcher.links(resp) == [
+            'http://www.test.com/a/c', 'http://x.com/d',
+            'http://www.test.com/from-body']
+
+    @pytest.mark.parametrize(
+        'origin', [{'respond': _next_page}], indirect=True)
+    def test_prefetches_the_next_page(self, origin):
+        adapter = httpcache.CachingHTTPAdapter(prefetch=True)
+        adapter.send(requests.Request(
+            'GET', 'http://www.test.com/pages/1').prepare())
+        adapter.prefetcher.close()
+
+        # Page 2 was prefetched, but not the page it links to.
+        assert origin.urls == [
+            'http://www.test.com/pages/1', 'http://www.test.com/pages/2']
+        assert adapter.prefetcher.fetched == 1
+
+        resp = adapter.send(requests.Request(
+            'GET', 'http://www.test.com/pages/2').prepare())
+        assert resp.content == b'page'
+        assert len(origin.sent) == 2
+
+    def test_rate_limits_each_origin(self, origin):
+        adapter = httpcache.CachingHTTPAdapter()
+        prefetcher = Prefetcher(adapter, rate=1)
+        resp = MockRequestsResponse(headers={
+            'Link': '</1>; rel=next, </2>; rel=next, </3>; rel=next'})
+
+        prefetcher.submit(MockRequestsPreparedRequest(), resp)
+        prefetcher.close()
+
+        assert prefetcher.dropped == 2
+        assert origin.urls == ['http://www.test.com/1']
+
+    def test_credentials_stay_on_the_same_origin(self, origin):
+        prefetcher = Prefetcher(httpcache.CachingHTTPAdapter())
+        req = requests.Request(
+            'GET', 'http://api.test.com/x', auth=('user', 'secret'),
+            headers={'Cookie': 'session=1', 'Accept': 'text/plain',
+                     'Proxy-Authorization': 'Basic eA=='}).prepare()
+        resp = MockRequestsResponse(
+            url=req.url, headers={
+                'Link': '<https://evil.example/steal>; rel=preload, '
+                        '</y>; rel=next'})
+
+        prefetcher.submit(req, resp)
+        prefetcher.close()
+
+        sent = dict((r.url, r.headers) for r in origin.sent)
+        stolen = sent['https://evil.example/steal']
+        for name in ('Authorization', 'Cookie', 'Proxy-Authorization'):
+            assert name not in stolen
+        assert stolen['Accept'] == 'text/plain'
+
+        same = sent['http://api.test.com/y']
+        assert same['Authorization'] == req.headers['Authorization']
+        assert same['Cookie'] == 'session=1'
+
+
+class TestWarm(object):
+    """
+    Tests for filling the cache ahead of demand.
+    """
+    @pytest.mark.parametrize(
+        'origin', [{'broken': ['http://www.test.com/broken']}], indirect=True)
+    def test_warm_fills_the_cache(self, origin):
+        adapter = httpcache.CachingHTTPAdapter()
+        urls = ['http://www.test.com/1', 'http://www.test.com/2']
+
+        assert adapter.warm(urls + ['http://www.test.com/broken'],
+                            workers=2) == 2
+        assert sorted(origin.urls) == sorted(
+            urls + ['http://www.test.com/broken'])
+
+        for url in urls:
+            request = requests.Request('GET', url).prepare()
+            assert adapter.cache.retrieve(request) is not None
+
+
+class TestImports(object):
+    """
+    Tests that the cache can be used without importing Requests.
+    """
+    def run(self, code):
+        root = os.path.dirname(os.path.dirname(
+            os.path.abspath(httpcache.__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], env=env)
+        return output.decode('utf-8').strip()
+
+    def test_core_does_not_import_requests(self):
+        code = (
+            "import sys\n"
+            "import httpcache\n"
+            "from httpcache import backends, bus, governor, serializer\n"
+            "httpcache.HTTPCache().top_keys()\n"
+            "print(sorted(m for m in ('requests', 'urllib3')"
+            " if m in sys.modules))\n")
+        assert self.run(code) == '[]'
+
+    def test_core_does_not_import_shared_memory(self):
+        code = (
+            "import sys\n"
+            "before = set(sys.modules)\n"
+            "import httpcache\n"
+            "httpcache.HTTPCache()\n"
+            "print(sorted(m for m in ('fcntl', 'multiprocessing', 'tempfile')"
+            " if m in set(sys.modules) - before))\n")
+        assert self.run(code) == '[]'
+
+    def test_adapter_is_imported_on_first_use(self):
+        code = (
+            "import sys\n"
+            "import httpcache\n"
+            "before = 'requests' in sys.modules\n"
+            "adapter = httpcache.CachingHTTPAdapter\n"
+            "print(before, 'requests' in sys.modules, adapter.__name__)\n")
+        expected = 'False True CachingHTTPAdapter'
+        if sys.version_info < (3, 7):
+            expected = 'True True CachingHTTPAdapter'
+        assert self.run(code) == expected
+
+    def test_all_names_are_importable(self):
+        for name in httpcache.__all__:
+            assert getattr(httpcache, name) is not None
+        assert 'CachingHTTPAdapter' in dir(httpcache)
+        with pytest.raises(AttributeError):
+            httpcache.NoSuchThing
+
+
 class TestCachingHTTPAdapter(object):
     """
     Tests for the caching HTTP adapter.
@@ -300,7 +2392,7 @@ class TestCachingHTTPAdapter(object):
         r1 = s.get('http://httpbin.org/cache')
         r2 = s.get('http://httpbin.org/cache')
 
-        assert r1 is r2
+        assert r1.content is r2.content
 
     def test_we_respect_cache_control(self):
         s = requests.Session()
@@ -311,7 +2403,7 @@ class TestCachingHTTPAdapter(object):
         r2 = s.get('http://httpbin.org/response-headers',
                    params={'Cache-Control': 'max-age=3600'})
 
-        assert r1 is r2
+        assert r1.content is r2.content
 
     def test_we_respect_expires(self):
         s = requests.Session()
@@ -322,7 +2414,7 @@ class TestCachingHTTPAdapter(object):
         r2 = s.get('http://httpbin.org/response-headers',
                    params={'Expires': 'Sun, 06 Nov 2034 08:49:37 GMT'})
 
-        assert r1 is r2
+        assert r1.content is r2.content
 
     def test_we_respect_cache_control_2(self):
         s = requests.Session()
@@ -333,7 +2425,7 @@ class TestCachingHTTPAdapter(object):
         r2 = s.get('http://httpbin.org/response-headers',
                    params={'Cache-Control': 'no-cache'})
 
-        assert r1 is not r2
+        assert r1.content is not r2.content
 
 
 class MockRequestsResponse(object):
@@ -345,14 +2437,59 @@ class MockRequestsResponse(object):
                  status_code=200,
                  headers=None,
                  body='',
-                 url='http://www.test.com/'):
+                 url='http://www.test.com/',
+                 content=b''):
         self.status_code = status_code
+        self.reason = None
+        self.encoding = None
         if not headers:
             headers = {}
         self.headers = headers
         self.body = body
         self.url = url
         self.request = MockRequestsPreparedRequest(url=self.url)
+        self._content = content
+
+    @property
+    def content(self):
+        return self._content
+
+
+class MockOrigin(object):
+    """
+    A Mock origin server to stand in for HTTPAdapter.send, recording every
+    request sent to it. By default it answers with ``content`` and a copy of
+    ``headers``, after ``delay`` seconds.
+
+    :param respond: (Optional) A function that builds the response to a
+        request instead.
+    :param broken: (Optional) URLs whose requests fail to connect.
+    """
+    def __init__(self, headers=None, content=b'body', delay=0,
+                 respond=None, broken=()):
+        if headers is None:
+            headers = {'Cache-Control': 'max-age=3600'}
+        self.headers = headers
+        self.content = content
+        self.delay = delay
+        self.respond = respond
+        self.broken = broken
+        self.sent = []
+
+    @property
+    def urls(self):
+        return [request.url for request in self.sent]
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        if self.delay:
+            time.sleep(self.delay)
+        if request.url in self.broken:
+            raise requests.exceptions.ConnectionError('refused')
+        if self.respond is not None:
+            return self.respond(request)
+        return MockRequestsResponse(
+            url=request.url, content=self.content, headers=dict(self.headers))
 
 
 class MockRequestsPreparedRequest(object):